@@ -62,7 +62,7 @@ from inbox.util import blockstore
 from inbox.util.misc import imap_folder_path
 from inbox.actions.backends.generic import remote_delete_sent
 from inbox.crispin import writable_connection_pool
-from inbox.s3.base import get_raw_from_provider
+from inbox.s3.base import get_raw_from_provider, load_pending_body
 from inbox.s3.exc import (EmailFetchException, TemporaryEmailFetchException,
                           EmailDeletedException)
 from inbox.util.stats import statsd_client
@@ -536,11 +536,13 @@ def message_read_api(public_id):
     except NoResultFound:
         raise NotFoundError("Couldn't find message {0}".format(public_id))
 
-    if request.headers.get('Accept', None) == 'message/rfc822':
-        raw_message = blockstore.get_from_blockstore(message.data_sha256)
-        if raw_message is not None:
-            return Response(raw_message, mimetype='message/rfc822')
-        else:
+    raw_requested = request.headers.get('Accept', None) == 'message/rfc822'
+    # Messages synced header-first don't have a body yet; fetch it now.
+    if raw_requested or message.body_pending:
+        raw_message = None
+        if not message.body_pending:
+            raw_message = blockstore.get_from_blockstore(message.data_sha256)
+        if raw_message is None:
             # Try getting the message from the email provider.
             account = g.namespace.account
             statsd_string = 'api.direct_fetching.{}.{}'\
@@ -575,17 +577,26 @@ def message_read_api(public_id):
 
                 return err(404, "Couldn't find data on the email server.")
 
-            if contents is not None:
-                # If we found it, save it too.
+            if contents is None:
+                request.environ['log_context']['message_id'] = message.id
+                raise NotFoundError(
+                    "Couldn't find raw contents for message `{0}`. "
+                    "Please try again in a few minutes."
+                    .format(public_id))
+
+            raw_message = contents
+            if not message.body_pending:
+                # If we found it, save it too. (load_pending_body() saves
+                # it otherwise.)
                 data_sha256 = sha256(contents).hexdigest()
                 blockstore.save_to_blockstore(data_sha256, contents)
-                return contents
 
-            request.environ['log_context']['message_id'] = message.id
-            raise NotFoundError(
-                "Couldn't find raw contents for message `{0}`. "
-                "Please try again in a few minutes."
-                .format(public_id))
+        if message.body_pending:
+            load_pending_body(g.db_session, message, raw_message)
+            g.db_session.commit()
+
+        if raw_requested:
+            return Response(raw_message, mimetype='message/rfc822')
 
     return encoder.jsonify(message)
 
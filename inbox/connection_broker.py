@@ -0,0 +1,260 @@
+"""
+Process-wide budgets for IMAP connections.
+
+Each account has its own crispin connection pools, but providers limit the
+number of concurrent connections per user (Gmail: 15), small corporate
+servers may only accept a handful of connections in total while many of our
+accounts live on them, and the sync process itself has limits too. Before a
+pool opens a new connection, it asks the ConnectionBroker for a Lease, which
+counts against the account's, the IMAP host's and the process's budgets.
+
+If a budget is exhausted, the broker first closes idle pooled connections
+sharing it, and otherwise makes the caller wait. Waiters are served in
+priority order (e.g. inbox polling and syncback before archive folders).
+Idle connections are also closed once they've been idle for longer than
+IDLE_CONNECTION_TTL, rather than living in their pool forever.
+
+"""
+import itertools
+import time
+
+import gevent
+from gevent.event import Event
+
+from inbox.config import config
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+# Checkout priorities; lower values are served first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_NAMES = {PRIORITY_HIGH: 'high', PRIORITY_NORMAL: 'normal'}
+
+# Maximum number of IMAP connections open in this process. None means no
+# limit.
+PROCESS_CONNECTION_LIMIT = config.get('IMAP_PROCESS_CONNECTION_LIMIT', None)
+# Maximum number of connections per account, by provider.
+ACCOUNT_CONNECTION_LIMITS = config.get('IMAP_ACCOUNT_CONNECTION_LIMITS',
+                                       {'gmail': 15})
+DEFAULT_ACCOUNT_CONNECTION_LIMIT = config.get(
+    'IMAP_DEFAULT_ACCOUNT_CONNECTION_LIMIT', 10)
+# Maximum number of connections per IMAP server host, across all accounts.
+HOST_CONNECTION_LIMITS = config.get('IMAP_HOST_CONNECTION_LIMITS', {})
+DEFAULT_HOST_CONNECTION_LIMIT = config.get(
+    'IMAP_DEFAULT_HOST_CONNECTION_LIMIT', None)
+# Seconds after which idle pooled connections are closed.
+IDLE_CONNECTION_TTL = config.get('IMAP_IDLE_CONNECTION_TTL', 900)
+# Seconds between checks for expired idle connections, which is also how
+# often the broker's gauges are reported.
+REAP_INTERVAL = 60
+
+
+def connection_limits(account_id, provider, host):
+    """
+    Return the budgets a connection for the given account counts against,
+    as a dict of budget key: limit (None for unlimited).
+
+    """
+    return {
+        ('process',): PROCESS_CONNECTION_LIMIT,
+        ('account', account_id): ACCOUNT_CONNECTION_LIMITS.get(
+            provider, DEFAULT_ACCOUNT_CONNECTION_LIMIT),
+        ('host', host): HOST_CONNECTION_LIMITS.get(
+            host, DEFAULT_HOST_CONNECTION_LIMIT),
+    }
+
+
+class Lease(object):
+    """
+    One open connection's share of the budgets. Busy when created; pools call
+    checkin() when they put the connection back and checkout() when they
+    take it out again.
+
+    """
+
+    def __init__(self, broker, keys):
+        self.broker = broker
+        self.keys = keys
+        self.idle_since = None
+        self.closed = False
+        # Called (in a separate greenlet) if the broker closes the lease
+        # while it is idle, to close the connection.
+        self.on_evict = None
+
+    def checkout(self):
+        """
+        Mark the connection as in use. Returns False if the lease was
+        closed while the connection was idle, in which case the connection
+        must not be used.
+
+        """
+        if self.closed:
+            return False
+        self.idle_since = None
+        return True
+
+    def checkin(self):
+        """Mark the connection as idle."""
+        if not self.closed:
+            self.idle_since = time.time()
+            self.broker._dispatch()
+
+    def release(self):
+        """Give up the lease, because the connection has been closed."""
+        self.broker._close(self)
+
+
+class _Waiter(object):
+
+    def __init__(self, limits, priority, seq):
+        self.limits = limits
+        self.priority = priority
+        self.seq = seq
+        self.lease = None
+        self.event = Event()
+
+
+class ConnectionBroker(object):
+    """
+    Parameters
+    ----------
+    idle_ttl: int
+        Seconds after which idle leases are closed.
+
+    """
+
+    def __init__(self, idle_ttl=IDLE_CONNECTION_TTL):
+        self.idle_ttl = idle_ttl
+        self._limits = {}
+        self._counts = {}
+        self._leases = set()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._reaper = None
+
+    def acquire(self, limits, priority=PRIORITY_NORMAL):
+        """
+        Return a Lease for a new connection counting against the budgets in
+        `limits` (see connection_limits()), blocking until one is available.
+
+        """
+        start = time.time()
+        waiter = _Waiter(limits, priority, next(self._seq))
+        self._waiters.append(waiter)
+        self._waiters.sort(key=lambda w: (w.priority, w.seq))
+        try:
+            self._dispatch()
+            waiter.event.wait()
+        except BaseException:
+            # e.g. the greenlet was killed while waiting.
+            if waiter.lease is None:
+                self._waiters.remove(waiter)
+            else:
+                waiter.lease.release()
+            raise
+        wait_time = time.time() - start
+        statsd_client.timing('mailsync.connection_broker.wait_time.{}'.format(
+            PRIORITY_NAMES.get(priority, priority)), wait_time * 1000)
+        if wait_time > 1:
+            log.info('Waited for IMAP connection budget',
+                     wait_time=wait_time, priority=priority,
+                     budgets=[k for k in limits if self._full(k)])
+        self._ensure_reaper()
+        return waiter.lease
+
+    def _full(self, key):
+        limit = self._limits.get(key)
+        return limit is not None and self._counts.get(key, 0) >= limit
+
+    def _dispatch(self):
+        """Grant leases to as many waiters as the budgets allow."""
+        self._evict_expired()
+        # Budgets a higher-priority waiter is blocked on; lower-priority
+        # waiters mustn't take capacity from them.
+        blocked = set()
+        for waiter in list(self._waiters):
+            if blocked.intersection(waiter.limits):
+                continue
+            self._limits.update(waiter.limits)
+            full = self._make_room(waiter.limits)
+            if full:
+                blocked.update(full)
+                continue
+            lease = Lease(self, tuple(waiter.limits))
+            self._leases.add(lease)
+            for key in lease.keys:
+                self._counts[key] = self._counts.get(key, 0) + 1
+            self._waiters.remove(waiter)
+            waiter.lease = lease
+            waiter.event.set()
+
+    def _make_room(self, keys):
+        """
+        Close idle leases until none of `keys` are at their limit. Returns
+        the keys still at their limit if that's not possible.
+
+        """
+        while True:
+            full = [key for key in keys if self._full(key)]
+            if not full:
+                return []
+            idle = [lease for lease in self._leases
+                    if lease.idle_since is not None and
+                    any(key in lease.keys for key in full)]
+            if not idle:
+                return full
+            self._evict(min(idle, key=lambda lease: lease.idle_since))
+
+    def _evict(self, lease):
+        self._close(lease, dispatch=False)
+        if lease.on_evict is not None:
+            gevent.spawn(lease.on_evict)
+
+    def _evict_expired(self):
+        now = time.time()
+        expired = [lease for lease in self._leases
+                   if lease.idle_since is not None and
+                   now - lease.idle_since > self.idle_ttl]
+        for lease in expired:
+            self._evict(lease)
+        if expired:
+            log.info('Closed idle IMAP connections', count=len(expired))
+
+    def _close(self, lease, dispatch=True):
+        if lease.closed:
+            return
+        lease.closed = True
+        self._leases.discard(lease)
+        for key in lease.keys:
+            self._counts[key] -= 1
+            if not self._counts[key]:
+                del self._counts[key]
+        if dispatch:
+            self._dispatch()
+
+    def _report(self):
+        statsd_client.gauge('mailsync.connection_broker.open',
+                            len(self._leases))
+        statsd_client.gauge('mailsync.connection_broker.idle', sum(
+            1 for lease in self._leases if lease.idle_since is not None))
+        statsd_client.gauge('mailsync.connection_broker.waiting',
+                            len(self._waiters))
+
+    def _ensure_reaper(self):
+        if self._reaper is None or self._reaper.dead:
+            self._reaper = gevent.spawn(self._reap)
+
+    def _reap(self):
+        while self._leases:
+            gevent.sleep(REAP_INTERVAL)
+            self._dispatch()
+            self._report()
+
+
+_broker = ConnectionBroker()
+
+
+def get_broker():
+    """Return the process-wide ConnectionBroker."""
+    return _broker
@@ -4,6 +4,7 @@ import re
 import time
 import imaplib
 import imapclient
+from imapclient.imapclient import _parse_untagged_response
 
 # Even though RFC 2060 says that the date component must have two characters
 # (either two digits or space+digit), it seems that some IMAP servers only
@@ -19,7 +20,19 @@ imaplib.InternalDate = re.compile(
     r' (?P<zonen>[-+])(?P<zoneh>[0-9][0-9])(?P<zonem>[0-9][0-9])'
     r'"')
 
+# imaplib in Python 2 doesn't know about the ENABLE command (RFC 5161), which
+# we need to turn on QRESYNC. Like SELECT, it's only valid before a mailbox
+# is selected.
+imaplib.Commands.setdefault('ENABLE', ('AUTH',))
+# Nor about NOTIFY (RFC 5465), which we use to watch all of an account's
+# folders over a single connection.
+imaplib.Commands.setdefault('NOTIFY', ('AUTH', 'SELECTED'))
+
+import base64
+import binascii
 import functools
+import itertools
+import quopri
 import threading
 from email.parser import HeaderParser
 
@@ -35,7 +48,12 @@ from sqlalchemy.orm import joinedload
 from inbox.util.concurrency import retry
 from inbox.util.itert import chunk
 from inbox.util.misc import or_none
+from inbox.util.html import strip_tags
+from inbox.util.imap_compress import can_compress, DeflateStream
 from inbox.basicauth import GmailSettingError
+from inbox.connection_broker import (connection_limits, get_broker,
+                                     PRIORITY_HIGH, PRIORITY_NORMAL)
+from inbox.config import config
 from inbox.models.session import session_scope
 from inbox.models.backends.imap import ImapAccount
 from inbox.models.backends.generic import GenericAccount
@@ -55,7 +73,29 @@ GMetadata = namedtuple('GMetadata', 'g_msgid g_thrid size')
 RawMessage = namedtuple(
     'RawImapMessage',
     'uid internaldate flags body g_thrid g_msgid g_labels')
+# For header-first sync: `body` is just the header block, `size` the size of
+# the full message and `preview` the start of its text.
+RawHeaders = namedtuple(
+    'RawImapHeaders',
+    'uid internaldate flags body size preview g_thrid g_msgid g_labels')
 RawFolder = namedtuple('RawFolder', 'display_name role')
+# The MIME part (IMAP section specifier, e.g. '1.2') header-first sync takes
+# message previews from.
+PreviewPart = namedtuple('PreviewPart', 'section subtype encoding charset')
+
+HEADER_FETCH_ITEMS = ['BODY.PEEK[HEADER]', 'BODYSTRUCTURE', 'RFC822.SIZE',
+                      'INTERNALDATE', 'FLAGS']
+# Enough of the first text part to make a snippet from.
+PREVIEW_BYTES = 2048
+# Number of Gmail threads expand_threads() ORs together in a single SEARCH.
+THREAD_SEARCH_CHUNK_SIZE = 100
+# Maximum length of a UID sequence set in a single command. Servers limit the
+# length of command lines (RFC 7162 recommends clients stay under 8192
+# octets), and some abort the connection rather than return an error.
+SEQUENCE_SET_MAX_LENGTH = 4000
+
+# Negotiate COMPRESS=DEFLATE (RFC 4978) with servers that support it.
+IMAP_COMPRESS = config.get('IMAP_COMPRESS', True)
 
 # Lazily-initialized map of account ids to lock objects.
 # This prevents multiple greenlets from concurrently creating duplicate
@@ -139,6 +179,9 @@ class CrispinConnectionPool(object):
         How many connections in the pool.
     readonly : bool
         Is the connection to the IMAP server read-only?
+
+    New connections are only opened once the process-wide ConnectionBroker
+    grants a lease for them, see inbox/connection_broker.py.
     """
 
     def __init__(self, account_id, num_connections, readonly):
@@ -148,6 +191,8 @@ class CrispinConnectionPool(object):
         self.readonly = readonly
         self._queue = Queue(num_connections, items=num_connections * [None])
         self._sem = BoundedSemaphore(num_connections)
+        self.provider = None
+        self.host = None
         self._set_account_info()
 
     def _should_timeout_connection(self):
@@ -163,11 +208,18 @@ class CrispinConnectionPool(object):
             log.info('Error on IMAP logout', exc_info=True)
 
     @contextlib.contextmanager
-    def get(self):
+    def get(self, priority=None):
         """ Get a connection from the pool, or instantiate a new one if needed.
         If `num_connections` connections are already in use, block until one is
         available.
+
+        `priority` (PRIORITY_HIGH or PRIORITY_NORMAL) determines the order in
+        which we're served if opening a new connection has to wait for the
+        connection budgets. It defaults to high for writable (syncback)
+        pools, normal otherwise.
         """
+        if priority is None:
+            priority = PRIORITY_NORMAL if self.readonly else PRIORITY_HIGH
         # A gevent semaphore is granted in the order that greenlets tried to
         # acquire it, so we use a semaphore here to prevent potential
         # starvation of greenlets if there is high contention for the pool.
@@ -177,12 +229,16 @@ class CrispinConnectionPool(object):
         self._sem.acquire()
         client = self._queue.get()
         try:
+            if client is not None and not client.lease.checkout():
+                # The broker closed the connection while it was idle.
+                client = None
             if client is None:
-                client = self._new_connection()
+                client = self._new_leased_connection(priority)
             yield client
 
             if not self._should_timeout_connection():
                 self._logout(client)
+                client.lease.release()
                 client = None
         except CONN_DISCARD_EXC_CLASSES as exc:
             # Discard the connection on socket or IMAP errors. Technically this
@@ -191,17 +247,33 @@ class CrispinConnectionPool(object):
             # thing to do.
             log.info('IMAP connection error; discarding connection',
                      exc_info=True)
-            if client is not None and \
-               not isinstance(exc, CONN_UNUSABLE_EXC_CLASSES):
-                self._logout(client)
+            if client is not None:
+                if not isinstance(exc, CONN_UNUSABLE_EXC_CLASSES):
+                    self._logout(client)
+                client.lease.release()
             client = None
             raise exc
         except:
             raise
         finally:
+            if client is not None:
+                client.lease.checkin()
             self._queue.put(client)
             self._sem.release()
 
+    def _new_leased_connection(self, priority):
+        lease = get_broker().acquire(
+            connection_limits(self.account_id, self.provider, self.host),
+            priority)
+        try:
+            client = self._new_connection()
+        except:
+            lease.release()
+            raise
+        client.lease = lease
+        lease.on_evict = functools.partial(self._logout, client)
+        return client
+
     def _set_account_info(self):
         with session_scope(self.account_id) as db_session:
             account = db_session.query(ImapAccount).get(self.account_id)
@@ -210,6 +282,7 @@ class CrispinConnectionPool(object):
             self.provider_info = account.provider_info
             self.email_address = account.email_address
             self.auth_handler = account.auth_handler
+            self.host = account.imap_endpoint[0]
             if account.provider == 'gmail':
                 self.client_cls = GmailCrispinClient
             else:
@@ -233,9 +306,17 @@ class CrispinConnectionPool(object):
 
     def _new_connection(self):
         conn = self._new_raw_connection()
-        return self.client_cls(self.account_id, self.provider_info,
-                               self.email_address, conn,
-                               readonly=self.readonly)
+        client = self.client_cls(self.account_id, self.provider_info,
+                                 self.email_address, conn,
+                                 readonly=self.readonly)
+        if IMAP_COMPRESS and client.compression_supported():
+            client.enable_compression(
+                'mailsync.providers.{}.imap.bytes'.format(self.provider))
+        # QRESYNC can only be enabled before the first SELECT, so do it
+        # right away for the sync connections that poll for changes.
+        if self.readonly and client.qresync_supported():
+            client.enable_qresync()
+        return client
 
 
 def _exc_callback(exc):
@@ -297,6 +378,9 @@ class CrispinClient(object):
         self._folder_names = None
         self.conn = conn
         self.readonly = readonly
+        self.qresync_enabled = False
+        # DeflateStream, once COMPRESS=DEFLATE is enabled.
+        self.compression = None
 
     def _fetch_folder_list(self):
         """ NOTE: XLIST is deprecated, so we just use LIST.
@@ -609,9 +693,91 @@ class CrispinClient(object):
         capabilities = self.conn.capabilities()
         return 'CONDSTORE' in capabilities or 'QRESYNC' in capabilities
 
+    def qresync_supported(self):
+        return 'QRESYNC' in self.conn.capabilities()
+
+    def enable_qresync(self):
+        """
+        Issue ENABLE QRESYNC (RFC 7162). Must be called before any folder is
+        selected on this connection. If the server refuses, we just carry on
+        without it and fall back to plain CONDSTORE.
+
+        """
+        try:
+            typ, data = self.conn._imap._simple_command('ENABLE', 'QRESYNC')
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error as e:
+            typ, data = 'NO', [str(e)]
+        if typ != 'OK':
+            log.warning('Error enabling QRESYNC', response=data)
+            return
+        self.qresync_enabled = True
+
+    def compression_supported(self):
+        return ('COMPRESS=DEFLATE' in self.conn.capabilities() and
+                can_compress(self.conn._imap))
+
+    def enable_compression(self, metric_prefix=None):
+        """
+        Issue COMPRESS DEFLATE (RFC 4978) and compress all further traffic
+        on this connection. If the server refuses, we just carry on
+        uncompressed.
+
+        Parameters
+        ----------
+        metric_prefix: str, optional
+            Report compressed and raw byte counts under this statsd prefix.
+
+        """
+        try:
+            typ, data = self.conn._imap._simple_command('COMPRESS', 'DEFLATE')
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error as e:
+            typ, data = 'NO', [str(e)]
+        if typ != 'OK':
+            log.warning('Error enabling COMPRESS=DEFLATE', response=data)
+            return
+        self.compression = DeflateStream(self.conn._imap, metric_prefix)
+
     def idle_supported(self):
         return 'IDLE' in self.conn.capabilities()
 
+    def notify_supported(self):
+        return 'NOTIFY' in self.conn.capabilities()
+
+    def notify_set(self, folder_names):
+        """
+        Ask the server to notify us of new and expunged messages and of flag
+        changes in `folder_names` (RFC 5465). Notifications arrive as untagged
+        STATUS responses, which we pick up by IDLEing; see
+        parse_notify_status().
+
+        Returns
+        -------
+        bool
+            Whether the server accepted the request.
+
+        """
+        # event-group = "(" filter-mailboxes SP events ")", where a list of
+        # several mailboxes needs its own parentheses.
+        mailboxes = ' '.join(self.conn._normalise_folder(name)
+                             for name in folder_names)
+        try:
+            typ, data = self.conn._imap._simple_command(
+                'NOTIFY', 'SET',
+                '(mailboxes ({}) (MessageNew MessageExpunge FlagChange))'
+                .format(mailboxes))
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error as e:
+            typ, data = 'NO', [str(e)]
+        if typ != 'OK':
+            log.warning('Error setting up NOTIFY', response=data)
+            return False
+        return True
+
     def search_uids(self, criteria):
         """
         Find UIDs in this folder matching the criteria. See
@@ -658,27 +824,30 @@ class CrispinClient(object):
         return sorted([long(uid) for uid in fetch_result])
 
     def uids(self, uids):
+        """
+        Download the given UIDs with a single multi-UID FETCH command.
+
+        Some servers reject the whole command if any one of the messages can't
+        be fetched. In that case, we retry the UIDs of the rejected batch one
+        at a time, so that only the offending UIDs get skipped.
+
+        """
         uid_set = set(uids)
         messages = []
-        raw_messages = {}
 
-        for uid in uid_set:
+        if len(uid_set) > 1:
             try:
-                raw_messages.update(self.conn.fetch(
-                    uid, ['BODY.PEEK[]', 'INTERNALDATE', 'FLAGS']))
+                raw_messages = self._fetch_sequence_sets(
+                    uid_set, ['BODY.PEEK[]', 'INTERNALDATE', 'FLAGS'])
+            except imapclient.IMAPClient.AbortError:
+                raise
             except imapclient.IMAPClient.Error as e:
-                if ('[UNAVAILABLE] UID FETCH Server error '
-                        'while fetching messages') in str(e):
-                    log.info('Got an exception while requesting an UID',
-                             uid=uid, error=e,
-                             logstash_tag='imap_download_exception')
-                    continue
-                else:
-                    log.info(('Got an unhandled exception while '
-                              'requesting an UID'),
-                             uid=uid, error=e,
-                             logstash_tag='imap_download_exception')
-                    raise
+                log.info('Batch UID fetch failed, falling back to '
+                         'per-UID fetches', uid_count=len(uid_set), error=e,
+                         logstash_tag='imap_download_exception')
+                raw_messages = self._fetch_uids_individually(uid_set)
+        else:
+            raw_messages = self._fetch_uids_individually(uid_set)
 
         for uid in sorted(raw_messages.iterkeys(), key=long):
             # Skip handling unsolicited FETCH responses
@@ -699,22 +868,155 @@ class CrispinClient(object):
                                        g_labels=None))
         return messages
 
-    def flags(self, uids):
-        if len(uids) > 100:
-            # Some backends abort the connection if you give them a really
-            # long sequence set of individual UIDs, so instead fetch flags for
-            # all UIDs greater than or equal to min(uids).
-            seqset = '{}:*'.format(min(uids))
-        else:
-            seqset = uids
-        data = self.conn.fetch(seqset, ['FLAGS'])
+    def _fetch_uids_individually(self, uid_set):
+        raw_messages = {}
+        for uid in uid_set:
+            try:
+                raw_messages.update(self.conn.fetch(
+                    uid, ['BODY.PEEK[]', 'INTERNALDATE', 'FLAGS']))
+            except imapclient.IMAPClient.Error as e:
+                if ('[UNAVAILABLE] UID FETCH Server error '
+                        'while fetching messages') in str(e):
+                    log.info('Got an exception while requesting an UID',
+                             uid=uid, error=e,
+                             logstash_tag='imap_download_exception')
+                    continue
+                else:
+                    log.info(('Got an unhandled exception while '
+                              'requesting an UID'),
+                             uid=uid, error=e,
+                             logstash_tag='imap_download_exception')
+                    raise
+        return raw_messages
+
+    def uid_headers(self, uids):
+        """
+        Like uids(), but for header-first sync: only download the header
+        block, size and a short text preview of the given UIDs.
+
+        """
+        data, previews = self._fetch_headers_and_previews(uids, [])
+        return [RawHeaders(uid=long(uid), internaldate=msg['INTERNALDATE'],
+                           flags=msg['FLAGS'], body=msg['BODY[HEADER]'],
+                           size=msg['RFC822.SIZE'], preview=previews.get(uid),
+                           g_thrid=None, g_msgid=None, g_labels=None)
+                for uid, msg in sorted(data.iteritems())]
+
+    def _fetch_headers_and_previews(self, uids, extra_items):
+        """
+        Fetch HEADER_FETCH_ITEMS plus `extra_items` for `uids`, then the
+        first PREVIEW_BYTES of each message's first text part. That's one
+        extra FETCH per distinct part section, and typically all messages
+        have their text in part 1 or 1.1.
+
+        Returns
+        -------
+        (dict, dict)
+            uid: fetch response, and uid: preview text (unicode).
+
+        """
+        data = self._fetch_sequence_sets(uids,
+                                         HEADER_FETCH_ITEMS + extra_items)
+        # Skip expunged messages.
+        data = {uid: ret for uid, ret in data.iteritems()
+                if 'BODY[HEADER]' in ret}
+
+        parts = {}
+        by_section = defaultdict(list)
+        for uid, ret in data.iteritems():
+            part = preview_part(ret.get('BODYSTRUCTURE'))
+            if part is not None:
+                parts[uid] = part
+                by_section[part.section].append(uid)
+
+        previews = {}
+        for section, section_uids in by_section.iteritems():
+            response_key = 'BODY[{}]'.format(section)
+            fetched = self._fetch_sequence_sets(
+                section_uids,
+                ['BODY.PEEK[{}]<0.{}>'.format(section, PREVIEW_BYTES)])
+            for uid, ret in fetched.iteritems():
+                # The response key carries the origin octet, e.g.
+                # 'BODY[1]<0>'.
+                for key, value in ret.iteritems():
+                    if str(key).startswith(response_key) and value:
+                        previews[uid] = decode_preview(value, parts[uid])
+                        break
+        return data, previews
+
+    def _fetch_sequence_sets(self, uids, data):
+        """
+        Fetch `data` for `uids`, encoded as compact sequence sets, with as
+        many commands as needed to keep each command line short.
+
+        Returns
+        -------
+        dict
+            uid: fetch response, for the requested UIDs only; unsolicited
+            FETCH responses are dropped.
+
+        """
         uid_set = set(uids)
-        return {uid: Flags(ret['FLAGS'], None)
-                for uid, ret in data.items() if uid in uid_set}
+        responses = {}
+        for seqset in sequence_sets(uid_set):
+            responses.update(self.conn.fetch(seqset, data))
+        return {uid: ret for uid, ret in responses.iteritems()
+                if uid in uid_set}
+
+    def sizes(self, uids):
+        """
+        RFC822.SIZE for the given UIDs.
+
+        Returns
+        -------
+        dict
+            Mapping of `uid` (long) : `size` (int). UIDs which have been
+            expunged in the meantime are omitted.
+
+        """
+        data = self._fetch_sequence_sets(uids, ['RFC822.SIZE'])
+        return {uid: ret['RFC822.SIZE'] for uid, ret in data.iteritems()
+                if 'RFC822.SIZE' in ret}
+
+    def message_ids(self, uids):
+        """
+        Message-ID header and RFC822.SIZE for the given UIDs, which together
+        identify a message across UIDVALIDITY changes.
+
+        Returns
+        -------
+        dict
+            Mapping of `uid` (long) : (`message_id_header`, `size`). Messages
+            without a Message-ID header and UIDs which have been expunged in
+            the meantime are omitted.
+
+        """
+        message_ids = {}
+        parser = HeaderParser()
+        data = self._fetch_sequence_sets(uids, [
+            'BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]', 'RFC822.SIZE'])
+        for uid, ret in data.iteritems():
+            if 'RFC822.SIZE' not in ret:
+                continue
+            # Servers differ in how they echo back the section, so don't
+            # rely on the exact response key.
+            headers = next((value for key, value in ret.iteritems()
+                            if str(key).upper().startswith(
+                                'BODY[HEADER.FIELDS')), None)
+            message_id = parser.parsestr(headers or '').get('Message-Id')
+            if message_id:
+                # Unfold; Message-IDs can't contain whitespace.
+                message_ids[uid] = (''.join(message_id.split()),
+                                    ret['RFC822.SIZE'])
+        return message_ids
+
+    def flags(self, uids):
+        data = self._fetch_sequence_sets(uids, ['FLAGS'])
+        return {uid: Flags(ret['FLAGS'], None) for uid, ret in data.items()}
 
     def delete_uids(self, uids):
-        uids = [str(u) for u in uids]
-        self.conn.delete_messages(uids, silent=True)
+        for seqset in sequence_sets(uids):
+            self.conn.delete_messages(seqset, silent=True)
         self.conn.expunge()
 
     def set_starred(self, uids, starred):
@@ -752,17 +1054,8 @@ class CrispinClient(object):
                                 date)
 
     def fetch_headers(self, uids):
-        """
-        Fetch headers for the given uids. Chunked because certain providers
-        fail with 'Command line too large' if you feed them too many uids at
-        once.
-
-        """
-        headers = {}
-        for uid_chunk in chunk(uids, 100):
-            headers.update(self.conn.fetch(
-                uid_chunk, ['BODY.PEEK[HEADER]']))
-        return headers
+        """Fetch headers for the given uids."""
+        return self._fetch_sequence_sets(uids, ['BODY.PEEK[HEADER]'])
 
     def find_by_header(self, header_name, header_value):
         """Find all uids in the selected folder with the given header value."""
@@ -854,13 +1147,26 @@ class CrispinClient(object):
         context."""
         self.conn.idle()
         try:
-            r = self.conn.idle_check(timeout)
+            # With compression, responses which arrived together with the
+            # server's continuation may already be decompressed, where
+            # idle_check()'s select() can't see them.
+            r = self._buffered_responses()
+            r.extend(self.conn.idle_check(0 if r else timeout))
         except:
             self.conn.idle_done()
             raise
-        self.conn.idle_done()
+        _, done_responses = self.conn.idle_done()
+        r.extend(done_responses)
         return r
 
+    def _buffered_responses(self):
+        responses = []
+        while (self.compression is not None and
+                self.compression.has_buffered_line()):
+            line = self.conn._imap._get_line()
+            responses.append(_parse_untagged_response(line))
+        return responses
+
     def condstore_changed_flags(self, modseq):
         data = self.conn.fetch('1:*', ['FLAGS'],
                                modifiers=['CHANGEDSINCE {}'.format(modseq)])
@@ -868,10 +1174,226 @@ class CrispinClient(object):
                            if 'MODSEQ' in ret else None)
                 for uid, ret in data.items()}
 
+    def qresync_changed_flags(self, modseq):
+        """
+        Like condstore_changed_flags(), but also asks the server for the UIDs
+        which have been expunged since `modseq`, using the VANISHED UID FETCH
+        modifier. Requires QRESYNC to be enabled on the connection.
+
+        Returns
+        -------
+        tuple
+            (dict of `uid` : Flags, list of vanished UID ranges as returned
+            by parse_vanished())
+
+        """
+        assert self.qresync_enabled, 'QRESYNC must be enabled first'
+        untagged_responses = self.conn._imap.untagged_responses
+        # Discard stale unsolicited VANISHED responses; the ones we care about
+        # are returned by the FETCH below.
+        untagged_responses.pop('VANISHED', None)
+        data = self.conn.fetch('1:*', ['FLAGS'],
+                               modifiers=['CHANGEDSINCE {}'.format(modseq),
+                                          'VANISHED'])
+        vanished = parse_vanished(untagged_responses.pop('VANISHED', []))
+        changed_flags = {uid: Flags(ret['FLAGS'], ret['MODSEQ'][0]
+                                    if 'MODSEQ' in ret else None)
+                         for uid, ret in data.items() if 'FLAGS' in ret}
+        return changed_flags, vanished
+
+
+def parse_vanished(responses):
+    """
+    Parse the data of untagged VANISHED responses (RFC 7162, section 3.2.10),
+    e.g. ['(EARLIER) 41,43:116,118'], into UID ranges.
+
+    Servers may report ranges covering UIDs which never existed in the
+    folder, so we don't expand them; intersect them with the UIDs we have
+    instead (see UidIndex.in_ranges()).
+
+    Returns
+    -------
+    list
+        Sorted, non-overlapping (start, end) ranges, both ends inclusive.
+
+    """
+    ranges = []
+    for response in responses:
+        if response is None:
+            continue
+        if response.upper().startswith('(EARLIER)'):
+            response = response[len('(EARLIER)'):]
+        for item in response.strip().split(','):
+            if not item:
+                continue
+            if ':' in item:
+                start, end = sorted(long(i) for i in item.split(':'))
+            else:
+                start = end = long(item)
+            ranges.append((start, end))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def sequence_sets(uids, max_length=SEQUENCE_SET_MAX_LENGTH):
+    """
+    Encode `uids` as compact IMAP sequence sets, collapsing runs of
+    consecutive UIDs into ranges, e.g. [1, 2, 3, 5, 7, 8] -> '1:3,5,7:8'.
+
+    Yields
+    ------
+    str
+        Sequence sets of at most `max_length` characters (unless a single
+        range is longer), covering all of `uids` in ascending order.
+
+    """
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    items = []
+    length = 0
+    for start, end in ranges:
+        item = str(start) if start == end else '{}:{}'.format(start, end)
+        if items and length + len(item) + 1 > max_length:
+            yield ','.join(items)
+            items = []
+            length = 0
+        length += len(item) + (1 if items else 0)
+        items.append(item)
+    if items:
+        yield ','.join(items)
+
+
+def or_criteria(key, values):
+    """
+    Build SEARCH criteria matching any of `values` for `key`, e.g.
+    ['OR', 'OR', 'X-GM-THRID', 1, 'X-GM-THRID', 2, 'X-GM-THRID', 3].
+
+    """
+    criteria = ['OR'] * (len(values) - 1)
+    for value in values:
+        criteria.extend([key, value])
+    return criteria
+
+
+def preview_part(bodystructure, section=None):
+    """
+    Find the first text/plain or text/html part in a BODYSTRUCTURE response,
+    depth-first, not descending into attached messages.
+
+    Returns
+    -------
+    PreviewPart or None
+
+    """
+    if not bodystructure:
+        return None
+    if isinstance(bodystructure[0], list):
+        children = bodystructure[0]
+    else:
+        # Multipart structures which haven't been unpacked by imapclient
+        # start with the child parts themselves.
+        children = list(itertools.takewhile(
+            lambda p: isinstance(p, tuple), bodystructure))
+    if children:
+        for i, child in enumerate(children, 1):
+            child_section = '{}.{}'.format(section, i) if section else str(i)
+            part = preview_part(child, child_section)
+            if part is not None:
+                return part
+        return None
+
+    if len(bodystructure) < 6:
+        return None
+    content_type, subtype, params, _, _, encoding = bodystructure[:6]
+    subtype = str(subtype).lower()
+    if str(content_type).lower() != 'text' or \
+            subtype not in ('plain', 'html'):
+        return None
+    params = params or ()
+    charset = None
+    for name, value in zip(params[::2], params[1::2]):
+        if str(name).lower() == 'charset':
+            charset = str(value)
+    return PreviewPart(section=section or '1', subtype=subtype,
+                       encoding=str(encoding or '7bit').lower(),
+                       charset=charset)
+
+
+def decode_preview(data, part):
+    """
+    Decode the (possibly truncated) start of MIME part `part` into text.
+    Undecodable bytes are replaced rather than raising.
+
+    """
+    if part.encoding == 'base64':
+        data = re.sub(r'[^A-Za-z0-9+/]', '', data)
+        data = data[:len(data) - len(data) % 4]
+        try:
+            data = base64.b64decode(data)
+        except (TypeError, binascii.Error):
+            return u''
+    elif part.encoding == 'quoted-printable':
+        data = quopri.decodestring(data)
+    try:
+        text = data.decode(part.charset or 'utf-8', 'replace')
+    except LookupError:
+        text = data.decode('utf-8', 'replace')
+    if part.subtype == 'html':
+        text = strip_tags(text)
+    return text
+
+
+def parse_notify_status(responses):
+    """
+    Return the names of the folders which have untagged STATUS responses
+    among `responses` (as returned by CrispinClient.idle()). With NOTIFY
+    active, these signal changes in folders other than the selected one.
+
+    """
+    folder_names = set()
+    for response in responses:
+        if (isinstance(response, tuple) and len(response) >= 2 and
+                str(response[0]).upper() == 'STATUS'):
+            folder_names.add(imapclient.imap_utf7.decode(str(response[1])))
+    return folder_names
+
+
+def selected_folder_changed(responses):
+    """
+    Return whether `responses` (as returned by CrispinClient.idle()) report
+    changes to the selected folder: EXISTS, EXPUNGE, FETCH or VANISHED
+    responses, as opposed to e.g. the server's OK keepalives.
+
+    """
+    for response in responses:
+        if not isinstance(response, tuple) or not response:
+            continue
+        if str(response[0]).upper() == 'VANISHED':
+            return True
+        if (len(response) >= 2 and
+                str(response[1]).upper() in ('EXISTS', 'EXPUNGE', 'FETCH')):
+            return True
+    return False
+
 
 class GmailCrispinClient(CrispinClient):
     PROVIDER = 'gmail'
 
+    def qresync_supported(self):
+        # Flags refreshes on Gmail need X-GM-LABELS too, which the generic
+        # QRESYNC path doesn't fetch. (Gmail doesn't advertise QRESYNC at the
+        # time of writing anyway.)
+        return False
+
     def sync_folders(self):
         """
         Gmail-specific list of folders to sync.
@@ -913,12 +1435,11 @@ class GmailCrispinClient(CrispinClient):
             Mapping of `uid` : GmailFlags.
 
         """
-        data = self.conn.fetch(uids, ['FLAGS', 'X-GM-LABELS'])
-        uid_set = set(uids)
+        data = self._fetch_sequence_sets(uids, ['FLAGS', 'X-GM-LABELS'])
         return {uid: GmailFlags(ret['FLAGS'],
                                 self._decode_labels(ret['X-GM-LABELS']),
                                 ret['MODSEQ'][0] if 'MODSEQ' in ret else None)
-                for uid, ret in data.items() if uid in uid_set}
+                for uid, ret in data.items()}
 
     def condstore_changed_flags(self, modseq):
         data = self.conn.fetch('1:*', ['FLAGS', 'X-GM-LABELS'],
@@ -950,10 +1471,8 @@ class GmailCrispinClient(CrispinClient):
             Mapping of `uid` (long) : `g_msgid` (long)
 
         """
-        data = self.conn.fetch(uids, ['X-GM-MSGID'])
-        uid_set = set(uids)
-        return {uid: ret['X-GM-MSGID']
-                for uid, ret in data.items() if uid in uid_set}
+        data = self._fetch_sequence_sets(uids, ['X-GM-MSGID'])
+        return {uid: ret['X-GM-MSGID'] for uid, ret in data.items()}
 
     def g_msgid_to_uids(self, g_msgid):
         """
@@ -1032,16 +1551,12 @@ class GmailCrispinClient(CrispinClient):
         return RawFolder(display_name=display_name, role=role)
 
     def uids(self, uids):
-        raw_messages = self.conn.fetch(uids, ['BODY.PEEK[]', 'INTERNALDATE',
-                                              'FLAGS', 'X-GM-THRID',
-                                              'X-GM-MSGID', 'X-GM-LABELS'])
+        raw_messages = self._fetch_sequence_sets(
+            uids, ['BODY.PEEK[]', 'INTERNALDATE', 'FLAGS', 'X-GM-THRID',
+                   'X-GM-MSGID', 'X-GM-LABELS'])
 
         messages = []
-        uid_set = set(uids)
         for uid in sorted(raw_messages.iterkeys(), key=long):
-            # Skip handling unsolicited FETCH responses
-            if uid not in uid_set:
-                continue
             msg = raw_messages[uid]
             messages.append(
                 RawMessage(uid=long(uid),
@@ -1053,6 +1568,17 @@ class GmailCrispinClient(CrispinClient):
                            g_labels=self._decode_labels(msg['X-GM-LABELS'])))
         return messages
 
+    def uid_headers(self, uids):
+        data, previews = self._fetch_headers_and_previews(
+            uids, ['X-GM-THRID', 'X-GM-MSGID', 'X-GM-LABELS'])
+        return [RawHeaders(uid=long(uid), internaldate=msg['INTERNALDATE'],
+                           flags=msg['FLAGS'], body=msg['BODY[HEADER]'],
+                           size=msg['RFC822.SIZE'], preview=previews.get(uid),
+                           g_thrid=long(msg['X-GM-THRID']),
+                           g_msgid=long(msg['X-GM-MSGID']),
+                           g_labels=self._decode_labels(msg['X-GM-LABELS']))
+                for uid, msg in sorted(data.iteritems())]
+
     def g_metadata(self, uids):
         """
         Download Gmail MSGIDs, THRIDs, and message sizes for the given uids.
@@ -1067,15 +1593,11 @@ class GmailCrispinClient(CrispinClient):
         dict
             uid: GMetadata(msgid, thrid, size)
         """
-        # Super long sets of uids may fail with BAD ['Could not parse command']
-        # In that case, just fetch metadata for /all/ uids.
-        seqset = uids if len(uids) < 1e6 else '1:*'
-        data = self.conn.fetch(seqset, ['X-GM-MSGID', 'X-GM-THRID',
-                                        'RFC822.SIZE'])
-        uid_set = set(uids)
+        data = self._fetch_sequence_sets(uids, ['X-GM-MSGID', 'X-GM-THRID',
+                                                'RFC822.SIZE'])
         return {uid: GMetadata(ret['X-GM-MSGID'], ret['X-GM-THRID'],
                                ret['RFC822.SIZE'])
-                for uid, ret in data.items() if uid in uid_set}
+                for uid, ret in data.items()}
 
     def expand_thread(self, g_thrid):
         """
@@ -1091,6 +1613,25 @@ class GmailCrispinClient(CrispinClient):
         # UIDs ascend over time; return in order most-recent first
         return sorted(uids, reverse=True)
 
+    def expand_threads(self, g_thrids):
+        """
+        Like expand_thread(), but for many threads at once: find the UIDs of
+        all messages in the selected folder on any of the given threads, with
+        one SEARCH per THREAD_SEARCH_CHUNK_SIZE threads, and fetch their
+        metadata.
+
+        Returns
+        -------
+        dict
+            uid: GMetadata(msgid, thrid, size)
+        """
+        g_thrids = sorted(set(g_thrids))
+        uids = set()
+        for thrid_chunk in chunk(g_thrids, THREAD_SEARCH_CHUNK_SIZE):
+            uids.update(self.search_uids(
+                or_criteria('X-GM-THRID', thrid_chunk)))
+        return self.g_metadata(uids)
+
     def find_by_header(self, header_name, header_value):
         return self.conn.search(['HEADER', header_name, header_value])
 
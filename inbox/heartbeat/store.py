@@ -1,3 +1,4 @@
+import json
 import time
 import itertools
 from inbox.util.itert import chunk
@@ -68,12 +69,20 @@ class HeartbeatStatusProxy(object):
         self.folder_id = folder_id
         self.device_id = device_id
         self.store = HeartbeatStore.store()
+        # Metadata published so far (e.g. state, poll_interval). Each publish
+        # call with keyword arguments updates it and stores the result.
+        self.metadata = {}
 
     @safe_failure
     def publish(self, **kwargs):
         try:
             self.heartbeat_at = time.time()
-            self.store.publish(self.key, self.heartbeat_at)
+            metadata = None
+            if kwargs:
+                self.metadata.update(kwargs)
+                metadata = dict(self.metadata, heartbeat_at=self.heartbeat_at)
+            self.store.publish(self.key, self.heartbeat_at, self.device_id,
+                               metadata)
         except Exception:
             log = get_logger()
             log.error('Error while writing the heartbeat status',
@@ -105,9 +114,18 @@ class HeartbeatStore(object):
         return cls._instances.get(host)
 
     @safe_failure
-    def publish(self, key, timestamp):
+    def publish(self, key, timestamp, device_id=0, metadata=None):
         # Update indexes
         self.update_folder_index(key, float(timestamp))
+        if metadata:
+            client = heartbeat_config.get_redis_client(key.account_id)
+            client.hset(key, device_id, json.dumps(metadata))
+
+    def get_folder_metadata(self, key):
+        # Returns the metadata last published for the folder, by device.
+        client = heartbeat_config.get_redis_client(key.account_id)
+        return {int(device_id): json.loads(value)
+                for device_id, value in client.hgetall(key).iteritems()}
 
     def remove(self, key, device_id=None):
         # Remove a key from the store, or device entry from a key.
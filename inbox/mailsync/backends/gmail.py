@@ -20,21 +20,23 @@ user always gets the full thread when they look at mail.
 
 """
 from __future__ import division
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
 import gevent
-from sqlalchemy.orm import joinedload, load_only
+from sqlalchemy.orm import load_only
 
 from inbox.util.itert import chunk
+from inbox.crispin import RawMessage
 from inbox.util.debug import bind_context
 
 from nylas.logging import get_logger
 from gevent.lock import Semaphore
-from inbox.models import Message, Folder, Namespace, Account, Label, Category
+from inbox.models import Message, Folder, Account, Label, Category
 from inbox.models.category import EPOCH
 from inbox.models.backends.imap import ImapFolderInfo, ImapUid, ImapThread
 from inbox.models.session import session_scope
-from inbox.mailsync.backends.imap.generic import FolderSyncEngine
+from inbox.mailsync.backends.imap.generic import (
+    FolderSyncEngine, use_header_first_sync, HEADER_FIRST_DOWNLOAD_COUNT)
 from inbox.mailsync.backends.imap.monitor import ImapSyncMonitor
 from inbox.mailsync.backends.imap import common
 from inbox.mailsync.gc import LabelRenameHandler
@@ -48,6 +50,15 @@ SYNC_MONITOR_CLS = 'GmailSyncMonitor'
 MAX_DOWNLOAD_BYTES = 2 ** 20
 # USE MAX_DOWNLOAD_COUNT = 1 instead of 30 until N1 launch herding dies.
 MAX_DOWNLOAD_COUNT = 1
+# Maximum number of UIDs of already-synced messages we fetch flags and labels
+# for at once, instead of downloading them.
+KNOWN_UID_BATCH_SIZE = 100
+# Number of g_msgids looked up per query by g_msgids(). See
+# inbox/test/benchmarks/bench_g_msgids.py.
+G_MSGID_LOOKUP_CHUNK_SIZE = 1000
+# Number of threads expanded at once during initial sync. See
+# expand_uids_to_download().
+THREAD_EXPANSION_BATCH_SIZE = 100
 
 
 class GmailSyncMonitor(ImapSyncMonitor):
@@ -207,7 +218,6 @@ class GmailFolderSyncEngine(FolderSyncEngine):
 
     def __init__(self, *args, **kwargs):
         FolderSyncEngine.__init__(self, *args, **kwargs)
-        self.saved_uids = set()
 
     def is_all_mail(self, crispin_client):
         if not hasattr(self, '_is_all_mail'):
@@ -224,14 +234,14 @@ class GmailFolderSyncEngine(FolderSyncEngine):
         change_poller = None
         try:
             remote_uids = sorted(crispin_client.all_uids(), key=int)
+            self.header_first = use_header_first_sync(len(remote_uids))
+            if self.header_first:
+                log.info('Syncing folder header-first',
+                         remote_uid_count=len(remote_uids))
             with self.syncmanager_lock:
-                with session_scope(self.namespace_id) as db_session:
-                    local_uids = common.local_uids(self.account_id, db_session,
-                                                   self.folder_id)
-                common.remove_deleted_uids(
-                    self.account_id, self.folder_id,
-                    set(local_uids) - set(remote_uids))
-                unknown_uids = set(remote_uids) - local_uids
+                uid_index = self.get_uid_index()
+                self.remove_deleted_uids(uid_index.difference(remote_uids))
+                unknown_uids = set(uid_index.missing(remote_uids))
                 with session_scope(self.namespace_id) as db_session:
                     self.update_uid_counts(
                         db_session, remote_uid_count=len(remote_uids),
@@ -267,55 +277,59 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 # They may also have been preemptively downloaded by thread
                 # expansion. We can omit such UIDs.
                 uids = [u for u in uids if u in g_metadata and u not in
-                        self.saved_uids]
-                self.batch_download_uids(crispin_client, uids, g_metadata)
+                        self.get_uid_index()]
+                if self.header_first:
+                    self.batch_download_uids(
+                        crispin_client, uids, g_metadata,
+                        max_download_count=HEADER_FIRST_DOWNLOAD_COUNT)
+                else:
+                    self.batch_download_uids(crispin_client, uids,
+                                             g_metadata)
         finally:
             if change_poller is not None:
                 # schedule change_poller to die
                 gevent.kill(change_poller)
 
     def resync_uids_impl(self):
+        with session_scope(self.namespace_id) as db_session:
+            saved_uidvalidity, = db_session.query(
+                ImapFolderInfo.uidvalidity).filter_by(
+                    account_id=self.account_id,
+                    folder_id=self.folder_id).one()
+        with self.conn_pool.get(self.conn_priority) as crispin_client:
+            crispin_client.select_folder(self.folder_name,
+                                         lambda *args: True)
+            uidvalidity = crispin_client.selected_uidvalidity
+            if uidvalidity <= saved_uidvalidity:
+                # if the remote UIDVALIDITY is less than or equal to -
+                # from my (siro) understanding it should not be less than -
+                # the local UIDVALIDITY log a debug message and exit right
+                # away
+                log.debug('UIDVALIDITY unchanged')
+                return
+            msg_uids = crispin_client.all_uids()
+            mapping = {g_msgid: msg_uid for msg_uid, g_msgid in
+                       crispin_client.g_msgids(msg_uids).iteritems()}
+        # Rewrite the saved UIDs in bounded transactions. The saved
+        # UIDVALIDITY is only updated once they've all been remapped, so if
+        # we're interrupted we'll end up back here and resume.
+        common.remap_uids(self.account_id, self.folder_id, [Message.g_msgid],
+                          mapping)
         with session_scope(self.namespace_id) as db_session:
             imap_folder_info_entry = db_session.query(ImapFolderInfo)\
                 .options(load_only('uidvalidity', 'highestmodseq'))\
                 .filter_by(account_id=self.account_id,
                            folder_id=self.folder_id)\
                 .one()
-            with self.conn_pool.get() as crispin_client:
-                crispin_client.select_folder(self.folder_name,
-                                             lambda *args: True)
-                uidvalidity = crispin_client.selected_uidvalidity
-                if uidvalidity <= imap_folder_info_entry.uidvalidity:
-                    # if the remote UIDVALIDITY is less than or equal to -
-                    # from my (siro) understanding it should not be less than -
-                    # the local UIDVALIDITY log a debug message and exit right
-                    # away
-                    log.debug('UIDVALIDITY unchanged')
-                    return
-                msg_uids = crispin_client.all_uids()
-                mapping = {g_msgid: msg_uid for msg_uid, g_msgid in
-                           crispin_client.g_msgids(msg_uids).iteritems()}
-            imap_uid_entries = db_session.query(ImapUid)\
-                .options(load_only('msg_uid'),
-                         joinedload('message').load_only('g_msgid'))\
-                .filter_by(account_id=self.account_id,
-                           folder_id=self.folder_id)
-
-            chunk_size = 1000
-            for entry in imap_uid_entries.yield_per(chunk_size):
-                if entry.message.g_msgid in mapping:
-                    log.debug('X-GM-MSGID {} from UID {} to UID {}'.format(
-                        entry.message.g_msgid,
-                        entry.msg_uid,
-                        mapping[entry.message.g_msgid]))
-                    entry.msg_uid = mapping[entry.message.g_msgid]
-                else:
-                    db_session.delete(entry)
             log.debug('UIDVALIDITY from {} to {}'.format(
                 imap_folder_info_entry.uidvalidity, uidvalidity))
             imap_folder_info_entry.uidvalidity = uidvalidity
             imap_folder_info_entry.highestmodseq = None
             db_session.commit()
+        # Saved UIDs and folder info were rewritten in place; reload them on
+        # next use.
+        self._uid_index = None
+        self.folder_info.reset()
 
     def __deduplicate_message_object_creation(self, db_session, raw_messages,
                                               account):
@@ -324,11 +338,9 @@ class GmailFolderSyncEngine(FolderSyncEngine):
         Message object for this raw message, we don't create a new one. But we
         do create a new ImapUid, associate it to the message, and update flags
         and categories accordingly.
-        Note: we could do this prior to downloading the actual message
-        body, but that's really more complicated than it's worth. This
-        operation is not super common unless you're regularly moving lots
-        of messages to trash or spam, and even then the overhead of just
-        downloading the body is generally not that high.
+        Note: during initial sync, batch_download_uids() already does this
+        before downloading message bodies, based on the g_metadata it has.
+        Here we catch the remaining cases, e.g. new mail found when polling.
 
         """
         new_g_msgids = {msg.g_msgid for msg in raw_messages}
@@ -389,7 +401,7 @@ class GmailFolderSyncEngine(FolderSyncEngine):
 
     def download_and_commit_uids(self, crispin_client, uids):
         start = datetime.utcnow()
-        raw_messages = crispin_client.uids(uids)
+        raw_messages = self.fetch_uids(crispin_client, uids)
         if not raw_messages:
             return
         new_uids = set()
@@ -397,18 +409,25 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             with session_scope(self.namespace_id) as db_session:
                 account = Account.get(self.account_id, db_session)
                 folder = Folder.get(self.folder_id, db_session)
-                raw_messages = self.__deduplicate_message_object_creation(
-                    db_session, raw_messages, account)
-                if not raw_messages:
+                brand_new_messages = \
+                    self.__deduplicate_message_object_creation(
+                        db_session, raw_messages, account)
+                # UIDs for previously synced messages were saved by
+                # deduplication.
+                self.add_saved_uids(
+                    {msg.uid for msg in raw_messages} -
+                    {msg.uid for msg in brand_new_messages})
+                if not brand_new_messages:
                     return 0
 
-                for msg in raw_messages:
+                for msg in brand_new_messages:
                     uid = self.create_message(db_session, account, folder,
                                               msg)
                     if uid is not None:
                         db_session.add(uid)
                         db_session.commit()
-                        new_uids.add(uid)
+                        new_uids.add(uid.msg_uid)
+                        self.add_saved_uids([uid.msg_uid])
 
         log.debug('Committed new UIDs',
                   new_committed_message_count=len(new_uids))
@@ -421,8 +440,6 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             self._report_first_message()
             self.is_first_message = False
 
-        self.saved_uids.update(new_uids)
-
     def expand_uids_to_download(self, crispin_client, uids, metadata):
         # During Gmail initial sync, we expand threads: given a UID to
         # download, we want to also download other UIDs on the same thread, so
@@ -437,37 +454,72 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             else:
                 thrids[g_thrid] = [uid]
 
-        for g_thrid, uids in thrids.items():
-            g_msgid = metadata[uids[0]].g_msgid
+        # Expand a batch of threads at a time, so that we don't hold up the
+        # first downloads on expanding every thread in the chunk, and don't
+        # need a round trip per thread either.
+        for thread_batch in chunk(thrids.items(), THREAD_EXPANSION_BATCH_SIZE):
             # Because `uids` is ordered newest-to-oldest here, uids[0] is the
             # last UID on the thread. If g_thrid is equal to its g_msgid, that
             # means it's also the first UID on the thread. In that case, we can
             # skip thread expansion for greater sync throughput.
-            if g_thrid != g_msgid:
-                uids = set(uids).union(crispin_client.expand_thread(g_thrid))
-                metadata.update(crispin_client.g_metadata(uids))
-            for uid in sorted(uids, reverse=True):
-                yield uid
+            to_expand = {g_thrid for g_thrid, uids in thread_batch
+                         if g_thrid != metadata[uids[0]].g_msgid}
+            expanded = defaultdict(set)
+            if to_expand:
+                thread_metadata = crispin_client.expand_threads(to_expand)
+                metadata.update(thread_metadata)
+                for uid, uid_metadata in thread_metadata.iteritems():
+                    if uid_metadata.g_thrid in to_expand:
+                        expanded[uid_metadata.g_thrid].add(uid)
+            for g_thrid, uids in thread_batch:
+                for uid in sorted(expanded[g_thrid].union(uids),
+                                  reverse=True):
+                    yield uid
 
     def batch_download_uids(self, crispin_client, uids, metadata,
                             max_download_bytes=MAX_DOWNLOAD_BYTES,
                             max_download_count=MAX_DOWNLOAD_COUNT):
         expanded_pending_uids = self.expand_uids_to_download(
             crispin_client, uids, metadata)
+        # g_msgids we've checked for an existing Message, and those we found
+        # one for. UIDs of the latter don't need their bodies downloaded.
+        checked_g_msgids = set()
+        saved_g_msgids = set()
         count = 0
         while True:
             dl_size = 0
             batch = []
+            known_batch = []
             while (dl_size < max_download_bytes and
-                   len(batch) < max_download_count):
+                   len(batch) < max_download_count and
+                   len(known_batch) < KNOWN_UID_BATCH_SIZE):
                 try:
                     uid = expanded_pending_uids.next()
                 except StopIteration:
                     break
+                g_msgid = metadata[uid].g_msgid if uid in metadata else None
+                if g_msgid is not None and g_msgid not in checked_g_msgids:
+                    # Thread expansion adds to `metadata` as we go, so check
+                    # everything we haven't seen yet in one query.
+                    unchecked = {m.g_msgid for m in metadata.itervalues()} - \
+                        checked_g_msgids
+                    with session_scope(self.namespace_id) as db_session:
+                        saved_g_msgids.update(g_msgids(
+                            self.namespace_id, db_session, in_=unchecked))
+                    checked_g_msgids.update(unchecked)
+                if g_msgid in saved_g_msgids:
+                    known_batch.append(uid)
+                    continue
                 batch.append(uid)
-                if uid in metadata:
+                # Header-first downloads are batched by count only.
+                if uid in metadata and not self.header_first:
                     dl_size += metadata[uid].size
+            if known_batch:
+                self.save_uids_for_known_messages(crispin_client,
+                                                  known_batch, metadata)
             if not batch:
+                if known_batch:
+                    continue
                 return
             self.download_and_commit_uids(crispin_client, batch)
             self.heartbeat_status.publish()
@@ -480,6 +532,37 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 # not the #(messages).
                 gevent.sleep(THROTTLE_WAIT)
 
+    def save_uids_for_known_messages(self, crispin_client, uids, metadata):
+        """
+        Save ImapUids for `uids`, whose g_msgids (from `metadata`) belong to
+        messages we've already synced, e.g. from another folder. We only
+        fetch their flags and labels, not their bodies. UIDs whose message
+        has disappeared in the meantime are downloaded as usual.
+
+        """
+        flags = crispin_client.flags(uids)
+        raw_messages = [RawMessage(uid=uid, internaldate=None,
+                                   flags=flags[uid].flags, body=None,
+                                   g_thrid=metadata[uid].g_thrid,
+                                   g_msgid=metadata[uid].g_msgid,
+                                   g_labels=flags[uid].labels)
+                        for uid in uids if uid in flags]
+        if not raw_messages:
+            return
+        with self.syncmanager_lock:
+            with session_scope(self.namespace_id) as db_session:
+                account = Account.get(self.account_id, db_session)
+                missing_messages = \
+                    self.__deduplicate_message_object_creation(
+                        db_session, raw_messages, account)
+            self.add_saved_uids({msg.uid for msg in raw_messages} -
+                                {msg.uid for msg in missing_messages})
+        log.debug('Saved UIDs for known messages without downloading',
+                  count=len(raw_messages) - len(missing_messages))
+        if missing_messages:
+            self.download_and_commit_uids(
+                crispin_client, [msg.uid for msg in missing_messages])
+
     @property
     def throttled(self):
         with session_scope(self.namespace_id) as db_session:
@@ -489,22 +572,24 @@ class GmailFolderSyncEngine(FolderSyncEngine):
         return throttled
 
 
-def g_msgids(namespace_id, session, in_):
+def g_msgids(namespace_id, session, in_,
+             chunk_size=G_MSGID_LOOKUP_CHUNK_SIZE):
+    """
+    Return the subset of the g_msgids `in_` which we have a Message for in
+    the namespace.
+
+    Large sets are looked up chunk_size values at a time, so that each query
+    stays an index lookup on Message.g_msgid and we never load the whole
+    namespace's g_msgids (millions of rows for big accounts) into memory.
+
+    """
     if not in_:
-        return []
-    # Easiest way to account-filter Messages is to namespace-filter from
-    # the associated thread. (Messages may not necessarily have associated
-    # ImapUids.)
-    in_ = {long(i) for i in in_}  # in case they are strings
-    if len(in_) > 1000:
-        # If in_ is really large, passing all the values to MySQL can get
-        # deadly slow. (Approximate threshold empirically determined)
-        query = session.query(Message.g_msgid).join(Namespace). \
-            filter(Message.namespace_id == namespace_id).all()
-        return sorted(g_msgid for g_msgid, in query if g_msgid in in_)
-    # But in the normal case that in_ only has a few elements, it's way better
-    # to not fetch a bunch of values from MySQL only to return a few of them.
-    query = session.query(Message.g_msgid). \
-        filter(Message.namespace_id == namespace_id,
-               Message.g_msgid.in_(in_)).all()
-    return {g_msgid for g_msgid, in query}
+        return set()
+    in_ = sorted({long(i) for i in in_})  # in case they are strings
+    found = set()
+    for g_msgid_chunk in chunk(in_, chunk_size):
+        query = session.query(Message.g_msgid). \
+            filter(Message.namespace_id == namespace_id,
+                   Message.g_msgid.in_(g_msgid_chunk))
+        found.update(g_msgid for g_msgid, in query)
+    return found
@@ -13,20 +13,32 @@ accounts.
 """
 from datetime import datetime
 
-from sqlalchemy import bindparam, desc
+from sqlalchemy import bindparam, case, desc
+from sqlalchemy.orm import joinedload, subqueryload
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql.expression import func
 
+from inbox.config import config
 from inbox.contacts.process_mail import update_contacts_from_message
+from inbox.crispin import RawHeaders
 from inbox.models import Account, Message, Folder, ActionLog
-from inbox.models.backends.imap import ImapUid, ImapFolderInfo
+from inbox.models.backends.imap import ImapUid, ImapFolderInfo, LabelItem
 from inbox.models.session import session_scope
 from inbox.models.util import reconcile_message
 from inbox.sqlalchemy_ext.util import bakery
+from inbox.util.itert import chunk
 from nylas.logging import get_logger
 
 log = get_logger()
 
+# Number of expunged UIDs processed per database transaction.
+REMOVE_DELETED_UIDS_CHUNK_SIZE = config.get('IMAP_EXPUNGE_CHUNK_SIZE', 100)
+# Number of flag/label changes applied per database transaction.
+UPDATE_METADATA_BATCH_SIZE = config.get('IMAP_METADATA_BATCH_SIZE', 200)
+# Number of saved UIDs rewritten per database transaction after a
+# UIDVALIDITY change.
+REMAP_UIDS_CHUNK_SIZE = config.get('IMAP_REMAP_UIDS_CHUNK_SIZE', 1000)
+
 
 def local_uids(account_id, session, folder_id, limit=None):
     q = bakery(lambda session: session.query(ImapUid.msg_uid))
@@ -42,6 +54,19 @@ def local_uids(account_id, session, folder_id, limit=None):
     return {u for u, in results}
 
 
+def iter_local_uids(account_id, session, folder_id, yield_per=10000):
+    """
+    Yield the UIDs we have saved for the folder in ascending order, streaming
+    them from the database instead of materializing the full result set.
+
+    """
+    q = session.query(ImapUid.msg_uid).filter(
+        ImapUid.account_id == account_id,
+        ImapUid.folder_id == folder_id).order_by(ImapUid.msg_uid)
+    for u, in q.yield_per(yield_per):
+        yield u
+
+
 def lastseenuid(account_id, session, folder_id):
     q = bakery(lambda session: session.query(func.max(ImapUid.msg_uid)))
     q += lambda q: q.filter(
@@ -76,7 +101,8 @@ def update_message_metadata(session, account, message, is_draft):
         _update_categories(session, message, categories)
 
 
-def update_metadata(account_id, folder_id, folder_role, new_flags, session):
+def update_metadata(account_id, folder_id, folder_role, new_flags, session,
+                    batch_size=UPDATE_METADATA_BATCH_SIZE):
     """
     Update flags and labels (the only metadata that can change).
 
@@ -84,66 +110,101 @@ def update_metadata(account_id, folder_id, folder_role, new_flags, session):
     to grab the lock in here in case the caller needs to put higher-level
     functionality in the lock.)
 
+    Changes are applied `batch_size` UIDs at a time, with a single commit per
+    batch. We first update the ImapUid rows, then recompute the metadata of
+    all changed messages with autoflush disabled, so that the batch gets
+    flushed once and each changed message and thread gets exactly one
+    revision.
+
     """
     if not new_flags:
         return
 
     account = Account.get(account_id, session)
     change_count = 0
-    for item in session.query(ImapUid).filter(
-            ImapUid.account_id == account_id,
-            ImapUid.msg_uid.in_(new_flags.keys()),
-            ImapUid.folder_id == folder_id):
-        flags = new_flags[item.msg_uid].flags
-        labels = getattr(new_flags[item.msg_uid], 'labels', None)
-
-        # TODO(emfree) refactor so this is only ever relevant for Gmail.
-        changed = item.update_flags(flags)
-        if labels is not None:
-            item.update_labels(labels)
-            changed = True
-
-        if changed:
-            change_count += 1
-            is_draft = item.is_draft and (folder_role == 'drafts' or
-                                          folder_role == 'all')
-            update_message_metadata(session, account, item.message, is_draft)
-            session.commit()
+    for uid_batch in chunk(sorted(new_flags), batch_size):
+        changed_items = []
+        for item in session.query(ImapUid).filter(
+                ImapUid.account_id == account_id,
+                ImapUid.msg_uid.in_(uid_batch),
+                ImapUid.folder_id == folder_id).options(
+                    joinedload(ImapUid.message).subqueryload(
+                        Message.imapuids)).all():
+            flags = new_flags[item.msg_uid].flags
+            labels = getattr(new_flags[item.msg_uid], 'labels', None)
+
+            # TODO(emfree) refactor so this is only ever relevant for Gmail.
+            changed = item.update_flags(flags)
+            if labels is not None:
+                item.update_labels(labels)
+                changed = True
+
+            if changed:
+                changed_items.append(item)
+
+        if not changed_items:
+            continue
+        change_count += len(changed_items)
+        # Flush the ImapUid changes (and any labels created along the way)
+        # before deriving message metadata from them.
+        session.flush()
+        with session.no_autoflush:
+            for item in changed_items:
+                is_draft = item.is_draft and (folder_role == 'drafts' or
+                                              folder_role == 'all')
+                update_message_metadata(session, account, item.message,
+                                        is_draft)
+        session.commit()
     log.info('Updated UID metadata', changed=change_count,
              out_of=len(new_flags))
 
 
-def remove_deleted_uids(account_id, folder_id, uids):
+def remove_deleted_uids(account_id, folder_id, uids,
+                        chunk_size=REMOVE_DELETED_UIDS_CHUNK_SIZE):
     """
     Make sure you're holding a db write lock on the account. (We don't try
     to grab the lock in here in case the caller needs to put higher-level
     functionality in the lock.)
 
+    UIDs are processed `chunk_size` at a time, with one database transaction
+    per chunk.
+
     """
     if not uids:
         return
     deleted_uid_count = 0
-    for uid in uids:
-        # We do this one-uid-at-a-time because issuing many deletes within a
-        # single database transaction is problematic. But loading many
-        # objects into a session and then frequently calling commit() is also
-        # bad, because expiring objects and checking for revisions is O(number
-        # of objects in session), resulting in quadratic runtimes.
-        # Performance could perhaps be additionally improved by choosing a
-        # sane balance, e.g., operating on 10 or 100 uids or something at once.
+    # Issuing many deletes within a single database transaction is
+    # problematic, but so is one transaction per UID when a whole folder gets
+    # emptied. Loading many objects into a session and then frequently calling
+    # commit() is also bad, because expiring objects and checking for
+    # revisions is O(number of objects in session). So we use a fresh session
+    # per chunk, and set-based statements for the ImapUid rows themselves.
+    for uid_chunk in chunk(sorted(uids), chunk_size):
         with session_scope(account_id) as db_session:
-            imapuid = db_session.query(ImapUid).filter(
+            rows = db_session.query(ImapUid.id, ImapUid.message_id).filter(
                 ImapUid.account_id == account_id,
                 ImapUid.folder_id == folder_id,
-                ImapUid.msg_uid == uid).first()
-            if imapuid is None:
+                ImapUid.msg_uid.in_(uid_chunk)).all()
+            if not rows:
                 continue
-            deleted_uid_count += 1
-            message = imapuid.message
-
-            db_session.delete(imapuid)
-
-            if message is not None:
+            deleted_uid_count += len(rows)
+            imapuid_ids = [imapuid_id for imapuid_id, _ in rows]
+            message_ids = {message_id for _, message_id in rows}
+
+            db_session.query(LabelItem).filter(
+                LabelItem.imapuid_id.in_(imapuid_ids)).delete(
+                    synchronize_session=False)
+            db_session.query(ImapUid).filter(
+                ImapUid.id.in_(imapuid_ids)).delete(synchronize_session=False)
+
+            # Load the affected messages (and their remaining imapuids) only
+            # after deleting the expunged ImapUid rows, so that
+            # `message.imapuids` reflects the new state.
+            messages = db_session.query(Message).filter(
+                Message.id.in_(message_ids)).options(
+                    subqueryload(Message.imapuids)).all()
+            account = Account.get(account_id, db_session)
+            for message in messages:
                 if not message.imapuids and message.is_draft:
                     # Synchronously delete drafts.
                     thread = message.thread
@@ -153,7 +214,6 @@ def remove_deleted_uids(account_id, folder_id, uids):
                     if thread is not None and not thread.messages:
                         db_session.delete(thread)
                 else:
-                    account = Account.get(account_id, db_session)
                     update_message_metadata(db_session, account, message,
                                             message.is_draft)
                     if not message.imapuids:
@@ -165,6 +225,95 @@ def remove_deleted_uids(account_id, folder_id, uids):
     log.info('Deleted expunged UIDs', count=deleted_uid_count)
 
 
+def remap_uids(account_id, folder_id, key_columns, new_uids,
+               chunk_size=REMAP_UIDS_CHUNK_SIZE):
+    """
+    Rewrite the saved UIDs of a folder whose UIDVALIDITY changed, instead of
+    dropping and redownloading all of its messages.
+
+    Parameters
+    ----------
+    key_columns: list
+        Message columns which identify a message across UIDVALIDITY changes,
+        e.g. [Message.g_msgid].
+    new_uids: dict
+        Mapping of key (the values of `key_columns`; a tuple if there are
+        several) to the message's new UID.
+
+    ImapUid rows are processed `chunk_size` at a time, each chunk in its own
+    transaction. Rows whose message isn't in `new_uids` are removed like
+    expunged UIDs.
+
+    To avoid transient unique constraint violations between old and new
+    UIDs, we first store each new UID negated, then flip the signs once all
+    rows are remapped. Only rows with a positive UID are remapped in the
+    first pass, and remapping is idempotent, so if we're interrupted we can
+    simply run again, with the same `new_uids`, to pick up where we left off.
+
+    """
+    with session_scope(account_id) as db_session:
+        # New UIDs handed out by an interrupted earlier run.
+        assigned = {-uid for uid, in db_session.query(ImapUid.msg_uid).filter(
+            ImapUid.account_id == account_id,
+            ImapUid.folder_id == folder_id,
+            ImapUid.msg_uid < 0)}
+
+    remapped_count = removed_count = 0
+    last_id = 0
+    while True:
+        with session_scope(account_id) as db_session:
+            rows = db_session.query(ImapUid.id, ImapUid.msg_uid,
+                                    *key_columns).join(Message).filter(
+                ImapUid.account_id == account_id,
+                ImapUid.folder_id == folder_id,
+                ImapUid.msg_uid > 0,
+                ImapUid.id > last_id).order_by(ImapUid.id). \
+                limit(chunk_size).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            negated_uids = {}
+            unmatched_uids = []
+            for row in rows:
+                key = row[2] if len(key_columns) == 1 else tuple(row[2:])
+                new_uid = new_uids.get(key)
+                # Several rows can map to the same new UID if the folder had
+                # duplicate messages; keep only the first.
+                if new_uid is None or new_uid in assigned:
+                    unmatched_uids.append(row[1])
+                else:
+                    assigned.add(new_uid)
+                    negated_uids[row[0]] = -new_uid
+            if negated_uids:
+                db_session.query(ImapUid).filter(
+                    ImapUid.id.in_(negated_uids)).update(
+                        {ImapUid.msg_uid: case(negated_uids,
+                                               value=ImapUid.id)},
+                        synchronize_session=False)
+                db_session.commit()
+        remapped_count += len(negated_uids)
+        removed_count += len(unmatched_uids)
+        remove_deleted_uids(account_id, folder_id, unmatched_uids)
+        log.info('Remapping UIDs', remapped_count=remapped_count,
+                 removed_count=removed_count)
+
+    while True:
+        with session_scope(account_id) as db_session:
+            imapuid_ids = [imapuid_id for imapuid_id, in db_session.query(
+                ImapUid.id).filter(ImapUid.account_id == account_id,
+                                   ImapUid.folder_id == folder_id,
+                                   ImapUid.msg_uid < 0).limit(chunk_size)]
+            if not imapuid_ids:
+                break
+            db_session.query(ImapUid).filter(
+                ImapUid.id.in_(imapuid_ids)).update(
+                    {ImapUid.msg_uid: -ImapUid.msg_uid},
+                    synchronize_session=False)
+            db_session.commit()
+    log.info('Remapped UIDs', remapped_count=remapped_count,
+             removed_count=removed_count)
+
+
 def get_folder_info(account_id, session, folder_name):
     try:
         # using .one() here may catch duplication bugs
@@ -186,10 +335,15 @@ def create_imap_message(db_session, account, folder, msg):
         relationships. All new objects are uncommitted.
 
     """
-    new_message = Message.create_from_synced(account=account, mid=msg.uid,
-                                             folder_name=folder.name,
-                                             received_date=msg.internaldate,
-                                             body_string=msg.body)
+    if isinstance(msg, RawHeaders):
+        new_message = Message.create_from_headers(
+            account=account, mid=msg.uid, folder_name=folder.name,
+            received_date=msg.internaldate, header_string=msg.body,
+            size=msg.size, preview=msg.preview)
+    else:
+        new_message = Message.create_from_synced(
+            account=account, mid=msg.uid, folder_name=folder.name,
+            received_date=msg.internaldate, body_string=msg.body)
 
     # Check to see if this is a copy of a message that was first created
     # by the Nylas API. If so, don't create a new object; just use the old one.
@@ -63,10 +63,13 @@ sessions reduce scalability.
 from __future__ import division
 
 from datetime import datetime, timedelta
+from collections import defaultdict
 from gevent import Greenlet
+from gevent.event import Event
+from gevent.queue import Queue
 import gevent
 import imaplib
-from sqlalchemy import func
+from sqlalchemy import desc
 from sqlalchemy.orm import load_only
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
@@ -74,21 +77,27 @@ from sqlalchemy.orm.exc import NoResultFound
 from inbox.basicauth import ValidationError
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.debug import bind_context
-from inbox.util.itert import chunk
+from inbox.util.itert import chunk, consume
 from inbox.util.misc import or_none
-from inbox.util.threading import fetch_corresponding_thread, MAX_THREAD_LENGTH
+from inbox.util.threading import (fetch_corresponding_thread,
+                                  index_thread_references, MAX_THREAD_LENGTH)
 from inbox.util.stats import statsd_client
+from inbox.config import config
 from nylas.logging import get_logger
 log = get_logger()
 from inbox.crispin import connection_pool, retry_crispin, FolderMissingError
+from inbox.connection_broker import PRIORITY_HIGH, PRIORITY_NORMAL
 from inbox.models import Folder, Account, Message
 from inbox.models.backends.imap import (ImapFolderSyncStatus, ImapThread,
                                         ImapUid, ImapFolderInfo)
 from inbox.models.session import session_scope
 from inbox.mailsync.backends.imap import common
+from inbox.mailsync.backends.imap.poll_scheduler import PollScheduler
+from inbox.mailsync.backends.imap.uid_index import UidIndex
 from inbox.mailsync.backends.base import (MailsyncDone, MailsyncError,
                                           THROTTLE_COUNT, THROTTLE_WAIT)
 from inbox.heartbeat.store import HeartbeatStatusProxy
+from inbox.s3.base import load_pending_body
 from inbox.events.ical import import_attached_events
 
 
@@ -99,6 +108,10 @@ IDLE_WAIT = 30
 DEFAULT_POLL_FREQUENCY = 30
 # Poll on the Inbox folder more often.
 INBOX_POLL_FREQUENCY = 10
+# Folders which haven't changed in a while are polled less and less often,
+# up to these intervals. See PollScheduler.
+MAX_POLL_FREQUENCY = config.get('IMAP_MAX_POLL_FREQUENCY', 600)
+INBOX_MAX_POLL_FREQUENCY = config.get('IMAP_INBOX_MAX_POLL_FREQUENCY', 60)
 FAST_FLAGS_REFRESH_LIMIT = 100
 SLOW_FLAGS_REFRESH_LIMIT = 2000
 SLOW_REFRESH_INTERVAL = timedelta(seconds=3600)
@@ -109,6 +122,48 @@ MAX_UIDINVALID_RESYNCS = 5
 
 CONDSTORE_FLAGS_REFRESH_BATCH_SIZE = 200
 
+# During initial sync, generic IMAP messages are downloaded with multi-UID
+# FETCH commands. A batch is closed as soon as adding another message would
+# exceed either limit. Set IMAP_MAX_DOWNLOAD_COUNT to 1 to go back to
+# downloading one message per round trip.
+MAX_DOWNLOAD_BYTES = config.get('IMAP_MAX_DOWNLOAD_BYTES', 2 ** 21)
+MAX_DOWNLOAD_COUNT = config.get('IMAP_MAX_DOWNLOAD_COUNT', 30)
+# Saved messages are committed (and their objects freed) whenever the raw
+# size of the uncommitted ones reaches this many bytes, so that the memory
+# used for a batch is bounded by its size rather than by its message count.
+COMMIT_MAX_BYTES = config.get('IMAP_COMMIT_MAX_BYTES', 2 ** 22)
+# Number of pending UIDs we fetch RFC822.SIZE for at a time.
+SIZE_FETCH_CHUNK_SIZE = 1024
+# In pipelined mode, initial sync fetches message batches in a separate
+# greenlet, up to this many bytes ahead of parsing and committing them.
+PIPELINED_DOWNLOAD = config.get('IMAP_PIPELINED_DOWNLOAD', True)
+PIPELINE_MAX_QUEUED_BYTES = config.get('IMAP_PIPELINE_MAX_QUEUED_BYTES',
+                                       2 ** 23)
+# How often the in-memory UID index is reloaded from the database, to
+# correct any drift from changes made outside of the sync engine.
+UID_INDEX_RECONCILE_INTERVAL = timedelta(
+    seconds=config.get('IMAP_UID_INDEX_RECONCILE_INTERVAL', 3600))
+# When the account's FolderChangeWatcher is running, folder engines poll
+# only when it wakes them up, plus this often as a safety net.
+WATCHED_POLL_FREQUENCY = config.get('IMAP_WATCHED_POLL_FREQUENCY', 600)
+# Minimum time between writes of buffered ImapFolderInfo changes, outside of
+# state transitions and shutdown. See FolderInfoCache.
+FOLDER_INFO_FLUSH_INTERVAL = timedelta(
+    seconds=config.get('IMAP_FOLDER_INFO_FLUSH_INTERVAL', 30))
+# Folders with at least this many messages on the server are initially
+# synced header-first: we only download headers and a short preview, and
+# fetch full bodies on demand or in the background later. Off by default.
+HEADER_FIRST_SYNC_THRESHOLD = config.get('IMAP_HEADER_FIRST_SYNC_THRESHOLD',
+                                         None)
+# Header-first downloads are small, so batch them by count only.
+HEADER_FIRST_DOWNLOAD_COUNT = config.get('IMAP_HEADER_FIRST_DOWNLOAD_COUNT',
+                                         200)
+# Number of pending bodies downloaded per poll once the folder is synced.
+BODY_BACKFILL_BATCH_SIZE = config.get('IMAP_BODY_BACKFILL_BATCH_SIZE', 20)
+# After a UIDVALIDITY change, reattach saved messages to their new UIDs by
+# Message-ID and size instead of redownloading the whole folder.
+UIDVALIDITY_REMAP = config.get('IMAP_UIDVALIDITY_REMAP', True)
+
 
 class FolderSyncEngine(Greenlet):
     """Base class for a per-folder IMAP sync engine."""
@@ -139,15 +194,37 @@ class FolderSyncEngine(Greenlet):
         self.email_address = email_address
 
         if self.folder_name.lower() == 'inbox':
-            self.poll_frequency = INBOX_POLL_FREQUENCY
+            self.poll_scheduler = PollScheduler(INBOX_POLL_FREQUENCY,
+                                                INBOX_MAX_POLL_FREQUENCY)
+            # Get connections before archive folders when they're scarce.
+            self.conn_priority = PRIORITY_HIGH
         else:
-            self.poll_frequency = DEFAULT_POLL_FREQUENCY
+            self.poll_scheduler = PollScheduler(DEFAULT_POLL_FREQUENCY,
+                                                MAX_POLL_FREQUENCY)
+            self.conn_priority = PRIORITY_NORMAL
         self.syncmanager_lock = syncmanager_lock
         self.state = None
         self.provider_name = provider_name
         self.last_fast_refresh = None
         self.flags_fetch_results = {}
         self.conn_pool = connection_pool(self.account_id)
+        # In-memory index of the UIDs saved for this folder; see
+        # get_uid_index().
+        self._uid_index = None
+        self._uid_index_loaded_at = None
+        self._uid_index_journal = None
+        self.folder_info = FolderInfoCache(self.account_id,
+                                           self.namespace_id, self.folder_id)
+        # Set by the ImapSyncMonitor; see wait_for_changes().
+        self.change_watcher = None
+        self.wakeup = Event()
+        self._published_poll_interval = None
+        # Whether initial sync is downloading headers only; see
+        # fetch_uids().
+        self.header_first = False
+        # Highest UID the body backfill hasn't looked at yet; 0 once done.
+        # See backfill_pending_bodies().
+        self._backfill_cursor = None
 
         self.state_handlers = {
             'initial': self.initial_sync,
@@ -241,9 +318,13 @@ class FolderSyncEngine(Greenlet):
         # State handlers are idempotent, so it's okay if we're
         # killed between the end of the handler and the commit.
         if self.state != old_state:
+            self.folder_info.flush()
+
             def update(status):
                 status.state = self.state
             self.update_folder_sync_status(update)
+        else:
+            self.folder_info.checkpoint()
 
         if self.state == old_state and self.state in ['initial', 'poll']:
             # We've been through a normal state transition without raising any
@@ -271,6 +352,11 @@ class FolderSyncEngine(Greenlet):
             self.state = saved_folder_status.state
 
     def set_stopped(self, db_session):
+        try:
+            self.folder_info.flush()
+        except NoResultFound:
+            # The folder was deleted; nothing left to save.
+            pass
         self.update_folder_sync_status(lambda s: s.stop_sync())
 
     def _report_initial_sync_start(self):
@@ -292,7 +378,7 @@ class FolderSyncEngine(Greenlet):
             self._report_initial_sync_start()
             self.is_first_sync = False
 
-        with self.conn_pool.get() as crispin_client:
+        with self.conn_pool.get(self.conn_priority) as crispin_client:
             crispin_client.select_folder(self.folder_name, uidvalidity_cb)
             # Ensure we have an ImapFolderInfo row created prior to sync start.
             with session_scope(self.namespace_id) as db_session:
@@ -310,6 +396,8 @@ class FolderSyncEngine(Greenlet):
                 db_session.commit()
 
             self.initial_sync_impl(crispin_client)
+        # New mail is downloaded in full from here on.
+        self.header_first = False
 
         if self.is_initial_sync:
             self._report_initial_sync_end()
@@ -339,14 +427,14 @@ class FolderSyncEngine(Greenlet):
             assert crispin_client.selected_folder_name == self.folder_name
             remote_uids = crispin_client.all_uids()
             with self.syncmanager_lock:
-                with session_scope(self.namespace_id) as db_session:
-                    local_uids = common.local_uids(self.account_id, db_session,
-                                                   self.folder_id)
-                common.remove_deleted_uids(
-                    self.account_id, self.folder_id,
-                    set(local_uids).difference(remote_uids))
-
-            new_uids = set(remote_uids).difference(local_uids)
+                uid_index = self.get_uid_index()
+                self.remove_deleted_uids(uid_index.difference(remote_uids))
+
+            new_uids = uid_index.missing(remote_uids)
+            self.header_first = use_header_first_sync(len(remote_uids))
+            if self.header_first:
+                log.info('Syncing folder header-first',
+                         remote_uid_count=len(remote_uids))
             with session_scope(self.namespace_id) as db_session:
                 account = db_session.query(Account).get(self.account_id)
                 throttled = account.throttled
@@ -360,13 +448,24 @@ class FolderSyncEngine(Greenlet):
             bind_context(change_poller, 'changepoller', self.account_id,
                          self.folder_id)
             uids = sorted(new_uids, reverse=True)
+            # Throttled accounts are slowed down to one message per
+            # THROTTLE_WAIT anyway, so there's no point in batching them.
+            max_download_count = 1 if throttled else MAX_DOWNLOAD_COUNT
+            if self.header_first:
+                batches = chunk(uids, 1 if throttled else
+                                HEADER_FIRST_DOWNLOAD_COUNT)
+            else:
+                batches = self.batch_uids_by_size(crispin_client, uids,
+                                                  MAX_DOWNLOAD_BYTES,
+                                                  max_download_count)
+            if PIPELINED_DOWNLOAD and not throttled:
+                self.pipelined_download(crispin_client, batches)
+                return
             count = 0
-            for uid in uids:
-                # The speedup from batching appears to be less clear for
-                # non-Gmail accounts, so for now just download one-at-a-time.
-                self.download_and_commit_uids(crispin_client, [uid])
+            for batch in batches:
+                self.download_and_commit_uids(crispin_client, batch)
                 self.heartbeat_status.publish()
-                count += 1
+                count += len(batch)
                 if throttled and count >= THROTTLE_COUNT:
                     # Throttled accounts' folders sync at a rate of
                     # 1 message/ minute, after the first approx. THROTTLE_COUNT
@@ -379,6 +478,92 @@ class FolderSyncEngine(Greenlet):
                 # schedule change_poller to die
                 gevent.kill(change_poller)
 
+    def pipelined_download(self, crispin_client, batches):
+        """
+        Download and commit `batches` of UIDs. A fetcher greenlet downloads
+        upcoming batches into a queue (bounded by PIPELINE_MAX_QUEUED_BYTES)
+        while we parse and commit the current one, so that the IMAP
+        connection doesn't sit idle during parsing and the database doesn't
+        sit idle during fetches.
+
+        We report the time spent fetching and committing, and the time each
+        stage spent waiting for the other: a fetcher that's mostly waiting
+        for queue space means we're bound by parsing and committing, a
+        committer that's mostly waiting for batches means we're bound by the
+        IMAP server.
+
+        """
+        queue = DownloadQueue(PIPELINE_MAX_QUEUED_BYTES)
+        stage_times = defaultdict(float)
+
+        def fetch():
+            try:
+                for batch in batches:
+                    start = datetime.utcnow()
+                    raw_messages = self.fetch_uids(crispin_client, batch)
+                    fetched = datetime.utcnow()
+                    queue.put((start, raw_messages),
+                              sum(len(m.body or '') for m in raw_messages))
+                    stage_times['fetch'] += (fetched - start).total_seconds()
+                    stage_times['commit_wait'] += \
+                        (datetime.utcnow() - fetched).total_seconds()
+            finally:
+                queue.put(None, 0)
+
+        fetcher = gevent.spawn(fetch)
+        bind_context(fetcher, 'fetcher', self.account_id, self.folder_id)
+        try:
+            while True:
+                wait_start = datetime.utcnow()
+                item = queue.get()
+                commit_start = datetime.utcnow()
+                stage_times['fetch_wait'] += \
+                    (commit_start - wait_start).total_seconds()
+                if item is None:
+                    break
+                start, raw_messages = item
+                self.commit_raw_messages(raw_messages, start)
+                stage_times['commit'] += \
+                    (datetime.utcnow() - commit_start).total_seconds()
+                self.heartbeat_status.publish()
+            # Re-raise any error from the fetcher.
+            fetcher.get()
+        finally:
+            fetcher.kill()
+            self._report_stage_times(stage_times)
+
+    def _report_stage_times(self, stage_times):
+        for stage, seconds in stage_times.iteritems():
+            metrics = [
+                '.'.join(['mailsync', 'providers', self.provider_name,
+                          'download', stage]),
+                '.'.join(['mailsync', 'providers', 'overall', 'download',
+                          stage])
+            ]
+            for metric in metrics:
+                statsd_client.timing(metric, seconds * 1000)
+        log.info('Pipelined download stage times',
+                 **{'{}_seconds'.format(stage): round(seconds, 2)
+                    for stage, seconds in stage_times.iteritems()})
+
+    def batch_uids_by_size(self, crispin_client, uids, max_download_bytes,
+                           max_download_count):
+        """
+        Group `uids` (in the given order) into download batches, based on
+        their RFC822.SIZE. Sizes are fetched lazily, SIZE_FETCH_CHUNK_SIZE
+        UIDs at a time, so that we don't hold up the first download on a
+        metadata fetch for the whole folder.
+
+        """
+        for uid_chunk in chunk(uids, SIZE_FETCH_CHUNK_SIZE):
+            sizes = crispin_client.sizes(uid_chunk)
+            # UIDs might have been expunged since sync started, in which case
+            # the size fetch above returns nothing for them.
+            uid_chunk = [u for u in uid_chunk if u in sizes]
+            for batch in batch_by_size(uid_chunk, sizes, max_download_bytes,
+                                       max_download_count):
+                yield batch
+
     def should_idle(self, crispin_client):
         if not hasattr(self, '_should_idle'):
             self._should_idle = (
@@ -388,9 +573,16 @@ class FolderSyncEngine(Greenlet):
         return self._should_idle
 
     def poll_impl(self):
-        with self.conn_pool.get() as crispin_client:
+        with self.conn_pool.get(self.conn_priority) as crispin_client:
             self.check_uid_changes(crispin_client)
-            if self.should_idle(crispin_client):
+            if self.state == 'poll':
+                self.backfill_pending_bodies(crispin_client)
+            # With NOTIFY, the change watcher's connection gets notified of
+            # changes to this folder too, so we don't need to hold a second
+            # connection IDLEing on it.
+            notify_watched = (self.change_watcher is not None and
+                              self.change_watcher.mode == 'notify')
+            if self.should_idle(crispin_client) and not notify_watched:
                 crispin_client.select_folder(self.folder_name,
                                              self.uidvalidity_cb)
                 idling = True
@@ -416,21 +608,70 @@ class FolderSyncEngine(Greenlet):
                 idling = False
         # Close IMAP connection before sleeping
         if not idling:
-            gevent.sleep(self.poll_frequency)
+            self.wait_for_changes()
+
+    @property
+    def poll_frequency(self):
+        """The base poll interval, used while the folder is active."""
+        return self.poll_scheduler.min_interval
+
+    @poll_frequency.setter
+    def poll_frequency(self, value):
+        self.poll_scheduler = PollScheduler(
+            value, self.poll_scheduler.max_interval)
+
+    def wait_for_changes(self):
+        """
+        Sleep until it's time to poll again. If the account's
+        FolderChangeWatcher is running, that's when it tells us the folder
+        changed (or after WATCHED_POLL_FREQUENCY seconds regardless);
+        otherwise it's when the PollScheduler says so. Either way, we can be
+        woken up early through `self.wakeup`.
+
+        """
+        interval = self.poll_scheduler.next_interval()
+        if self.change_watcher is not None and \
+                self.change_watcher.mode is not None:
+            interval = WATCHED_POLL_FREQUENCY
+        if interval != self._published_poll_interval:
+            self.heartbeat_status.publish(poll_interval=interval)
+            self._published_poll_interval = interval
+        self.wakeup.wait(interval)
+        self.wakeup.clear()
 
     def resync_uids_impl(self):
         # First, let's check if the UIVDALIDITY change was spurious, if
         # it is, just discard it and go on.
-        with self.conn_pool.get() as crispin_client:
+        with self.conn_pool.get(self.conn_priority) as crispin_client:
             crispin_client.select_folder(self.folder_name, lambda *args: True)
             remote_uidvalidity = crispin_client.selected_uidvalidity
             remote_uidnext = crispin_client.selected_uidnext
             if remote_uidvalidity <= self.uidvalidity:
                 log.debug('UIDVALIDITY unchanged')
                 return
-        # Otherwise, if the UIDVALIDITY really has changed, discard all saved
-        # UIDs for the folder, mark associated messages for garbage-collection,
-        # and return to the 'initial' state to resync.
+            if UIDVALIDITY_REMAP:
+                message_ids = crispin_client.message_ids(
+                    crispin_client.all_uids())
+        if UIDVALIDITY_REMAP:
+            # Some servers bump UIDVALIDITY after maintenance without
+            # actually changing the folder's contents. Move saved messages
+            # over to the UID of the remote message with the same Message-ID
+            # and size; the rest are treated as deleted, and the 'initial'
+            # state downloads whatever we didn't match.
+            new_uids = {key: uid for uid, key in message_ids.iteritems()}
+            common.remap_uids(self.account_id, self.folder_id,
+                              [Message.message_id_header, Message.size],
+                              new_uids)
+            log.info('Remapped UIDs by Message-ID',
+                     remote_uid_count=len(message_ids))
+            self._uid_index = None
+            self.uidvalidity = remote_uidvalidity
+            self.highestmodseq = None
+            self.uidnext = remote_uidnext
+            return
+        # Otherwise, discard all saved UIDs for the folder, mark associated
+        # messages for garbage-collection, and return to the 'initial' state
+        # to resync.
         # This will cause message and threads to be deleted and recreated, but
         # uidinvalidity is sufficiently rare that this tradeoff is acceptable.
         with session_scope(self.namespace_id) as db_session:
@@ -439,8 +680,7 @@ class FolderSyncEngine(Greenlet):
                 filter_by(account_id=self.account_id,
                           folder_id=self.folder_id)
             }
-        common.remove_deleted_uids(self.account_id, self.folder_id,
-                                   invalid_uids)
+        self.remove_deleted_uids(invalid_uids)
         self.uidvalidity = remote_uidvalidity
         self.highestmodseq = None
         self.uidnext = remote_uidnext
@@ -451,6 +691,7 @@ class FolderSyncEngine(Greenlet):
         while True:
             log.debug('polling for changes')
             self.poll_impl()
+            self.folder_info.checkpoint()
 
     def create_message(self, db_session, acct, folder, msg):
         assert acct is not None and acct.namespace is not None
@@ -500,11 +741,6 @@ class FolderSyncEngine(Greenlet):
 
         return new_uid
 
-    def _count_thread_messages(self, thread_id, db_session):
-        count, = db_session.query(func.count(Message.id)). \
-            filter(Message.thread_id == thread_id).one()
-        return count
-
     def add_message_to_thread(self, db_session, message_obj, raw_message):
         """Associate message_obj to the right Thread object, creating a new
         thread if necessary."""
@@ -518,9 +754,7 @@ class FolderSyncEngine(Greenlet):
             if parent_thread:
                 # If there's a parent thread that isn't too long already,
                 # add to it. Otherwise create a new thread.
-                parent_message_count = self._count_thread_messages(
-                    parent_thread.id, db_session)
-                if parent_message_count < MAX_THREAD_LENGTH:
+                if parent_thread.get_message_count() < MAX_THREAD_LENGTH:
                     construct_new_thread = False
 
             if construct_new_thread:
@@ -528,26 +762,105 @@ class FolderSyncEngine(Greenlet):
                     db_session, self.namespace_id, message_obj)
             else:
                 parent_thread.messages.append(message_obj)
+            index_thread_references(db_session, self.namespace_id,
+                                    message_obj, message_obj.thread)
+
+    def fetch_uids(self, crispin_client, uids):
+        """
+        Download `uids` for saving, in full or, during a header-first
+        initial sync, just their headers and a preview.
+
+        """
+        if self.header_first:
+            return crispin_client.uid_headers(uids)
+        return crispin_client.uids(uids)
 
     def download_and_commit_uids(self, crispin_client, uids):
         start = datetime.utcnow()
+        raw_messages = self.fetch_uids(crispin_client, uids)
+        return self.commit_raw_messages(raw_messages, start)
+
+    def backfill_pending_bodies(self, crispin_client):
+        """
+        Download the full bodies of up to BODY_BACKFILL_BATCH_SIZE messages
+        in this folder that were synced header-first, newest first. Called
+        once per poll, so that this happens in the background without
+        getting in the way of syncing new mail.
+
+        """
+        if self._backfill_cursor == 0:
+            return
+        with session_scope(self.namespace_id) as db_session:
+            q = db_session.query(ImapUid.msg_uid).join(Message).filter(
+                ImapUid.account_id == self.account_id,
+                ImapUid.folder_id == self.folder_id,
+                Message.body_pending)
+            if self._backfill_cursor is not None:
+                q = q.filter(ImapUid.msg_uid < self._backfill_cursor)
+            uids = [uid for uid, in q.order_by(desc(ImapUid.msg_uid)).
+                    limit(BODY_BACKFILL_BATCH_SIZE)]
+        if not uids:
+            self._backfill_cursor = 0
+            return
+        self._backfill_cursor = min(uids)
+
+        crispin_client.select_folder(self.folder_name, self.uidvalidity_cb)
         raw_messages = crispin_client.uids(uids)
+        loaded = 0
+        with self.syncmanager_lock:
+            with session_scope(self.namespace_id) as db_session:
+                for msg in consume(raw_messages):
+                    imapuid = db_session.query(ImapUid).filter(
+                        ImapUid.account_id == self.account_id,
+                        ImapUid.folder_id == self.folder_id,
+                        ImapUid.msg_uid == msg.uid).first()
+                    # The body may have been fetched through the API in the
+                    # meantime.
+                    if imapuid is None or not imapuid.message.body_pending:
+                        continue
+                    load_pending_body(db_session, imapuid.message, msg.body)
+                    loaded += 1
+                db_session.commit()
+        log.debug('Backfilled message bodies', loaded_count=loaded)
+
+    def commit_raw_messages(self, raw_messages, start):
+        """
+        Parse and save downloaded messages. `start` is when their download
+        began, for reporting message velocity. Returns the number of UIDs
+        saved.
+
+        `raw_messages` is emptied as the messages are saved, so that each
+        raw message can be freed as soon as it's been parsed. Messages are
+        committed whenever the uncommitted ones add up to COMMIT_MAX_BYTES.
+
+        """
         if not raw_messages:
             return 0
 
         new_uids = set()
+        uncommitted_uids = set()
+        uncommitted_bytes = 0
         with self.syncmanager_lock:
             with session_scope(self.namespace_id) as db_session:
                 account = Account.get(self.account_id, db_session)
                 folder = Folder.get(self.folder_id, db_session)
-                for msg in raw_messages:
+                for msg in consume(raw_messages):
                     uid = self.create_message(db_session, account,
                                               folder, msg)
                     if uid is not None:
                         db_session.add(uid)
                         db_session.flush()
-                        new_uids.add(uid)
+                        uncommitted_uids.add(uid.msg_uid)
+                    uncommitted_bytes += len(msg.body or '')
+                    if uncommitted_bytes >= COMMIT_MAX_BYTES:
+                        db_session.commit()
+                        self.add_saved_uids(uncommitted_uids)
+                        new_uids.update(uncommitted_uids)
+                        uncommitted_uids = set()
+                        uncommitted_bytes = 0
                 db_session.commit()
+            self.add_saved_uids(uncommitted_uids)
+            new_uids.update(uncommitted_uids)
 
         log.debug('Committed new UIDs', new_committed_message_count=len(new_uids))
         # If we downloaded uids, record message velocity (#uid / latency)
@@ -633,6 +946,7 @@ class FolderSyncEngine(Greenlet):
                                                 ['UID']).keys()
         new_uids = set(latest_uids) - {lastseenuid}
         if new_uids:
+            self.poll_scheduler.record_change()
             for uid in sorted(new_uids):
                 self.download_and_commit_uids(crispin_client, [uid])
         self.uidnext = remote_uidnext
@@ -661,14 +975,26 @@ class FolderSyncEngine(Greenlet):
                   new_highestmodseq=new_highestmodseq,
                   saved_highestmodseq=self.highestmodseq)
         crispin_client.select_folder(self.folder_name, self.uidvalidity_cb)
-        changed_flags = crispin_client.condstore_changed_flags(
-            self.highestmodseq)
-        remote_uids = crispin_client.all_uids()
+        if crispin_client.qresync_enabled:
+            # With QRESYNC, the server tells us which UIDs were expunged since
+            # our saved modseq, so we can skip diffing the full remote and
+            # local UID sets.
+            changed_flags, vanished_ranges = \
+                crispin_client.qresync_changed_flags(self.highestmodseq)
+            remote_uids = None
+        else:
+            changed_flags = crispin_client.condstore_changed_flags(
+                self.highestmodseq)
+            remote_uids = crispin_client.all_uids()
+        if changed_flags:
+            self.poll_scheduler.record_change()
 
         # In order to be able to sync changes to tens of thousands of flags at
         # once, we commit updates in batches. We do this in ascending order by
         # modseq and periodically "checkpoint" our saved highestmodseq. (It's
         # safe to checkpoint *because* we go in ascending order by modseq.)
+        # Checkpoints are written out at most every FOLDER_INFO_FLUSH_INTERVAL;
+        # losing one just means we reprocess a few batches.
         # That way if the process gets restarted halfway through this refresh,
         # we don't have to completely start over. It's also slow to load many
         # objects into the SQLAlchemy session and then issue lots of commits;
@@ -684,25 +1010,30 @@ class FolderSyncEngine(Greenlet):
             if len(flag_batch) == CONDSTORE_FLAGS_REFRESH_BATCH_SIZE:
                 interim_highestmodseq = max(v.modseq for k, v in flag_batch)
                 self.highestmodseq = interim_highestmodseq
+                self.folder_info.checkpoint()
 
-        with session_scope(self.namespace_id) as db_session:
-            local_uids = common.local_uids(self.account_id, db_session,
-                                           self.folder_id)
-            expunged_uids = set(local_uids).difference(remote_uids)
+        if remote_uids is None:
+            expunged_uids = self.get_uid_index().in_ranges(vanished_ranges)
+        else:
+            expunged_uids = self.get_uid_index().difference(remote_uids)
 
         if expunged_uids:
+            self.poll_scheduler.record_change()
             # If new UIDs have appeared since we last checked in
             # get_new_uids, save them first. We want to always have the
             # latest UIDs before expunging anything, in order to properly
             # capture draft revisions.
-            with session_scope(self.namespace_id) as db_session:
-                lastseenuid = common.lastseenuid(self.account_id, db_session,
-                                                 self.folder_id)
-            if remote_uids and lastseenuid < max(remote_uids):
-                log.info('Downloading new UIDs before expunging')
+            if remote_uids is None:
+                # get_new_uids is a no-op if UIDNEXT hasn't moved.
                 self.get_new_uids(crispin_client)
-            common.remove_deleted_uids(self.account_id, self.folder_id,
-                                       expunged_uids)
+            else:
+                with session_scope(self.namespace_id) as db_session:
+                    lastseenuid = common.lastseenuid(
+                        self.account_id, db_session, self.folder_id)
+                if remote_uids and lastseenuid < max(remote_uids):
+                    log.info('Downloading new UIDs before expunging')
+                    self.get_new_uids(crispin_client)
+            self.remove_deleted_uids(expunged_uids)
         self.highestmodseq = new_highestmodseq
 
     def generic_refresh_flags(self, crispin_client):
@@ -724,11 +1055,7 @@ class FolderSyncEngine(Greenlet):
 
     def refresh_flags_impl(self, crispin_client, max_uids):
         crispin_client.select_folder(self.folder_name, self.uidvalidity_cb)
-        with session_scope(self.namespace_id) as db_session:
-            local_uids = common.local_uids(account_id=self.account_id,
-                                           session=db_session,
-                                           folder_id=self.folder_id,
-                                           limit=max_uids)
+        local_uids = self.get_uid_index().top(max_uids)
 
         flags = crispin_client.flags(local_uids)
         if (max_uids in self.flags_fetch_results and
@@ -740,14 +1067,65 @@ class FolderSyncEngine(Greenlet):
             return
         log.debug('Changed flags refresh response, persisting changes',
                   max_uids=max_uids)
+        self.poll_scheduler.record_change()
         expunged_uids = set(local_uids).difference(flags.keys())
-        common.remove_deleted_uids(self.account_id, self.folder_id,
-                                   expunged_uids)
+        self.remove_deleted_uids(expunged_uids)
         with session_scope(self.namespace_id) as db_session:
             common.update_metadata(self.account_id, self.folder_id,
                                    self.folder_role, flags, db_session)
         self.flags_fetch_results[max_uids] = (local_uids, flags)
 
+    def get_uid_index(self):
+        """
+        Return the in-memory index of UIDs saved for this folder. It's loaded
+        from the database on first use, kept up to date as we save and
+        delete UIDs, and reloaded every UID_INDEX_RECONCILE_INTERVAL in case
+        it has drifted from the database.
+
+        """
+        now = datetime.utcnow()
+        if (self._uid_index is not None and
+                now < self._uid_index_loaded_at + UID_INDEX_RECONCILE_INTERVAL):
+            return self._uid_index
+
+        # Other greenlets of this engine may save or delete UIDs while we
+        # stream the index from the database; journal their changes and
+        # replay them on top of what we loaded.
+        self._uid_index_journal = []
+        try:
+            with session_scope(self.namespace_id) as db_session:
+                uid_index = UidIndex(common.iter_local_uids(
+                    self.account_id, db_session, self.folder_id))
+            for method, uids in self._uid_index_journal:
+                getattr(uid_index, method)(uids)
+        finally:
+            self._uid_index_journal = None
+
+        if self._uid_index is not None and uid_index != self._uid_index:
+            log.warning('UID index out of sync with database, reloaded',
+                        index_count=len(self._uid_index),
+                        saved_count=len(uid_index))
+        self._uid_index = uid_index
+        self._uid_index_loaded_at = now
+        return uid_index
+
+    def _update_uid_index(self, method, uids):
+        uids = list(uids)
+        if self._uid_index is not None:
+            getattr(self._uid_index, method)(uids)
+        if self._uid_index_journal is not None:
+            self._uid_index_journal.append((method, uids))
+
+    def add_saved_uids(self, uids):
+        """Record newly saved UIDs in the in-memory UID index."""
+        self._update_uid_index('update', uids)
+
+    def remove_deleted_uids(self, uids):
+        """Delete `uids` from the database and the in-memory UID index."""
+        uids = list(uids)
+        common.remove_deleted_uids(self.account_id, self.folder_id, uids)
+        self._update_uid_index('difference_update', uids)
+
     def check_uid_changes(self, crispin_client):
         self.get_new_uids(crispin_client)
         if crispin_client.condstore_supported():
@@ -755,71 +1133,46 @@ class FolderSyncEngine(Greenlet):
         else:
             self.generic_refresh_flags(crispin_client)
 
+    # UIDVALIDITY changes are rare, and other code (e.g. the module-level
+    # uidvalidity_cb) reads the saved value straight from the database, so we
+    # write it through immediately. The other fields are progress markers
+    # which may safely lag behind: if we crash before a flush, we just redo
+    # some work on restart.
     @property
     def uidvalidity(self):
-        if not hasattr(self, '_uidvalidity'):
-            self._uidvalidity = self._load_imap_folder_info().uidvalidity
-        return self._uidvalidity
+        return self.folder_info.get('uidvalidity')
 
     @uidvalidity.setter
     def uidvalidity(self, value):
-        self._update_imap_folder_info('uidvalidity', value)
-        self._uidvalidity = value
+        self.folder_info.set('uidvalidity', value)
+        self.folder_info.flush()
 
     @property
     def uidnext(self):
-        if not hasattr(self, '_uidnext'):
-            self._uidnext = self._load_imap_folder_info().uidnext
-        return self._uidnext
+        return self.folder_info.get('uidnext')
 
     @uidnext.setter
     def uidnext(self, value):
-        self._update_imap_folder_info('uidnext', value)
-        self._uidnext = value
+        self.folder_info.set('uidnext', value)
 
     @property
     def last_slow_refresh(self):
         # We persist the last_slow_refresh timestamp so that we don't end up
         # doing a (potentially expensive) full flags refresh for every account
         # on every process restart.
-        if not hasattr(self, '_last_slow_refresh'):
-            self._last_slow_refresh = self._load_imap_folder_info(). \
-                last_slow_refresh
-        return self._last_slow_refresh
+        return self.folder_info.get('last_slow_refresh')
 
     @last_slow_refresh.setter
     def last_slow_refresh(self, value):
-        self._update_imap_folder_info('last_slow_refresh', value)
-        self._last_slow_refresh = value
+        self.folder_info.set('last_slow_refresh', value)
 
     @property
     def highestmodseq(self):
-        if not hasattr(self, '_highestmodseq'):
-            self._highestmodseq = self._load_imap_folder_info().highestmodseq
-        return self._highestmodseq
+        return self.folder_info.get('highestmodseq')
 
     @highestmodseq.setter
     def highestmodseq(self, value):
-        self._highestmodseq = value
-        self._update_imap_folder_info('highestmodseq', value)
-
-    def _load_imap_folder_info(self):
-        with session_scope(self.namespace_id) as db_session:
-            imapfolderinfo = db_session.query(ImapFolderInfo). \
-                filter(ImapFolderInfo.account_id == self.account_id,
-                       ImapFolderInfo.folder_id == self.folder_id). \
-                one()
-            db_session.expunge(imapfolderinfo)
-            return imapfolderinfo
-
-    def _update_imap_folder_info(self, attrname, value):
-        with session_scope(self.namespace_id) as db_session:
-            imapfolderinfo = db_session.query(ImapFolderInfo). \
-                filter(ImapFolderInfo.account_id == self.account_id,
-                       ImapFolderInfo.folder_id == self.folder_id). \
-                one()
-            setattr(imapfolderinfo, attrname, value)
-            db_session.commit()
+        self.folder_info.set('highestmodseq', value)
 
     def uidvalidity_cb(self, account_id, folder_name, select_info):
         assert folder_name == self.folder_name
@@ -836,11 +1189,147 @@ class FolderSyncEngine(Greenlet):
         return select_info
 
 
+def use_header_first_sync(remote_uid_count):
+    """Whether to sync a folder with this many messages header-first."""
+    return (HEADER_FIRST_SYNC_THRESHOLD is not None and
+            remote_uid_count >= HEADER_FIRST_SYNC_THRESHOLD)
+
+
+def batch_by_size(uids, sizes, max_bytes, max_count):
+    """
+    Split `uids` into consecutive batches of at most `max_count` UIDs whose
+    combined `sizes` don't exceed `max_bytes`. A single message larger than
+    `max_bytes` gets a batch of its own.
+
+    """
+    batch = []
+    batch_size = 0
+    for uid in uids:
+        size = sizes.get(uid, 0)
+        if batch and (len(batch) >= max_count or
+                      batch_size + size > max_bytes):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(uid)
+        batch_size += size
+    if batch:
+        yield batch
+
+
 class UidInvalid(Exception):
     """Raised when a folder's UIDVALIDITY changes, requiring a resync."""
     pass
 
 
+class DownloadQueue(object):
+    """
+    A queue of downloaded message batches, bounded by the total size of the
+    queued messages rather than by the number of batches. A batch is always
+    accepted into an empty queue, however big it is.
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._queue = Queue()
+        self._space_available = Event()
+
+    def put(self, item, size):
+        while size and self.size and self.size + size > self.max_bytes:
+            self._space_available.clear()
+            self._space_available.wait()
+        self.size += size
+        self._queue.put((item, size))
+
+    def get(self):
+        item, size = self._queue.get()
+        self.size -= size
+        self._space_available.set()
+        return item
+
+
+class FolderInfoCache(object):
+    """
+    Write-behind cache for a folder's ImapFolderInfo row.
+
+    The row is loaded once; reads are then served from memory. Writes are
+    buffered and persisted together by flush(), which the sync engine calls
+    on state transitions and when it's stopped. checkpoint() flushes only if
+    FOLDER_INFO_FLUSH_INTERVAL has passed since the last flush, so that a
+    busy engine doesn't issue an UPDATE for every change.
+
+    """
+    fields = ('uidvalidity', 'uidnext', 'highestmodseq', 'last_slow_refresh')
+
+    def __init__(self, account_id, namespace_id, folder_id):
+        self.account_id = account_id
+        self.namespace_id = namespace_id
+        self.folder_id = folder_id
+        self._values = None
+        self._dirty = {}
+        self._last_flush = datetime.utcnow()
+
+    def _query(self, db_session):
+        return db_session.query(ImapFolderInfo). \
+            filter(ImapFolderInfo.account_id == self.account_id,
+                   ImapFolderInfo.folder_id == self.folder_id). \
+            one()
+
+    def _load(self):
+        with session_scope(self.namespace_id) as db_session:
+            imapfolderinfo = self._query(db_session)
+            values = {attrname: getattr(imapfolderinfo, attrname)
+                      for attrname in self.fields}
+        # Don't clobber values that were set while we were loading.
+        values.update(self._dirty)
+        self._values = values
+
+    def get(self, attrname):
+        if self._values is None:
+            self._load()
+        return self._values[attrname]
+
+    def set(self, attrname, value):
+        if self._values is None:
+            self._load()
+        self._values[attrname] = value
+        self._dirty[attrname] = value
+
+    def reset(self):
+        """
+        Discard cached and pending values, e.g. after the row has been
+        rewritten directly.
+
+        """
+        self._values = None
+        self._dirty = {}
+
+    def checkpoint(self):
+        if (self._dirty and datetime.utcnow() >=
+                self._last_flush + FOLDER_INFO_FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            with session_scope(self.namespace_id) as db_session:
+                imapfolderinfo = self._query(db_session)
+                for attrname, value in dirty.iteritems():
+                    setattr(imapfolderinfo, attrname, value)
+                db_session.commit()
+        except Exception:
+            # Keep the values around for the next flush, unless they've been
+            # superseded in the meantime.
+            dirty.update(self._dirty)
+            self._dirty = dirty
+            raise
+        self._last_flush = datetime.utcnow()
+
+
 # This version is elsewhere in the codebase, so keep it for now
 # TODO(emfree): clean this up.
 def uidvalidity_cb(account_id, folder_name, select_info):
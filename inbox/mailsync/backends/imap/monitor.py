@@ -1,17 +1,33 @@
-from gevent import sleep
+import imaplib
+
+from gevent import Greenlet, sleep
+from sqlalchemy import func
 from gevent.pool import Group
 from gevent.coros import BoundedSemaphore
 from inbox.basicauth import ValidationError
 from nylas.logging import get_logger
-from inbox.crispin import retry_crispin, connection_pool
-from inbox.models import Account, Folder
+from inbox.config import config
+from inbox.crispin import (retry_crispin, connection_pool,
+                           parse_notify_status, selected_folder_changed)
+from inbox.models import Account, Folder, ActionLog
 from inbox.models.category import Category, sanitize_name
 from inbox.models.session import session_scope
 from inbox.mailsync.backends.base import BaseMailSyncMonitor
 from inbox.mailsync.backends.imap.generic import FolderSyncEngine
 from inbox.mailsync.gc import DeleteHandler
+from inbox.util.concurrency import retry_with_logging
+from inbox.util.debug import bind_context
 log = get_logger()
 
+CHANGE_WATCHER_ENABLED = config.get('IMAP_CHANGE_WATCHER_ENABLED', True)
+# How often FolderChangeWatcher checks folders with STATUS, for servers which
+# don't support NOTIFY.
+STATUS_SWEEP_FREQUENCY = config.get('IMAP_STATUS_SWEEP_FREQUENCY', 30)
+STATUS_SWEEP_ITEMS = ['UIDNEXT', 'HIGHESTMODSEQ', 'MESSAGES']
+# How long FolderChangeWatcher IDLEs waiting for NOTIFY events before
+# checking whether the set of folders to watch has changed.
+NOTIFY_IDLE_WAIT = 60
+
 
 class ImapSyncMonitor(BaseMailSyncMonitor):
     """
@@ -35,6 +51,8 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
 
         self.folder_monitors = Group()
         self.delete_handler = None
+        self.change_watcher = None
+        self.latest_action_id = None
 
         BaseMailSyncMonitor.__init__(self, account, heartbeat)
 
@@ -133,6 +151,7 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
                                                 self.email_address,
                                                 self.provider_name,
                                                 self.syncmanager_lock)
+                thread.change_watcher = self.change_watcher
                 self.folder_monitors.start(thread)
 
             while not thread.state == 'poll' and not thread.ready():
@@ -153,13 +172,45 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
                 uid_accessor=lambda m: m.imapuids)
             self.delete_handler.start()
 
+    def start_change_watcher(self):
+        if self.change_watcher is None and CHANGE_WATCHER_ENABLED:
+            self.change_watcher = FolderChangeWatcher(
+                account_id=self.account_id,
+                provider_name=self.provider_name,
+                folder_monitors=self.folder_monitors)
+            self.change_watcher.start()
+
+    def _cleanup(self):
+        if self.change_watcher is not None:
+            self.change_watcher.kill()
+        BaseMailSyncMonitor._cleanup(self)
+
+    def check_for_syncback_actions(self):
+        """
+        If the user has taken actions on the account (e.g. moved or marked
+        messages as read) since we last checked, more changes are likely to
+        follow, so put all folder engines back on their base poll interval.
+
+        """
+        with session_scope(self.namespace_id) as db_session:
+            latest_action_id = db_session.query(func.max(ActionLog.id)). \
+                filter(ActionLog.namespace_id == self.namespace_id).scalar()
+        if self.latest_action_id is not None and \
+                latest_action_id != self.latest_action_id:
+            for engine in self.folder_monitors:
+                engine.poll_scheduler.reset()
+                engine.wakeup.set()
+        self.latest_action_id = latest_action_id
+
     def sync(self):
         try:
             self.start_delete_handler()
+            self.start_change_watcher()
             self.start_new_folder_sync_engines()
             while True:
                 sleep(self.refresh_frequency)
                 self.start_new_folder_sync_engines()
+                self.check_for_syncback_actions()
         except ValidationError as exc:
             log.error(
                 'Error authenticating; stopping sync', exc_info=True,
@@ -168,3 +219,126 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
                 account = db_session.query(Account).get(self.account_id)
                 account.mark_invalid()
                 account.update_sync_error(exc)
+
+
+class FolderChangeWatcher(Greenlet):
+    """
+    Watches all of an account's folders over a single IMAP connection, and
+    wakes up the sync engines of the folders which changed, so that idle
+    folders don't each issue STATUS and SELECT commands every poll interval.
+
+    If the server supports NOTIFY (RFC 5465), we ask it to report changes to
+    all polling folders and IDLE waiting for them. Otherwise we sweep the
+    folders with STATUS every STATUS_SWEEP_FREQUENCY seconds. STATUS only
+    reveals flag changes through HIGHESTMODSEQ, so if the server supports
+    neither NOTIFY nor CONDSTORE we don't watch anything, and the folder
+    engines keep polling on their own.
+
+    Parameters
+    ----------
+    account_id: int
+    provider_name: str
+    folder_monitors: gevent.pool.Group
+        The account's FolderSyncEngines.
+
+    """
+
+    def __init__(self, account_id, provider_name, folder_monitors):
+        bind_context(self, 'changewatcher', account_id)
+        self.account_id = account_id
+        self.provider_name = provider_name
+        self.folder_monitors = folder_monitors
+        self.conn_pool = connection_pool(account_id)
+        # 'notify' or 'status' while we're watching the account's folders,
+        # None otherwise. Folder engines only rely on us to wake them up
+        # while this is set.
+        self.mode = None
+        # Last STATUS response for each folder, when sweeping.
+        self.folder_status = {}
+        self.log = log.new(account_id=account_id, component='change watcher')
+        Greenlet.__init__(self)
+
+    def _run(self):
+        return retry_with_logging(self._run_impl, account_id=self.account_id,
+                                  provider=self.provider_name,
+                                  logger=self.log)
+
+    def _run_impl(self):
+        try:
+            with self.conn_pool.get() as crispin_client:
+                if crispin_client.notify_supported():
+                    self.mode = 'notify'
+                elif crispin_client.condstore_supported():
+                    self.mode = 'status'
+                else:
+                    self.log.info('Server supports neither NOTIFY nor '
+                                  'CONDSTORE, not watching folders')
+                    return
+            if self.mode == 'notify':
+                self.watch_notify()
+            self.watch_status()
+        finally:
+            self.mode = None
+
+    def polling_engines(self):
+        return {engine.folder_name: engine for engine in self.folder_monitors
+                if engine.state == 'poll' and not engine.ready()}
+
+    def watch_notify(self):
+        """
+        Wait for NOTIFY events, waking up engines as they come in. Returns
+        if the server rejects our NOTIFY request, so that the caller can
+        fall back to STATUS sweeps.
+
+        """
+        with self.conn_pool.get() as crispin_client:
+            watched = set()
+            while True:
+                engines = self.polling_engines()
+                if not engines:
+                    sleep(NOTIFY_IDLE_WAIT)
+                    continue
+                if set(engines) != watched:
+                    if not crispin_client.notify_set(list(engines)):
+                        self.mode = 'status'
+                        return
+                    watched = set(engines)
+                    self.log.info('Watching folders with NOTIFY',
+                                  folder_count=len(watched))
+                responses = crispin_client.idle(NOTIFY_IDLE_WAIT)
+                changed = parse_notify_status(responses)
+                # Changes to the selected folder are reported as regular
+                # EXISTS, EXPUNGE and FETCH responses instead of STATUS.
+                selected = crispin_client.selected_folder_name
+                if (selected is not None and
+                        selected_folder_changed(responses)):
+                    changed.add(selected)
+                for folder_name in changed:
+                    if folder_name in engines:
+                        engines[folder_name].wakeup.set()
+
+    def watch_status(self):
+        while True:
+            engines = self.polling_engines()
+            with self.conn_pool.get() as crispin_client:
+                for folder_name, engine in engines.iteritems():
+                    if self.folder_changed(crispin_client, folder_name):
+                        engine.wakeup.set()
+            sleep(STATUS_SWEEP_FREQUENCY)
+
+    def folder_changed(self, crispin_client, folder_name):
+        try:
+            status = crispin_client.conn.folder_status(folder_name,
+                                                       STATUS_SWEEP_ITEMS)
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:
+            # E.g. the folder was deleted. Let its engine sort it out.
+            self.folder_status.pop(folder_name, None)
+            return True
+        status = tuple(status.get(item) for item in STATUS_SWEEP_ITEMS)
+        previous = self.folder_status.get(folder_name)
+        self.folder_status[folder_name] = status
+        # We also wake up engines the first time we see their folder, in case
+        # it changed between their last poll and our first sweep.
+        return status != previous
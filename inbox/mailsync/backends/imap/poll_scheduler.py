@@ -0,0 +1,60 @@
+"""
+Activity-adaptive poll intervals for folder sync engines.
+
+Most folders (archives, old project folders, ...) almost never change, but
+used to be polled just as often as the inbox. PollScheduler tracks whether
+each poll found changes, and backs the poll interval off exponentially while
+the folder stays quiet, snapping back to the base interval as soon as there
+is activity.
+
+"""
+from datetime import datetime
+
+
+class PollScheduler(object):
+    """
+    Parameters
+    ----------
+    min_interval: int
+        Poll interval (in seconds) for a folder with recent activity.
+    max_interval: int
+        Ceiling for the backed-off poll interval.
+    backoff: int
+        Factor to grow the interval by after each poll without changes.
+
+    """
+
+    def __init__(self, min_interval, max_interval, backoff=2):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.interval = min_interval
+        self.last_change_at = None
+        self._changed = False
+
+    def record_change(self):
+        """Note that the current poll found changes."""
+        self._changed = True
+        self.last_change_at = datetime.utcnow()
+
+    def reset(self):
+        """
+        Go back to polling at the base interval, e.g. because the user took
+        an action on the account and is likely to expect updates soon.
+
+        """
+        self._changed = True
+
+    def next_interval(self):
+        """
+        Return how long to wait before the next poll. Should be called once
+        after every poll.
+
+        """
+        if self._changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+        self._changed = False
+        return self.interval
@@ -0,0 +1,130 @@
+"""
+Compact in-memory index of the UIDs we have saved for a folder.
+
+Folder sync engines repeatedly need to diff the folder's saved UIDs against
+the UIDs the server reports. Holding them as a Python set of longs costs
+tens of bytes per UID, which adds up to hundreds of MB for folders with
+millions of messages. UidIndex instead keeps them in a sorted array of
+unsigned 32-bit integers (IMAP UIDs are defined as 32-bit), at 4 bytes per
+UID, and uses binary search for lookups.
+
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+
+# Unsigned int, which is at least 32 bits wide on all supported platforms.
+TYPECODE = 'I'
+# Removing more UIDs than this at once rebuilds the array in a single pass
+# rather than deleting entries one by one.
+REBUILD_THRESHOLD = 64
+
+
+class UidIndex(object):
+    """
+    A sorted set of UIDs, backed by an array.
+
+    Parameters
+    ----------
+    uids: iterable
+        Initial UIDs. Loading is cheapest if they are already sorted in
+        ascending order, but this is not required.
+
+    """
+
+    def __init__(self, uids=()):
+        self._uids = array(TYPECODE, uids)
+        if any(self._uids[i] >= self._uids[i + 1]
+               for i in xrange(len(self._uids) - 1)):
+            self._uids = array(TYPECODE, sorted(set(self._uids)))
+
+    def __len__(self):
+        return len(self._uids)
+
+    def __iter__(self):
+        return iter(self._uids)
+
+    def __contains__(self, uid):
+        i = bisect_left(self._uids, uid)
+        return i < len(self._uids) and self._uids[i] == uid
+
+    def __eq__(self, other):
+        return isinstance(other, UidIndex) and self._uids == other._uids
+
+    def __ne__(self, other):
+        return not self == other
+
+    def max(self):
+        """Return the highest UID in the index, or 0 if it is empty."""
+        return self._uids[-1] if self._uids else 0
+
+    def top(self, count):
+        """Return the `count` highest UIDs, in ascending order."""
+        return list(self._uids[-count:]) if count else []
+
+    def update(self, uids):
+        """Add `uids` to the index."""
+        new_uids = sorted(set(uids))
+        if not new_uids:
+            return
+        if not self._uids or new_uids[0] > self._uids[-1]:
+            # The common case: newly saved messages have higher UIDs than
+            # anything we already have.
+            self._uids.extend(new_uids)
+            return
+        new_uids = [uid for uid in new_uids if uid not in self]
+        if new_uids:
+            self._uids = array(TYPECODE, sorted(self._uids.tolist() +
+                                                new_uids))
+
+    def difference_update(self, uids):
+        """Remove `uids` from the index, ignoring UIDs we don't have."""
+        uids = set(uids)
+        if len(uids) > REBUILD_THRESHOLD:
+            self._uids = array(TYPECODE,
+                               (uid for uid in self._uids if uid not in uids))
+            return
+        for uid in uids:
+            i = bisect_left(self._uids, uid)
+            if i < len(self._uids) and self._uids[i] == uid:
+                del self._uids[i]
+
+    def difference(self, uids):
+        """
+        Return the UIDs in the index which are not in `uids` (typically, the
+        UIDs the server reports), in ascending order.
+
+        """
+        return list(_sorted_difference(self._uids, sorted(set(uids))))
+
+    def in_ranges(self, ranges):
+        """
+        Return the UIDs in the index which fall within `ranges`, a sequence
+        of (start, end) pairs with both ends inclusive, in ascending order.
+        Ranges may be arbitrarily large: only the UIDs we have are visited.
+
+        """
+        uids = set()
+        for start, end in ranges:
+            i = bisect_left(self._uids, start)
+            j = bisect_right(self._uids, end)
+            uids.update(self._uids[i:j])
+        return sorted(uids)
+
+    def missing(self, uids):
+        """
+        Return the UIDs in `uids` which are not in the index, in ascending
+        order.
+
+        """
+        return list(_sorted_difference(sorted(set(uids)), self._uids))
+
+
+def _sorted_difference(a, b):
+    """Yield the elements of sorted sequence `a` not in sorted sequence `b`."""
+    j = 0
+    len_b = len(b)
+    for x in a:
+        while j < len_b and b[j] < x:
+            j += 1
+        if j == len_b or b[j] != x:
+            yield x
@@ -1,8 +1,6 @@
 import os
-import binascii
 import datetime
 import itertools
-from hashlib import sha256
 from collections import defaultdict
 
 from flanker import mime
@@ -16,11 +14,11 @@ from sqlalchemy.ext.associationproxy import association_proxy
 
 from nylas.logging import get_logger
 log = get_logger()
-from inbox.util.html import plaintext2html, strip_tags
 from inbox.sqlalchemy_ext.util import JSON, json_field_too_long, bakery
-from inbox.util.addr import parse_mimepart_address_header
-from inbox.util.misc import parse_references, get_internaldate
 from inbox.util.blockstore import save_to_blockstore
+from inbox.util.mime_parse import (parse_message, parse_metadata,
+                                   html_snippet, plaintext_snippet,
+                                   PARSE_ERRORS)
 from inbox.security.blobstorage import encode_blob, decode_blob
 from inbox.models.mixins import (HasPublicID, HasRevisions, UpdatedAtMixin,
                                  DeletedAtMixin)
@@ -30,8 +28,6 @@ from inbox.models.category import Category
 from inbox.sqlalchemy_ext.util import MAX_MYSQL_INTEGER
 from inbox.util.encoding import unicode_safe_truncate
 
-SNIPPET_LENGTH = 191
-
 
 def _trim_filename(s, namespace_id, max_len=255):
     if s is None:
@@ -143,6 +139,11 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
     _compacted_body = Column(LONGBLOB, nullable=True)
     snippet = Column(String(191), nullable=False)
 
+    # Set on messages synced header-first, until the full body is fetched from
+    # the provider. Such messages have no body or parts yet, only headers and
+    # a snippet.
+    body_pending = Column(Boolean, server_default=false(), nullable=False)
+
     # this might be a mail-parsing bug, or just a message from a bad client
     decode_error = Column(Boolean, server_default=false(), nullable=False,
                           index=True)
@@ -251,7 +252,13 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
 
         msg = Message()
 
-        msg.data_sha256 = sha256(body_string).hexdigest()
+        # Large messages are parsed in a worker process, see
+        # inbox.util.mime_parse.
+        result = parse_message(body_string, received_date=received_date,
+                               account_id=account.id,
+                               folder_name=folder_name, mid=mid,
+                               stream_attachments=True)
+        msg.data_sha256 = result['data_sha256']
 
         # Persist the raw MIME message to disk/ S3
         save_to_blockstore(msg.data_sha256, body_string)
@@ -259,174 +266,148 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
         # Persist the processed message to the database
         msg.namespace_id = account.namespace.id
 
+        # If parsing failed, this is whatever was parsed before the error.
+        for key, value in result['metadata'].iteritems():
+            setattr(msg, key, value)
+
+        if result['headers'] is None:
+            # Non-persisted instance attribute used by EAS.
+            msg.parsed_body = ''
+            msg._mark_error()
+            return msg
+
+        # Non-persisted instance attribute used by EAS. Only its headers
+        # are used, so we don't need the full parse.
+        msg.parsed_body = mime.from_string(result['headers'])
+        msg._apply_body(result)
+        msg._check_field_lengths(account.id, folder_name, mid)
+        return msg
+
+    @classmethod
+    def create_from_headers(cls, account, mid, folder_name, received_date,
+                            header_string, size, preview):
+        """
+        Like create_from_synced(), but for header-first sync: creates a
+        body-pending Message from just the message's header block, its size
+        and a short plaintext preview of its first text part. The body and
+        attachments are filled in later by load_body().
+
+        Parameters
+        ----------
+        header_string : str
+            The message's header block (encoded).
+        size : int
+            The size of the full message, i.e. its RFC822.SIZE.
+        preview : unicode or None
+            The start of the message text, used for the snippet.
+
+        """
+        _rqd = [account, mid, folder_name, header_string]
+        if not all([v is not None for v in _rqd]):
+            raise ValueError(
+                'Required keyword arguments: account, mid, folder_name, '
+                'header_string')
+        assert account.namespace is not None
+        assert not isinstance(header_string, unicode)
+
+        msg = Message()
+        msg.namespace_id = account.namespace.id
+        msg.body_pending = True
+
+        metadata = {}
+        parse_error = False
         try:
-            parsed = mime.from_string(body_string)
+            parsed = mime.from_string(header_string)
             # Non-persisted instance attribute used by EAS.
             msg.parsed_body = parsed
-            msg._parse_metadata(parsed, body_string, received_date, account.id,
-                                folder_name, mid)
-        except (mime.DecodingError, AttributeError, RuntimeError,
-                TypeError) as e:
-            parsed = None
-            # Non-persisted instance attribute used by EAS.
+            parse_metadata(parsed, header_string, received_date, account.id,
+                           folder_name, mid, metadata)
+        except PARSE_ERRORS as e:
             msg.parsed_body = ''
             log.error('Error parsing message metadata',
                       folder_name=folder_name, account_id=account.id, error=e)
-            msg._mark_error()
+            parse_error = True
 
-        if parsed is not None:
-            plain_parts = []
-            html_parts = []
-            for mimepart in parsed.walk(
-                    with_self=parsed.content_type.is_singlepart()):
-                try:
-                    if mimepart.content_type.is_multipart():
-                        continue  # TODO should we store relations?
-                    msg._parse_mimepart(mid, mimepart, account.namespace.id,
-                                        html_parts, plain_parts)
-                except (mime.DecodingError, AttributeError, RuntimeError,
-                        TypeError, binascii.Error, UnicodeDecodeError) as e:
-                    log.error('Error parsing message MIME parts',
-                              folder_name=folder_name, account_id=account.id,
-                              error=e)
-                    msg._mark_error()
-            msg.calculate_body(html_parts, plain_parts)
-
-            # Occasionally people try to send messages to way too many
-            # recipients. In such cases, empty the field and treat as a parsing
-            # error so that we don't break the entire sync.
-            for field in ('to_addr', 'cc_addr', 'bcc_addr', 'references',
-                          'reply_to'):
-                value = getattr(msg, field)
-                if json_field_too_long(value):
-                    log.error('Recipient field too long', field=field,
-                              account_id=account.id, folder_name=folder_name,
-                              mid=mid)
-                    setattr(msg, field, [])
-                    msg._mark_error()
+        # If parsing failed, this is whatever was parsed before the error.
+        for key, value in metadata.iteritems():
+            setattr(msg, key, value)
+        if parse_error:
+            msg._mark_error()
+        else:
+            msg._check_field_lengths(account.id, folder_name, mid)
 
+        if not msg.decode_error:
+            msg.size = size or 0
+        msg.body = u''
+        msg.snippet = msg.calculate_plaintext_snippet(preview or u'')
         return msg
 
-    def _parse_metadata(self, parsed, body_string, received_date,
-                        account_id, folder_name, mid):
-        mime_version = parsed.headers.get('Mime-Version')
-        # sometimes MIME-Version is '1.0 (1.0)', hence the .startswith()
-        if mime_version is not None and not mime_version.startswith('1.0'):
-            log.warning('Unexpected MIME-Version',
-                        account_id=account_id, folder_name=folder_name,
-                        mid=mid, mime_version=mime_version)
-
-        self.subject = parsed.subject
-        self.from_addr = parse_mimepart_address_header(parsed, 'From')
-        self.sender_addr = parse_mimepart_address_header(parsed, 'Sender')
-        self.reply_to = parse_mimepart_address_header(parsed, 'Reply-To')
-        self.to_addr = parse_mimepart_address_header(parsed, 'To')
-        self.cc_addr = parse_mimepart_address_header(parsed, 'Cc')
-        self.bcc_addr = parse_mimepart_address_header(parsed, 'Bcc')
-
-        self.in_reply_to = parsed.headers.get('In-Reply-To')
-
-        # The RFC mandates that the Message-Id header must be at most 998
-        # characters. Sadly, not everybody follows specs.
-        self.message_id_header = parsed.headers.get('Message-Id')
-        if self.message_id_header and len(self.message_id_header) > 998:
-            self.message_id_header = self.message_id_header[:998]
-            log.warning('Message-Id header too long. Truncating',
-                        parsed.headers.get('Message-Id'),
-                        logstash_tag='truncated_message_id')
-
-        self.received_date = received_date if received_date else \
-            get_internaldate(parsed.headers.get('Date'),
-                             parsed.headers.get('Received'))
-
-        # It seems MySQL rounds up fractional seconds in a weird way,
-        # preventing us from reconciling messages correctly. See:
-        # https://github.com/nylas/sync-engine/commit/ed16b406e0a for
-        # more details.
-        self.received_date = self.received_date.replace(microsecond=0)
-
-        # Custom Nylas header
-        self.nylas_uid = parsed.headers.get('X-INBOX-ID')
-
-        # In accordance with JWZ (http://www.jwz.org/doc/threading.html)
-        self.references = parse_references(
-            parsed.headers.get('References', ''),
-            parsed.headers.get('In-Reply-To', ''))
-
-        self.size = len(body_string)  # includes headers text
-
-    def _parse_mimepart(self, mid, mimepart, namespace_id, html_parts,
-                        plain_parts):
-        disposition, _ = mimepart.content_disposition
-        content_id = mimepart.headers.get('Content-Id')
-        content_type, params = mimepart.content_type
-
-        filename = mimepart.detected_file_name
-        if filename == '':
-            filename = None
-
-        data = mimepart.body
-
-        is_text = content_type.startswith('text')
-        if disposition not in (None, 'inline', 'attachment'):
-            log.error('Unknown Content-Disposition',
-                      message_public_id=self.public_id,
-                      bad_content_disposition=mimepart.content_disposition)
-            self._mark_error()
-            return
-
-        if disposition == 'attachment':
-            self._save_attachment(data, disposition, content_type,
-                                  filename, content_id, namespace_id, mid)
-            return
+    def load_body(self, body_string):
+        """
+        Parse the full MIME message `body_string` into the body and parts of
+        a message created by create_from_headers(), and persist it to the
+        blockstore.
 
-        if (disposition == 'inline' and
-                not (is_text and filename is None and content_id is None)):
-            # Some clients set Content-Disposition: inline on text MIME parts
-            # that we really want to treat as part of the text body. Don't
-            # treat those as attachments.
-            self._save_attachment(data, disposition, content_type,
-                                  filename, content_id, namespace_id, mid)
+        """
+        assert not isinstance(body_string, unicode)
+        result = parse_message(body_string,
+                               account_id=self.namespace.account.id,
+                               mid=self.id, metadata=False,
+                               stream_attachments=True)
+        self.data_sha256 = result['data_sha256']
+        save_to_blockstore(self.data_sha256, body_string)
+        self.size = len(body_string)
+        self.body_pending = False
+
+        if result['body'] is None:
+            self._mark_error()
             return
+        self._apply_body(result)
 
-        if is_text:
-            if data is None:
-                return
-            normalized_data = data.encode('utf-8', 'strict')
-            normalized_data = normalized_data.replace('\r\n', '\n'). \
-                replace('\r', '\n')
-            if content_type == 'text/html':
-                html_parts.append(normalized_data)
-            elif content_type == 'text/plain':
-                plain_parts.append(normalized_data)
-            else:
-                log.info('Saving other text MIME part as attachment',
-                         content_type=content_type, namespace_id=namespace_id)
-                self._save_attachment(data, 'attachment', content_type,
-                                      filename, content_id, namespace_id, mid)
-            return
+    def _apply_body(self, result):
+        """
+        Set the body and snippet, and create the Parts and Blocks for the
+        attachments, from the result of parse_message().
 
-        # Finally, if we get a non-text MIME part without Content-Disposition,
-        # treat it as an attachment.
-        self._save_attachment(data, 'attachment', content_type,
-                              filename, content_id, namespace_id, mid)
+        """
+        for attachment in result['attachments']:
+            self._save_attachment(**attachment)
+        self.body = result['body']
+        self.snippet = result['snippet']
+        if result['decode_error']:
+            self._mark_error()
 
-    def _save_attachment(self, data, content_disposition, content_type,
-                         filename, content_id, namespace_id, mid):
+    def _check_field_lengths(self, account_id, folder_name, mid):
+        # Occasionally people try to send messages to way too many
+        # recipients. In such cases, empty the field and treat as a parsing
+        # error so that we don't break the entire sync.
+        for field in ('to_addr', 'cc_addr', 'bcc_addr', 'references',
+                      'reply_to'):
+            value = getattr(self, field)
+            if json_field_too_long(value):
+                log.error('Recipient field too long', field=field,
+                          account_id=account_id, folder_name=folder_name,
+                          mid=mid)
+                setattr(self, field, [])
+                self._mark_error()
+
+    def _save_attachment(self, data, data_sha256, size, content_disposition,
+                         content_type, filename, content_id):
         from inbox.models import Part, Block
         block = Block()
-        block.namespace_id = namespace_id
-        block.filename = _trim_filename(filename, namespace_id=namespace_id)
+        block.namespace_id = self.namespace_id
+        block.filename = _trim_filename(filename,
+                                        namespace_id=self.namespace_id)
         block.content_type = content_type
         part = Part(block=block, message=self)
-        if content_id:
-            content_id = content_id[:255]
         part.content_id = content_id
         part.content_disposition = content_disposition
-        data = data or ''
-        if isinstance(data, unicode):
-            data = data.encode('utf-8', 'strict')
-        block.data = data
+        if data is None:
+            # Streamed to the blockstore by the parser.
+            block.size = size
+            block.data_sha256 = data_sha256
+        else:
+            block.set_data(data, data_sha256)
 
     def _mark_error(self):
         """
@@ -450,25 +431,11 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
         if self.snippet is None:
             self.snippet = ''
 
-    def calculate_body(self, html_parts, plain_parts):
-        html_body = ''.join(html_parts).decode('utf-8').strip()
-        plain_body = '\n'.join(plain_parts).decode('utf-8').strip()
-        if html_body:
-            self.snippet = self.calculate_html_snippet(html_body)
-            self.body = html_body
-        elif plain_body:
-            self.snippet = self.calculate_plaintext_snippet(plain_body)
-            self.body = plaintext2html(plain_body, False)
-        else:
-            self.body = u''
-            self.snippet = u''
-
     def calculate_html_snippet(self, text):
-        text = strip_tags(text)
-        return self.calculate_plaintext_snippet(text)
+        return html_snippet(text)
 
     def calculate_plaintext_snippet(self, text):
-        return unicode_safe_truncate(' '.join(text.split()), SNIPPET_LENGTH)
+        return plaintext_snippet(text)
 
     @property
     def body(self):
@@ -17,7 +17,7 @@ def load_models():
     from inbox.models.namespace import Namespace
     from inbox.models.search import ContactSearchIndexCursor
     from inbox.models.secret import Secret
-    from inbox.models.thread import Thread
+    from inbox.models.thread import Thread, ThreadReference
     from inbox.models.transaction import Transaction, AccountTransaction
     from inbox.models.when import When, Time, TimeSpan, Date, DateSpan
     from inbox.models.label import Label
@@ -27,6 +27,7 @@ def load_models():
                MessageContactAssociation, Contact, PhoneNumber, Calendar,
                DataProcessingCache, Event, Folder,
                Message, Namespace, ContactSearchIndexCursor, Secret,
-               Thread, Transaction, When, Time, TimeSpan, Date, DateSpan,
-               Label, Category, MessageCategory, Metadata, AccountTransaction]
+               Thread, ThreadReference, Transaction, When, Time, TimeSpan,
+               Date, DateSpan, Label, Category, MessageCategory, Metadata,
+               AccountTransaction]
     return exports
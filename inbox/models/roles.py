@@ -112,6 +112,14 @@ class Blob(object):
 
     @data.setter
     def data(self, value):
+        self.set_data(value)
+
+    def set_data(self, value, data_sha256=None):
+        """
+        Like setting `data`, but `data_sha256` can be passed if the hash of
+        `value` has been computed already (e.g. by a MIME parse worker).
+
+        """
         assert value is not None
         assert type(value) is not unicode
 
@@ -119,7 +127,7 @@ class Blob(object):
         # roundtrip.
         self._data = value
         self.size = len(value)
-        self.data_sha256 = sha256(value).hexdigest()
+        self.data_sha256 = data_sha256 or sha256(value).hexdigest()
         assert self.data_sha256
 
         if len(value) == 0:
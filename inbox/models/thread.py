@@ -2,7 +2,8 @@ import datetime
 import itertools
 from collections import defaultdict
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
+from sqlalchemy import (Column, Integer, BigInteger, String, DateTime,
+                        ForeignKey, Index, func)
 from sqlalchemy.orm import (relationship, backref, validates, object_session,
                             subqueryload)
 
@@ -44,14 +45,26 @@ class Thread(MailSyncBase, HasPublicID, HasRevisions, UpdatedAtMixin,
     recentdate = Column(DateTime, nullable=False, index=True)
     snippet = Column(String(191), nullable=True, default='')
     version = Column(Integer, nullable=True, server_default='0')
+    # Number of messages in the thread, maintained as messages are added to
+    # and removed from `messages` so that threading doesn't need to count
+    # or load them. NULL for threads created before this column existed;
+    # see get_message_count().
+    message_count = Column(Integer, nullable=True)
 
     @validates('subject')
     def compute_cleaned_up_subject(self, key, value):
         self._cleaned_subject = cleanup_subject(value)
         return value
 
-    @validates('messages')
-    def update_from_message(self, k, message):
+    @validates('messages', include_removes=True)
+    def update_from_message(self, k, message, is_remove):
+        if self.message_count is None and self.id is None:
+            self.message_count = 0
+        if self.message_count is not None:
+            self.message_count += -1 if is_remove else 1
+        if is_remove:
+            return message
+
         with object_session(self).no_autoflush:
             if message.is_draft:
                 # Don't change subjectdate, recentdate, or unread/unseen based
@@ -68,6 +81,22 @@ class Thread(MailSyncBase, HasPublicID, HasRevisions, UpdatedAtMixin,
                 self.subjectdate = message.received_date
             return message
 
+    def get_message_count(self):
+        """
+        Return the number of messages in the thread without loading them.
+        For threads which predate the message_count column, count them once
+        and store the result.
+
+        """
+        if self.message_count is None:
+            from inbox.models.message import Message
+            db_session = object_session(self)
+            with db_session.no_autoflush:
+                self.message_count, = db_session.query(
+                    func.count(Message.id)).filter(
+                        Message.thread_id == self.id).one()
+        return self.message_count
+
     @property
     def most_recent_received_date(self):
         received_recent_date = None
@@ -204,3 +233,24 @@ Index('ix_cleaned_subject', Thread._cleaned_subject, mysql_length=191)
 # For async deletion.
 Index('ix_thread_namespace_id_deleted_at', Thread.namespace_id,
       Thread.deleted_at)
+
+
+class ThreadReference(MailSyncBase):
+    """
+    Threading index: the Message-IDs of a thread's messages, and the
+    Message-IDs they refer to (through In-Reply-To and References). A new
+    message belongs to the thread of any message it refers to or which refers
+    to it, as in JWZ threading (http://www.jwz.org/doc/threading.html).
+    See inbox.util.threading.
+
+    """
+    namespace_id = Column(BigInteger, nullable=False)
+    thread_id = Column(ForeignKey(Thread.id, ondelete='CASCADE'),
+                       nullable=False, index=True)
+    thread = relationship(Thread, load_on_pending=True)
+    # Message-IDs can be up to 998 characters long, so we index the hex
+    # SHA-256 digest instead.
+    message_id_hash = Column(String(64), nullable=False)
+
+Index('ix_threadreference_namespace_id_message_id_hash',
+      ThreadReference.namespace_id, ThreadReference.message_id_hash)
@@ -32,6 +32,9 @@ def reconcile_message(new_message, session):
     from inbox.models.message import Message
 
     if new_message.nylas_uid is None:
+        if new_message.data_sha256 is None:
+            # Synced header-first, so there's no hash to go on yet.
+            return None
         # try to reconcile using other means
         q = session.query(Message).filter(
             Message.namespace_id == new_message.namespace_id,
@@ -166,8 +169,9 @@ def delete_namespace(namespace_id, throttle=False, dry_run=False):
     # we include here for simplicity anyway.
 
     filters = OrderedDict()
-    for table in ['message', 'block', 'thread', 'transaction', 'actionlog',
-                  'contact', 'event', 'dataprocessingcache']:
+    for table in ['message', 'block', 'threadreference', 'thread',
+                  'transaction', 'actionlog', 'contact', 'event',
+                  'dataprocessingcache']:
         filters[table] = ('namespace_id', namespace_id)
 
     if account_discriminator == 'easaccount':
@@ -1,6 +1,7 @@
 import imapclient
 from inbox.s3.exc import EmailFetchException, EmailDeletedException
 from inbox.crispin import connection_pool
+from inbox.connection_broker import PRIORITY_HIGH
 from inbox.mailsync.backends.imap.generic import uidvalidity_cb
 
 from nylas.logging import get_logger
@@ -16,7 +17,8 @@ def get_imap_raw_contents(message):
     uid = message.imapuids[0]
     folder = uid.folder
 
-    with connection_pool(account.id).get() as crispin_client:
+    # Someone's waiting for this message.
+    with connection_pool(account.id).get(PRIORITY_HIGH) as crispin_client:
         crispin_client.select_folder(folder.name, uidvalidity_cb)
 
         try:
@@ -2,3 +2,22 @@ def get_raw_from_provider(message):
     """Get the raw contents of a message from the provider."""
     account = message.account
     return account.get_raw_message_contents(message)
+
+
+def load_pending_body(db_session, message, raw_message=None):
+    """
+    Fill in the body and attachments of a message that was synced
+    header-first, fetching it from the provider unless `raw_message` is given.
+    Raises the same exceptions as get_raw_from_provider().
+
+    """
+    # Imported here to avoid an import cycle through inbox.models.
+    from inbox.events.ical import import_attached_events
+
+    if raw_message is None:
+        raw_message = get_raw_from_provider(message)
+    message.load_body(raw_message)
+    db_session.flush()
+    if message.has_attached_events:
+        with db_session.no_autoflush:
+            import_attached_events(db_session, message.account, message)
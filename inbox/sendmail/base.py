@@ -315,6 +315,9 @@ def delete_draft(db_session, account, draft):
                     nylas_uid=draft.nylas_uid,
                     message_id_header=draft.message_id_header)
 
+    # Remove the draft from its thread too, so that the thread's
+    # message_count stays accurate.
+    thread.messages.remove(draft)
     db_session.delete(draft)
 
     # Delete the thread if it would now be empty.
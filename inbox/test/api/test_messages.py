@@ -1,7 +1,9 @@
 # flake8: noqa: F811
+import re
 import json
 import mock
 import pytest
+from datetime import datetime
 
 from inbox.api.ns_api import API_VERSIONS
 from inbox.util.blockstore import get_from_blockstore
@@ -104,6 +106,34 @@ def test_direct_fetching(stub_message_from_raw, api_client, mime_message,
     assert resp.data == 'Return contents'
 
 
+def test_body_pending_message_fetched_on_read(db, default_account, thread,
+                                              api_client, mime_message,
+                                              monkeypatch):
+    from inbox.models import Message
+    raw_message = mime_message.to_string()
+    headers = re.split(r'\r?\n\r?\n', raw_message, 1)[0]
+    message = Message.create_from_headers(
+        default_account, 139219, '[Gmail]/All Mail',
+        datetime(2014, 9, 22, 17, 25, 46), headers, len(raw_message),
+        u'Hello World!')
+    message.thread = thread
+    db.session.add(message)
+    db.session.commit()
+    assert message.body_pending
+    assert message.snippet == 'Hello World!'
+
+    raw_mock = mock.Mock(return_value=raw_message)
+    monkeypatch.setattr('inbox.s3.backends.gmail.get_gmail_raw_contents',
+                        raw_mock)
+
+    resp = api_client.get_data('/messages/{}'.format(message.public_id))
+    assert raw_mock.called
+    assert resp['body'] == '<html>Hello World!</html>'
+    db.session.expire_all()
+    assert not message.body_pending
+    assert get_from_blockstore(message.data_sha256) == raw_message
+
+
 @pytest.mark.parametrize("api_version", API_VERSIONS)
 def test_sender_and_participants(stub_message, api_client, api_version):
     headers = dict()
@@ -0,0 +1,67 @@
+"""
+Benchmark for looking up which of a batch of g_msgids we've already synced,
+over a synthetic namespace with millions of messages.
+
+Not collected as part of the regular test run; invoke explicitly with e.g.
+
+    py.test -s inbox/test/benchmarks/bench_g_msgids.py
+
+Set BENCH_G_MSGID_ROWS to change the namespace size. Populating it takes a
+while; the rows are committed, so use a throwaway test database.
+"""
+import os
+import time
+from datetime import datetime
+
+from inbox.mailsync.backends.gmail import g_msgids
+from inbox.models import Message
+from inbox.util.itert import chunk
+
+ROW_COUNT = int(os.environ.get('BENCH_G_MSGID_ROWS', 3000000))
+INSERT_CHUNK_SIZE = 10000
+LOOKUP_SIZES = [100, 1000, 10000, 100000]
+
+
+def scan_g_msgids(namespace_id, session, in_):
+    # The previous implementation for more than 1000 values: load all of the
+    # namespace's g_msgids and filter them in Python.
+    in_ = {long(i) for i in in_}
+    query = session.query(Message.g_msgid). \
+        filter(Message.namespace_id == namespace_id).all()
+    return {g_msgid for g_msgid, in query if g_msgid in in_}
+
+
+def populate(db, namespace_id, thread_id):
+    existing = db.session.query(Message).filter(
+        Message.namespace_id == namespace_id).count()
+    now = datetime.utcnow()
+    for g_msgid_chunk in chunk(xrange(existing, ROW_COUNT), INSERT_CHUNK_SIZE):
+        db.session.execute(Message.__table__.insert(), [
+            {'namespace_id': namespace_id, 'thread_id': thread_id,
+             'received_date': now, 'size': 0, 'snippet': '',
+             'g_msgid': 2 * g_msgid} for g_msgid in g_msgid_chunk])
+        db.session.commit()
+
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    result = f(*args, **kwargs)
+    return result, time.time() - start
+
+
+def test_g_msgids_lookup(db, default_namespace, thread):
+    populate(db, default_namespace.id, thread.id)
+    print '\n{} messages in namespace'.format(ROW_COUNT)
+    for lookup_size in LOOKUP_SIZES:
+        # Saved g_msgids are the even numbers below 2 * ROW_COUNT, so half of
+        # these exist.
+        in_ = range(ROW_COUNT, ROW_COUNT + lookup_size)
+        expected, scan_time = timed(scan_g_msgids, default_namespace.id,
+                                    db.session, in_)
+        print 'lookup_size={}: full scan {:.2f}s'.format(lookup_size,
+                                                         scan_time)
+        for chunk_size in (100, 1000, 5000):
+            found, elapsed = timed(g_msgids, default_namespace.id,
+                                   db.session, in_, chunk_size=chunk_size)
+            assert found == expected
+            print '    chunk_size={}: {:.2f}s'.format(chunk_size, elapsed)
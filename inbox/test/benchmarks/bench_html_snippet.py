@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for computing snippets of HTML message bodies: stripping the tags
+of the whole body versus extracting just enough text for the snippet.
+
+Not collected as part of the regular test run; invoke explicitly with e.g.
+
+    py.test -s inbox/test/benchmarks/bench_html_snippet.py
+
+The built-in corpus imitates common kinds of HTML mail (marketing
+newsletters with large <style> blocks and nested layout tables, receipts,
+short replies). Set BENCH_HTML_CORPUS to a directory of .html files (e.g.
+text/html parts extracted from a real mailbox) to run on those instead.
+"""
+import os
+import time
+
+from inbox.util.encoding import unicode_safe_truncate
+from inbox.util.html import strip_tags, extract_snippet_text
+from inbox.util.mime_parse import SNIPPET_LENGTH
+
+CORPUS_DIR = os.environ.get('BENCH_HTML_CORPUS')
+REPETITIONS = 5
+
+NEWSLETTER_STYLE = u''.join(
+    u'.col-{0} {{ width: {0}%; padding: 0 {0}px; font-family: Helvetica, '
+    u'Arial, sans-serif; }}\n'.format(i) for i in range(1, 400))
+NEWSLETTER_ITEM = (
+    u'<table role="presentation" cellpadding="0" cellspacing="0" '
+    u'width="100%"><tr><td class="col-50" style="padding:10px 0;">'
+    u'<a href="https://example.com/p/{0}?utm_source=newsletter">'
+    u'<img src="https://example.com/img/{0}.jpg" width="280" alt=""></a>'
+    u'</td><td class="col-50" style="padding:10px 0;"><h2>Product {0}'
+    u'</h2><p>Now only &euro;{0}.99 &mdash; free shipping &amp; returns.'
+    u'</p></td></tr></table>\n')
+RECEIPT_ROW = (u'<tr><td style="border-bottom:1px solid #eee">Item {0}</td>'
+               u'<td align="right">${0}.00</td></tr>\n')
+REPLY = (u'<div dir="ltr">Sounds good, see you then!<div><br></div>'
+         u'<div>Sent from my phone</div></div><br><div class="gmail_quote">'
+         u'<blockquote style="margin:0 0 0 .8ex">{0}</blockquote></div>')
+
+
+def newsletter(items):
+    return (u'<!DOCTYPE html><html><head><meta charset="utf-8">'
+            u'<title>This week&#39;s deals</title><style>' + NEWSLETTER_STYLE +
+            u'</style></head><body><div style="display:none">Don&#8217;t '
+            u'miss this week&#8217;s deals</div>' +
+            u''.join(NEWSLETTER_ITEM.format(i) for i in range(items)) +
+            u'</body></html>')
+
+
+def receipt(rows):
+    return (u'<html><body><p>Thanks for your order!</p><table>' +
+            u''.join(RECEIPT_ROW.format(i) for i in range(rows)) +
+            u'</table></body></html>')
+
+
+def corpus():
+    if CORPUS_DIR:
+        for name in sorted(os.listdir(CORPUS_DIR)):
+            if name.endswith('.html'):
+                with open(os.path.join(CORPUS_DIR, name)) as f:
+                    yield name, f.read().decode('utf-8', 'replace')
+        return
+    yield 'newsletter_50k', newsletter(80)
+    yield 'newsletter_500k', newsletter(1200)
+    yield 'receipt', receipt(200)
+    yield 'reply', REPLY.format(REPLY.format(u'Lunch on Friday?'))
+
+
+def snippet(text):
+    return unicode_safe_truncate(' '.join(text.split()), SNIPPET_LENGTH)
+
+
+def timed(f, *args):
+    start = time.time()
+    for _ in range(REPETITIONS):
+        result = f(*args)
+    return result, (time.time() - start) / REPETITIONS
+
+
+def test_html_snippet():
+    print
+    total_strip = total_extract = 0
+    for name, html in corpus():
+        stripped, strip_time = timed(strip_tags, html)
+        extracted, extract_time = timed(extract_snippet_text, html,
+                                        SNIPPET_LENGTH)
+        assert snippet(extracted) == snippet(stripped), name
+        total_strip += strip_time
+        total_extract += extract_time
+        print '{}: {} bytes, strip_tags {:.2f}ms, extract_snippet_text ' \
+            '{:.2f}ms'.format(name, len(html), strip_time * 1000,
+                              extract_time * 1000)
+    print 'total: strip_tags {:.2f}ms, extract_snippet_text {:.2f}ms'.format(
+        total_strip * 1000, total_extract * 1000)
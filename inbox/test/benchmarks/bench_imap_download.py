@@ -0,0 +1,65 @@
+"""
+Throughput benchmark for generic IMAP initial sync.
+
+Not collected as part of the regular test run; invoke explicitly with e.g.
+
+    py.test -s inbox/test/benchmarks/bench_imap_download.py
+
+The MockIMAPClient stands in for the IMAP server, with an artificial delay
+added to every command to simulate the network round trip to the provider.
+"""
+import time
+
+import gevent
+import pytest
+from gevent.lock import BoundedSemaphore
+
+from inbox.mailsync.backends.imap.generic import FolderSyncEngine
+from inbox.models import Folder
+from inbox.models.backends.imap import ImapFolderSyncStatus, ImapUid
+from inbox.test.imap.data import uid_data
+
+ROUND_TRIP_TIME = 0.05
+MESSAGE_COUNT = 200
+
+
+def add_round_trip_delay(conn, methods=('fetch', 'search', 'select_folder',
+                                        'folder_status')):
+    def delayed(method):
+        def wrapper(*args, **kwargs):
+            gevent.sleep(ROUND_TRIP_TIME)
+            return method(*args, **kwargs)
+        return wrapper
+    for name in methods:
+        setattr(conn, name, delayed(getattr(conn, name)))
+
+
+@pytest.mark.parametrize('max_download_count', [1, 10, 30])
+def test_generic_initial_sync_throughput(db, generic_account, mock_imapclient,
+                                         monkeypatch, max_download_count):
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.MAX_DOWNLOAD_COUNT',
+        max_download_count)
+    folder = Folder.find_or_create(db.session, generic_account, 'Inbox',
+                                   'inbox')
+    folder.imapsyncstatus = ImapFolderSyncStatus(account=generic_account)
+    db.session.commit()
+
+    mock_imapclient.add_folder_data(
+        folder.name, {uid: uid_data.example()
+                      for uid in range(1, MESSAGE_COUNT + 1)})
+    add_round_trip_delay(mock_imapclient)
+
+    engine = FolderSyncEngine(generic_account.id,
+                              generic_account.namespace.id, folder.name,
+                              generic_account.email_address, 'custom',
+                              BoundedSemaphore(1))
+    start = time.time()
+    engine.initial_sync()
+    elapsed = time.time() - start
+
+    assert db.session.query(ImapUid).filter(
+        ImapUid.folder_id == folder.id).count() == MESSAGE_COUNT
+    print '\nmax_download_count={}: {} messages in {:.2f}s ({:.1f} msgs/sec)' \
+        .format(max_download_count, MESSAGE_COUNT, elapsed,
+                MESSAGE_COUNT / elapsed)
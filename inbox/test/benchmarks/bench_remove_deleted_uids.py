@@ -0,0 +1,39 @@
+"""
+Benchmark for expunging many UIDs at once, e.g. when a user empties a large
+Trash folder.
+
+Not collected as part of the regular test run; invoke explicitly with e.g.
+
+    py.test -s inbox/test/benchmarks/bench_remove_deleted_uids.py
+
+A chunk size of 1 corresponds to the old one-transaction-per-UID behaviour.
+"""
+import time
+
+import pytest
+
+from inbox.mailsync.backends.imap.common import remove_deleted_uids
+from inbox.models.backends.imap import ImapUid
+from inbox.test.util.base import add_fake_imapuid, add_fake_message
+
+UID_COUNT = 2000
+
+
+@pytest.mark.parametrize('chunk_size', [1, 10, 100, 500])
+def test_remove_deleted_uids_throughput(db, default_account,
+                                        default_namespace, thread, folder,
+                                        chunk_size):
+    for msg_uid in range(1, UID_COUNT + 1):
+        message = add_fake_message(db.session, default_namespace.id, thread)
+        add_fake_imapuid(db.session, default_account.id, message, folder,
+                         msg_uid)
+
+    start = time.time()
+    remove_deleted_uids(default_account.id, folder.id,
+                        range(1, UID_COUNT + 1), chunk_size=chunk_size)
+    elapsed = time.time() - start
+
+    assert db.session.query(ImapUid).filter(
+        ImapUid.folder_id == folder.id).count() == 0
+    print '\nchunk_size={}: {} UIDs in {:.2f}s ({:.1f} UIDs/sec)'.format(
+        chunk_size, UID_COUNT, elapsed, UID_COUNT / elapsed)
@@ -0,0 +1,98 @@
+import os
+from hashlib import sha256
+
+import pytest
+
+from inbox.util import blockstore
+from inbox.util.blockstore import BlobCache, LocalBackend, ZLIB, RAW
+
+
+@pytest.fixture
+def backend(tmpdir):
+    return LocalBackend(compression='zlib', directory=str(tmpdir))
+
+
+def test_local_backend_round_trip(backend):
+    data = 'Hello, world! ' * 1000
+    h = sha256(data).hexdigest()
+    backend.save(h, data)
+
+    path = backend.path(h)
+    assert path.endswith(os.path.join(h[:2], h[2:4], h))
+    with open(path, 'rb') as f:
+        stored = f.read()
+    assert stored[:1] == ZLIB
+    assert len(stored) < len(data)
+    assert backend.get(h) == data
+    assert backend.get_many([h]) == {h: data}
+
+    # No temporary files are left behind.
+    assert os.listdir(os.path.dirname(path)) == [h]
+
+
+def test_local_backend_stores_incompressible_data_raw(backend):
+    data = os.urandom(4096)
+    h = sha256(data).hexdigest()
+    backend.save(h, data)
+    with open(backend.path(h), 'rb') as f:
+        assert f.read() == RAW + data
+    assert backend.get(h) == data
+
+
+def test_local_backend_skips_existing_blobs(backend):
+    data = 'attachment'
+    h = sha256(data).hexdigest()
+    backend.save(h, data)
+    os.utime(backend.path(h), (1000000000, 1000000000))
+    backend.save(h, data)
+    assert os.stat(backend.path(h)).st_mtime == 1000000000
+
+
+def test_local_backend_reads_legacy_blobs(config, monkeypatch):
+    monkeypatch.setattr(blockstore, '_backend', LocalBackend())
+    data = 'stored before switching backends'
+    h = sha256(data).hexdigest()
+    blockstore.DiskBackend().save(h, data)
+    assert blockstore.get_from_blockstore(h) == data
+    missing = sha256('missing').hexdigest()
+    assert blockstore.get_many_from_blockstore([h, missing]) == \
+        {h: data, missing: None}
+
+
+def test_blob_cache_evicts_least_recently_used():
+    cache = BlobCache(max_bytes=10, max_entry_bytes=5)
+    cache.put('a', 'aaaa')
+    cache.put('b', 'bbbb')
+    assert cache.get('a') == 'aaaa'
+    cache.put('c', 'cccc')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'aaaa'
+    assert cache.get('c') == 'cccc'
+    assert cache.size == 8
+
+    # Blobs over the per-entry limit aren't cached.
+    cache.put('d', 'dddddd')
+    assert cache.get('d') is None
+    assert len(cache) == 2
+
+
+def test_get_from_blockstore_reads_through_caches(config, tmpdir,
+                                                  monkeypatch):
+    backend = LocalBackend(directory=str(tmpdir.mkdir('store')))
+    disk_cache = LocalBackend(directory=str(tmpdir.mkdir('cache')))
+    monkeypatch.setattr(blockstore, '_backend', backend)
+    monkeypatch.setattr(blockstore, '_disk_cache', disk_cache)
+    monkeypatch.setattr(blockstore, '_cache', BlobCache(1024, 1024))
+    data = 'company logo'
+    h = sha256(data).hexdigest()
+    backend.save(h, data)
+
+    assert blockstore.get_from_blockstore(h) == data
+    assert os.path.exists(disk_cache.path(h))
+    os.unlink(backend.path(h))
+    assert blockstore.get_from_blockstore(h) == data
+
+    # Without the in-process cache, it's read from the disk cache.
+    blockstore._cache.clear()
+    assert blockstore.get_from_blockstore(h) == data
+    assert blockstore.get_many_from_blockstore([h]) == {h: data}
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """Regression tests for HTML parsing."""
-from inbox.util.html import strip_tags
+from inbox.util.html import strip_tags, extract_snippet_text
 
 
 def test_strip_tags():
@@ -20,3 +20,33 @@ def test_preserve_refs():
 
     text = u'veer &amp; wander'
     assert strip_tags(text) == 'veer & wander'
+
+
+def test_extract_snippet_text():
+    paragraph = u'<p>Caf&eacute; &amp; cr&#232;me, <b>50%</b> off!<br>' \
+                u'Ends <a href="http://example.com">soon</a>.</p>\n'
+    docs = [
+        u'<html><head><meta charset="utf-8"><title>Sale</title>'
+        u'<style>p { color: red; }</style></head><body>' +
+        paragraph * 100 + u'</body></html>',
+        # A </head> inside a script mustn't make us skip part of it.
+        u'<html><head><script>document.write("</head>")</script></head>'
+        u'<body>' + paragraph * 100 + u'</body></html>',
+        # strip_tags() keeps character references in titles.
+        u'<html><head><title>This week&#39;s deals</title></head><body>' +
+        paragraph * 100 + u'</body></html>',
+        # Stray </head>s, e.g. from quoted or pasted markup.
+        u'<p>intro</p><div>no head</div></head>after',
+        u'<html><head><title>Re: lunch</title><body><p>Sounds good</p>'
+        u'</head>' + paragraph * 100 + u'</body></html>',
+        u'<header>Logo</header><p>intro</p></head>' + paragraph,
+        u'Hello,<br />world',
+        u'',
+    ]
+    for doc in docs:
+        for length in (5, 191, 10000):
+            snippet_text = extract_snippet_text(doc, length)
+            assert ' '.join(snippet_text.split())[:length] == \
+                ' '.join(strip_tags(doc).split())[:length]
+    # We stop parsing once we have enough text.
+    assert len(extract_snippet_text(docs[0], 191)) < 1000
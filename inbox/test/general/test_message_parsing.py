@@ -125,6 +125,52 @@ def test_save_attachments(db, default_account):
             Block.namespace_id == default_account.namespace.id).count() == 2)
 
 
+def test_parse_in_worker_process(db, default_account, monkeypatch):
+    from inbox.util import mime_parse
+    pool = mime_parse.ParsePool(1)
+    monkeypatch.setattr(mime_parse, 'PARSE_WORKERS', 1)
+    monkeypatch.setattr(mime_parse, 'PARSE_WORKER_THRESHOLD', 0)
+    monkeypatch.setattr(mime_parse, '_pool', pool)
+
+    mime_msg = mime.create.multipart('mixed')
+    mime_msg.append(
+        mime.create.text('html', '<p>This is a message with attachments</p>'),
+        mime.create.attachment('application/pdf', 'filler',
+                               'attached_file.pdf', 'attachment'))
+    raw_message = mime_msg.to_string()
+    try:
+        assert mime_parse.parse_message(
+            raw_message, account_id=default_account.id) == \
+            mime_parse.parse_message_inline(
+                raw_message, account_id=default_account.id)
+        msg = create_from_synced(db, default_account, raw_message)
+    finally:
+        pool.close()
+    assert msg.snippet == 'This is a message with attachments'
+    assert len(msg.parts) == 1
+    assert msg.parts[0].block.data == 'filler'
+
+
+def test_stream_attachments(db, default_account, monkeypatch):
+    monkeypatch.setattr('inbox.util.mime_parse.STREAM_ATTACHMENT_THRESHOLD',
+                        10)
+    mime_msg = mime.create.multipart('mixed')
+    mime_msg.append(
+        mime.create.text('plain', 'This is a message with attachments'),
+        mime.create.attachment('image/png', 'small', 'small.png',
+                               'attachment'),
+        mime.create.attachment('application/pdf', 'a larger attachment',
+                               'large.pdf', 'attachment'))
+    msg = create_from_synced(db, default_account, mime_msg.to_string())
+    blocks = {part.block.filename: part.block for part in msg.parts}
+    # Only the large attachment was written out while parsing, and not
+    # kept in memory.
+    assert hasattr(blocks['small.png'], '_data')
+    assert not hasattr(blocks['large.pdf'], '_data')
+    assert blocks['large.pdf'].size == len('a larger attachment')
+    assert blocks['large.pdf'].data == 'a larger attachment'
+
+
 def test_save_inline_attachments(db, default_account):
     mime_msg = mime.create.multipart('mixed')
     inline_attachment = mime.create.attachment('image/png', 'filler',
@@ -357,6 +403,19 @@ def test_store_full_body_on_parse_error(
     assert get_from_blockstore(m.data_sha256)
 
 
+def test_keep_parsed_metadata_on_parse_error(
+        default_account, mime_message_with_bad_date):
+    m = Message.create_from_synced(default_account, 139219, '[Gmail]/All Mail',
+                                   None,
+                                   mime_message_with_bad_date.to_string())
+    assert m.decode_error
+    # The headers parsed before the bad Date header are kept.
+    assert m.subject == 'Hello'
+    assert m.to_addr == [['Alice', 'alice@example.com']]
+    assert m.cc_addr == [['Bob', 'bob@example.com']]
+    assert m.received_date is not None
+
+
 def test_long_content_id(db, default_account, thread,
                          raw_message_with_long_content_id):
     m = create_from_synced(db, default_account, raw_message_with_long_content_id)
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 # flake8: noqa: F401
 import pytest
-from inbox.util.threading import fetch_corresponding_thread
+from inbox.util.threading import (fetch_corresponding_thread,
+                                  index_thread_references)
 from inbox.util.misc import cleanup_subject
+from inbox.models import Thread
 from inbox.test.util.base import (add_fake_message, add_fake_thread,
                              add_fake_imapuid)
 
@@ -77,5 +79,62 @@ def test_self_send(db, default_namespace):
     assert matched_thread is first_thread, "Should match on self-send"
 
 
+def test_reference_threading(db, default_namespace):
+    thread = add_fake_thread(db.session, default_namespace.id)
+    thread.subject = 'Lunch?'
+    reply = add_fake_message(db.session, default_namespace.id, thread=thread,
+                             subject='Re: Lunch?')
+    reply.message_id_header = '<reply@example.com>'
+    reply.references = ['<original@example.com>']
+    index_thread_references(db.session, default_namespace.id, reply, thread)
+    db.session.commit()
+
+    # The original message arrives after the reply, with no participants in
+    # common and a different subject.
+    original = add_fake_message(db.session, default_namespace.id,
+                                subject='Lunch today?')
+    original.message_id_header = '<original@example.com>'
+    assert fetch_corresponding_thread(db.session, default_namespace.id,
+                                      original) is thread
+
+    # A later reply to the first one.
+    followup = add_fake_message(db.session, default_namespace.id,
+                                subject='Something else entirely')
+    followup.references = ['<original@example.com>', '<reply@example.com>']
+    assert fetch_corresponding_thread(db.session, default_namespace.id,
+                                      followup) is thread
+
+    unrelated = add_fake_message(db.session, default_namespace.id,
+                                 subject='Lunch?')
+    unrelated.message_id_header = '<unrelated@example.com>'
+    assert fetch_corresponding_thread(db.session, default_namespace.id,
+                                      unrelated) is None
+
+
+def test_thread_message_count(db, default_namespace):
+    thread = add_fake_thread(db.session, default_namespace.id)
+    assert thread.message_count is None
+    first = add_fake_message(db.session, default_namespace.id, thread=thread)
+    # Threads created before the column existed are counted once.
+    assert thread.get_message_count() == 1
+    second = add_fake_message(db.session, default_namespace.id, thread=thread)
+    assert thread.message_count == 2
+
+    thread.messages.remove(first)
+    db.session.delete(first)
+    db.session.commit()
+    assert thread.get_message_count() == 1
+
+    # Moving a message between threads updates both counts.
+    other = Thread(subjectdate=second.received_date,
+                   recentdate=second.received_date,
+                   namespace_id=default_namespace.id)
+    db.session.add(other)
+    second.thread = other
+    db.session.commit()
+    assert thread.message_count == 0
+    assert other.message_count == 1
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
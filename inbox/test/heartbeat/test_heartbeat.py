@@ -85,6 +85,16 @@ def test_folder_publish_in_index(redis_client):
     assert fuzzy_equals(proxy.heartbeat_at, timestamp)
 
 
+def test_folder_publish_metadata(redis_client):
+    proxy = proxy_for(1, 2)
+    proxy.publish(state='poll')
+    proxy.publish(poll_interval=40)
+    proxy.publish()
+    metadata = HeartbeatStore.store().get_folder_metadata(proxy.key)
+    assert metadata[0]['state'] == 'poll'
+    assert metadata[0]['poll_interval'] == 40
+
+
 def test_kill_device_multiple():
     # If we kill a device and the folder has multiple devices, don't clear
     # the heartbeat status
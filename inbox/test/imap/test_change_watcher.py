@@ -0,0 +1,117 @@
+# flake8: noqa: F401, F811
+from contextlib import contextmanager
+
+import pytest
+from gevent.event import Event
+
+from inbox.mailsync.backends.imap.monitor import FolderChangeWatcher
+from inbox.test.imap.data import uids, uid_data
+from inbox.util.testutils import mock_imapclient
+
+
+class FakeFolderSyncEngine(object):
+    def __init__(self, folder_name, state='poll'):
+        self.folder_name = folder_name
+        self.state = state
+        self.wakeup = Event()
+
+    def ready(self):
+        return False
+
+
+class IdleDone(Exception):
+    pass
+
+
+class FakeNotifyClient(object):
+    """
+    Returns the scripted IDLE responses, recording which engines were woken
+    up by the previous ones.
+
+    """
+
+    def __init__(self, engines, idle_responses, notify_ok=True):
+        self.engines = engines
+        self.idle_responses = list(idle_responses)
+        self.notify_ok = notify_ok
+        self.notify_calls = []
+        self.woken = []
+        self.selected_folder_name = 'Inbox'
+
+    def notify_set(self, folder_names):
+        self.notify_calls.append(sorted(folder_names))
+        return self.notify_ok
+
+    def idle(self, timeout):
+        self.woken.append(sorted(engine.folder_name for engine in self.engines
+                                 if engine.wakeup.is_set()))
+        for engine in self.engines:
+            engine.wakeup.clear()
+        if not self.idle_responses:
+            raise IdleDone
+        return self.idle_responses.pop(0)
+
+
+class FakeConnectionPool(object):
+    def __init__(self, client):
+        self.client = client
+
+    @contextmanager
+    def get(self):
+        yield self.client
+
+
+def test_status_sweep_detects_changed_folders(db, generic_account,
+                                              mock_imapclient):
+    mock_imapclient.add_folder_data('Inbox', uids.example())
+    archive_data = {1: uid_data.example()}
+    mock_imapclient.add_folder_data('Archive', archive_data)
+    engines = [FakeFolderSyncEngine('Inbox'),
+               FakeFolderSyncEngine('Archive'),
+               FakeFolderSyncEngine('Sent', state='initial')]
+    watcher = FolderChangeWatcher(generic_account.id, 'custom', engines)
+    assert set(watcher.polling_engines()) == {'Inbox', 'Archive'}
+
+    with watcher.conn_pool.get() as crispin_client:
+        # Folders are reported as changed the first time we see them.
+        assert watcher.folder_changed(crispin_client, 'Inbox')
+        assert watcher.folder_changed(crispin_client, 'Archive')
+        assert not watcher.folder_changed(crispin_client, 'Inbox')
+        assert not watcher.folder_changed(crispin_client, 'Archive')
+
+        archive_data[2] = uid_data.example()
+        assert watcher.folder_changed(crispin_client, 'Archive')
+        assert not watcher.folder_changed(crispin_client, 'Inbox')
+
+
+def test_notify_wakes_up_changed_folders(db, generic_account,
+                                         mock_imapclient):
+    engines = [FakeFolderSyncEngine('Inbox'),
+               FakeFolderSyncEngine('Archive'),
+               FakeFolderSyncEngine('Sent', state='initial')]
+    watcher = FolderChangeWatcher(generic_account.id, 'custom', engines)
+    client = FakeNotifyClient(engines, [
+        [('OK', 'Still here')],
+        [('STATUS', 'Archive', ('UIDNEXT', 5))],
+        [(4, 'EXISTS')],
+        [(3, 'FETCH', ('FLAGS', ('\\Seen',))), ('OK', 'Still here')],
+    ])
+    watcher.conn_pool = FakeConnectionPool(client)
+    with pytest.raises(IdleDone):
+        watcher.watch_notify()
+
+    assert client.notify_calls == [['Archive', 'Inbox']]
+    # Keepalives don't wake up the selected folder.
+    assert client.woken == [[], [], ['Archive'], ['Inbox'], ['Inbox']]
+
+
+def test_notify_falls_back_to_status_if_rejected(db, generic_account,
+                                                 mock_imapclient):
+    engines = [FakeFolderSyncEngine('Inbox')]
+    watcher = FolderChangeWatcher(generic_account.id, 'custom', engines)
+    client = FakeNotifyClient(engines, [], notify_ok=False)
+    watcher.conn_pool = FakeConnectionPool(client)
+    watcher.watch_notify()
+    assert watcher.mode == 'status'
+    assert client.notify_calls == [['Inbox']]
+    assert client.woken == []
@@ -0,0 +1,106 @@
+import socket
+import zlib
+
+import mock
+
+from inbox.crispin import CrispinClient
+from inbox.util.imap_compress import can_compress, DeflateStream
+
+
+class FakeIMAP4(object):
+    """The parts of imaplib.IMAP4 DeflateStream relies on."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('rb')
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+
+def deflate(data):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def test_deflate_stream():
+    # Wrap the raw sockets the way imaplib's are.
+    client, server = [socket.socket(_sock=s) for s in socket.socketpair()]
+    imap = FakeIMAP4(client)
+    assert can_compress(imap)
+    # Uncompressed response to COMPRESS DEFLATE, read by imaplib as usual.
+    server.sendall('tag OK DEFLATE active\r\n')
+    assert imap.file.readline() == 'tag OK DEFLATE active\r\n'
+
+    stream = DeflateStream(imap)
+    literal = 'x' * 100000
+    server.sendall(deflate('* 1 FETCH (BODY[] {{{}}}\r\n{})\r\n'
+                           'tag OK done\r\n'.format(len(literal), literal)))
+    assert imap.file.readline() == '* 1 FETCH (BODY[] {100000}\r\n'
+    assert imap.file.read(len(literal)) == literal
+    assert imap.file.readline(4) == ')\r\n'
+    assert imap.file.readline(3) == 'tag'
+    assert imap.file.readline() == ' OK done\r\n'
+
+    imap.send('tag UID FETCH 1:* (FLAGS)\r\n')
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    assert decompressor.decompress(server.recv(1024)) == \
+        'tag UID FETCH 1:* (FLAGS)\r\n'
+
+    assert stream.counts['received.raw'] > 100000
+    assert stream.counts['received.compressed'] < 1000
+    assert stream.counts['sent.raw'] == len('tag UID FETCH 1:* (FLAGS)\r\n')
+
+    server.shutdown(socket.SHUT_WR)
+    assert imap.file.readline() == ''
+    imap.file.close()
+
+
+def test_idle_over_compressed_connection():
+    client, server = [socket.socket(_sock=s) for s in socket.socketpair()]
+    imap = FakeIMAP4(client)
+    conn = mock.Mock()
+    conn._imap._get_line = lambda: imap.file.readline()[:-2]
+    crispin_client = CrispinClient(account_id=1, provider_info=None,
+                                   email_address='inboxapptest@fastmail.fm',
+                                   conn=conn)
+    crispin_client.compression = DeflateStream(imap)
+
+    # The continuation and an update arrive in the same deflate flush, so
+    # the update is decompressed along with the continuation, before
+    # idle_check() selects on the socket.
+    server.sendall(deflate('+ idling\r\n* 4 EXISTS\r\n'))
+    conn.idle.side_effect = lambda: imap.file.readline()
+    conn.idle_check.return_value = []
+    conn.idle_done.return_value = ('IDLE terminated', [(5, 'EXISTS')])
+    assert crispin_client.idle(60) == [(4, 'EXISTS'), (5, 'EXISTS')]
+    # We don't wait for more once we have something.
+    conn.idle_check.assert_called_once_with(0)
+
+    conn.idle_check.reset_mock()
+    conn.idle_done.return_value = ('IDLE terminated', [])
+    server.sendall(deflate('+ idling\r\n'))
+    assert crispin_client.idle(60) == []
+    conn.idle_check.assert_called_once_with(60)
+
+
+def test_partial_line_survives_nonblocking_read():
+    client, server = [socket.socket(_sock=s) for s in socket.socketpair()]
+    imap = FakeIMAP4(client)
+    DeflateStream(imap)
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    server.sendall(compressor.compress('* 4 EXI') +
+                   compressor.flush(zlib.Z_SYNC_FLUSH))
+    # Reading on, e.g. in IMAPClient's idle_check(), hits the end of the
+    # data received so far.
+    client.setblocking(0)
+    try:
+        imap.file.readline()
+    except socket.error:
+        pass
+    server.sendall(compressor.compress('STS\r\n') +
+                   compressor.flush(zlib.Z_SYNC_FLUSH))
+    client.setblocking(1)
+    assert imap.file.readline() == '* 4 EXISTS\r\n'
@@ -12,7 +12,11 @@ import pytest
 
 from inbox.crispin import (CrispinClient, GmailCrispinClient, GMetadata,
                            GmailFlags, RawMessage, Flags,
-                           FolderMissingError, localized_folder_names)
+                           FolderMissingError, localized_folder_names,
+                           parse_vanished, parse_notify_status,
+                           selected_folder_changed,
+                           preview_part, decode_preview, PreviewPart,
+                           or_criteria, sequence_sets)
 
 
 class MockedIMAPClient(imapclient.IMAPClient):
@@ -649,3 +653,141 @@ def test_imap_many_folders_one_role(monkeypatch, constants):
                           map(lambda y: y.role, raw_folders))
         assert len(test_set) == number_roles,\
             "assigned wrong number of {}".format(role)
+
+
+def test_body_batch_falls_back_to_per_uid_fetches(monkeypatch, generic_client,
+                                                  constants):
+    fetched = []
+
+    def fetch(self, messages, data, modifiers=None):
+        fetched.append(messages)
+        if isinstance(messages, list):
+            raise imapclient.IMAPClient.Error(
+                'UID FETCH Server error while fetching messages')
+        if messages == 1765:
+            raise imapclient.IMAPClient.Error(
+                '[UNAVAILABLE] UID FETCH Server error while fetching messages')
+        return {messages: {'INTERNALDATE': None, 'FLAGS': (),
+                           'BODY[]': constants['body'], 'SEQ': 1}}
+
+    monkeypatch.setattr('imapclient.IMAPClient.fetch', fetch)
+
+    messages = generic_client.uids([1764, 1765, 1766])
+    assert [m.uid for m in messages] == [1764, 1766]
+    assert fetched[0] == [1764, 1765, 1766]
+    assert sorted(fetched[1:]) == [1764, 1765, 1766]
+
+
+def test_sizes(generic_client, constants):
+    expected_resp = '{seq} (RFC822.SIZE {size} UID {uid})'.format(**constants)
+    unsolicited_resp = '1198 (UID 1731 MODSEQ (95244) FLAGS (\\Seen))'
+    patch_imap4(generic_client, [expected_resp, unsolicited_resp])
+    uid = constants['uid']
+    assert generic_client.sizes([uid]) == {uid: constants['size']}
+
+
+def test_or_criteria():
+    assert or_criteria('X-GM-THRID', [1]) == ['X-GM-THRID', 1]
+    assert or_criteria('X-GM-THRID', (1, 2, 3)) == \
+        ['OR', 'OR', 'X-GM-THRID', 1, 'X-GM-THRID', 2, 'X-GM-THRID', 3]
+
+
+def test_sequence_sets():
+    assert list(sequence_sets([])) == []
+    assert list(sequence_sets([7, 8, 1, 2, 3, 5, 3])) == ['1:3,5,7:8']
+    assert list(sequence_sets([1, 3, 5, 7, 9, 10, 11], max_length=6)) == \
+        ['1,3,5', '7,9:11']
+    uids = range(1, 2000, 2)
+    seqsets = list(sequence_sets(uids, max_length=100))
+    assert all(len(seqset) <= 100 for seqset in seqsets)
+    assert [long(uid) for seqset in seqsets
+            for uid in seqset.split(',')] == uids
+
+
+def test_preview_part():
+    text_plain = ('TEXT', 'PLAIN', ('CHARSET', 'iso-8859-1'), None, None,
+                  'QUOTED-PRINTABLE', 120, 4)
+    text_html = ('TEXT', 'HTML', None, None, None, 'BASE64', 300, 6)
+    image = ('IMAGE', 'PNG', ('NAME', 'x.png'), None, None, 'BASE64', 9000)
+    assert preview_part(text_plain) == \
+        PreviewPart('1', 'plain', 'quoted-printable', 'iso-8859-1')
+    # multipart/mixed(image, multipart/alternative(html, plain))
+    assert preview_part(([image, ([text_html, text_plain], 'ALTERNATIVE')],
+                         'MIXED')) == \
+        PreviewPart('2.1', 'html', 'base64', None)
+    assert preview_part(([image], 'MIXED')) is None
+    assert preview_part(None) is None
+
+
+def test_decode_preview():
+    part = PreviewPart('1', 'plain', 'quoted-printable', 'iso-8859-1')
+    assert decode_preview('Gr=FC=DFe aus K=\r\n=F6ln', part) == \
+        u'Gr\xfc\xdfe aus K\xf6ln'
+    # Partial fetches cut base64 data off at arbitrary points.
+    part = PreviewPart('1', 'html', 'base64', 'utf-8')
+    assert decode_preview('PHA+SGVsbG8gd29ybGQ8L3A+PHA+VHJ1bmNh', part) == \
+        u'Hello worldTrunca'
+
+
+def test_parse_vanished():
+    assert parse_vanished(['(EARLIER) 41,43:45,118']) == \
+        [(41, 41), (43, 45), (118, 118)]
+    assert parse_vanished(['7:5', '9', '(EARLIER) 6,8']) == [(5, 9)]
+    # Huge ranges aren't expanded.
+    assert parse_vanished(['1:4294967295']) == [(1, 4294967295)]
+    assert parse_vanished([]) == []
+
+
+def test_parse_notify_status():
+    responses = [('STATUS', 'INBOX', ('UIDNEXT', 12)),
+                 ('STATUS', 'Entw&APw-rfe', ('MESSAGES', 3)),
+                 (4, 'EXISTS')]
+    assert parse_notify_status(responses) == {u'INBOX', u'Entw\xfcrfe'}
+
+
+def test_selected_folder_changed():
+    assert selected_folder_changed([(4, 'EXISTS')])
+    assert selected_folder_changed([(2, 'EXPUNGE')])
+    assert selected_folder_changed([(3, 'FETCH', ('FLAGS', ('\\Seen',)))])
+    assert selected_folder_changed([('VANISHED', 41)])
+    # Keepalives and STATUS responses for other folders don't count.
+    assert not selected_folder_changed([('OK', 'Still here')])
+    assert not selected_folder_changed([('STATUS', 'INBOX', ('UIDNEXT', 3))])
+    assert not selected_folder_changed([])
+
+
+def test_notify_set(monkeypatch, generic_client):
+    monkeypatch.setattr(generic_client.conn, '_normalise_folder',
+                        lambda name: '"{}"'.format(name))
+    imap = generic_client.conn._imap
+    imap._simple_command.return_value = ('OK', ['NOTIFY completed'])
+    assert generic_client.notify_set(['INBOX', 'Archive'])
+    imap._simple_command.assert_called_once_with(
+        'NOTIFY', 'SET',
+        '(mailboxes ("INBOX" "Archive") '
+        '(MessageNew MessageExpunge FlagChange))')
+
+    imap._simple_command.return_value = ('BAD', ['Syntax error'])
+    assert not generic_client.notify_set(['INBOX'])
+
+
+def test_qresync_changed_flags(generic_client, constants):
+    expected_resp = '{seq} (FLAGS {flags} ' \
+                    'UID {uid} MODSEQ ({modseq}))'.format(**constants)
+    imap = generic_client.conn._imap
+    imap.untagged_responses = {'VANISHED': ['41']}
+
+    def command_complete(*args):
+        # Simulate the server sending VANISHED (EARLIER) along with the FETCH
+        # responses.
+        imap.untagged_responses['VANISHED'] = ['(EARLIER) 1:3,1700']
+        return ('OK', ['Success'])
+    imap._command_complete.side_effect = command_complete
+    imap._untagged_response.return_value = ('OK', [expected_resp])
+
+    generic_client.qresync_enabled = True
+    changed, vanished = generic_client.qresync_changed_flags(1)
+    uid = constants['uid']
+    assert changed == {uid: Flags(constants['flags'], constants['modseq'])}
+    assert vanished == [(1, 3), (1700, 1700)]
+    assert 'VANISHED' not in imap.untagged_responses
@@ -6,7 +6,8 @@ import gevent
 from gevent.lock import Semaphore
 from sqlalchemy.orm.exc import ObjectDeletedError
 from inbox.crispin import GmailFlags
-from inbox.mailsync.backends.imap.common import (remove_deleted_uids,
+from inbox.mailsync.backends.imap.common import (remap_uids,
+                                                 remove_deleted_uids,
                                                  update_metadata)
 from inbox.mailsync.gc import DeleteHandler, LabelRenameHandler
 from inbox.models import Folder, Message, Transaction
@@ -75,6 +76,59 @@ def test_deleting_from_a_message_with_multiple_uids(db, default_account,
         "The message should have only one imapuid."
 
 
+def test_remove_deleted_uids_in_chunks(db, default_account, default_namespace,
+                                       thread, folder):
+    messages = []
+    for msg_uid in range(100, 105):
+        message = add_fake_message(db.session, default_namespace.id, thread)
+        add_fake_imapuid(db.session, default_account.id, message, folder,
+                         msg_uid)
+        messages.append(message)
+    draft = add_fake_message(db.session, default_namespace.id, thread)
+    draft.is_draft = True
+    add_fake_imapuid(db.session, default_account.id, draft, folder, 105)
+    db.session.commit()
+
+    # Includes a UID we never saved.
+    remove_deleted_uids(default_account.id, folder.id, range(100, 106) + [999],
+                        chunk_size=2)
+    db.session.expire_all()
+
+    with pytest.raises(ObjectDeletedError):
+        draft.id
+    for message in messages:
+        assert message.imapuids == []
+        assert message.deleted_at is not None
+        assert db.session.query(Transaction).filter(
+            Transaction.object_type == 'message',
+            Transaction.record_id == message.id,
+            Transaction.command == 'update').count() >= 1
+    thread.id
+
+
+def test_remap_uids(db, default_account, default_namespace, thread, folder):
+    imapuids = []
+    for g_msgid, msg_uid in [(1, 10), (2, 11), (3, 12), (4, 13), (5, 14)]:
+        message = add_fake_message(db.session, default_namespace.id, thread)
+        message.g_msgid = g_msgid
+        imapuids.append(add_fake_imapuid(db.session, default_account.id,
+                                         message, folder, msg_uid))
+    # An interrupted earlier run already remapped the third message.
+    imapuids[2].msg_uid = -20
+    db.session.commit()
+
+    # The first two messages swap UIDs, and the last one is gone.
+    remap_uids(default_account.id, folder.id, [Message.g_msgid],
+               {1: 11, 2: 10, 3: 20, 4: 21}, chunk_size=2)
+    db.session.expire_all()
+
+    assert [imapuid.msg_uid for imapuid in imapuids[:4]] == [11, 10, 20, 21]
+    with pytest.raises(ObjectDeletedError):
+        imapuids[4].id
+    assert message.imapuids == []
+    assert message.deleted_at is not None
+
+
 def test_deletion_with_short_ttl(db, default_account, default_namespace,
                                  marked_deleted_message, thread, folder):
     handler = DeleteHandler(account_id=default_account.id,
@@ -1,5 +1,8 @@
+from datetime import timedelta
+
 from inbox.crispin import RawFolder
 from inbox.models import Folder
+from inbox.mailsync.backends.imap.generic import FolderInfoCache
 from inbox.mailsync.backends.imap.monitor import ImapSyncMonitor
 from inbox.models.backends.imap import ImapFolderInfo, ImapFolderSyncStatus
 
@@ -75,3 +78,31 @@ def test_imap_folder_sync_enabled(db, default_account):
 
     assert all([not fs.sync_enabled
                 for fs in default_account.foldersyncstatuses])
+
+
+def test_folder_info_cache_writes_behind(db, default_account, monkeypatch):
+    create_foldersyncstatuses(db, default_account)
+    folder = default_account.foldersyncstatuses[0].folder
+    folder_info = FolderInfoCache(default_account.id,
+                                  default_account.namespace.id, folder.id)
+
+    def saved_highestmodseq():
+        db.session.expire_all()
+        return folder.imapfolderinfo.highestmodseq
+
+    folder_info.set('highestmodseq', 23)
+    folder_info.set('uidnext', 100)
+    assert folder_info.get('highestmodseq') == 23
+    folder_info.checkpoint()
+    assert saved_highestmodseq() == 22
+
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.FOLDER_INFO_FLUSH_INTERVAL',
+        timedelta(0))
+    folder_info.checkpoint()
+    assert saved_highestmodseq() == 23
+    assert folder.imapfolderinfo.uidnext == 100
+
+    folder_info.set('highestmodseq', 24)
+    folder_info.flush()
+    assert saved_highestmodseq() == 24
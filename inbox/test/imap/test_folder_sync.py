@@ -1,16 +1,22 @@
 # flake8: noqa: F401, F811
+import re
+import gevent
 import pytest
+from datetime import datetime
 from hashlib import sha256
 from gevent.lock import BoundedSemaphore
+from flanker import mime
 from sqlalchemy.orm.exc import ObjectDeletedError
 from inbox.models import Folder, Message
 from inbox.models.backends.imap import (ImapFolderSyncStatus, ImapUid,
                                         ImapFolderInfo)
 from inbox.mailsync.backends.imap.generic import (FolderSyncEngine, UidInvalid,
-                                                  MAX_UIDINVALID_RESYNCS)
-from inbox.mailsync.backends.gmail import GmailFolderSyncEngine
+                                                  MAX_UIDINVALID_RESYNCS,
+                                                  DownloadQueue, batch_by_size)
+from inbox.mailsync.backends.gmail import GmailFolderSyncEngine, g_msgids
 from inbox.mailsync.backends.base import MailsyncDone
 from inbox.test.imap.data import uids, uid_data # noqa
+from inbox.test.util.base import add_fake_message
 from inbox.util.testutils import mock_imapclient  # noqa
 
 
@@ -71,6 +77,115 @@ def test_initial_sync(db, generic_account, inbox_folder, mock_imapclient):
                                     uid_dict.values()}
 
 
+@pytest.mark.parametrize('pipelined', [True, False])
+def test_initial_sync_downloads_in_batches(db, generic_account, inbox_folder,
+                                           mock_imapclient, monkeypatch,
+                                           pipelined):
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.MAX_DOWNLOAD_COUNT', 2)
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.PIPELINED_DOWNLOAD', pipelined)
+    # Only ever queue a single batch ahead.
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.PIPELINE_MAX_QUEUED_BYTES', 1)
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+
+    body_fetches = []
+    fetch = mock_imapclient.fetch
+
+    def counting_fetch(items, data, modifiers=None):
+        if 'BODY.PEEK[]' in data:
+            body_fetches.append(items)
+        return fetch(items, data, modifiers)
+    mock_imapclient.fetch = counting_fetch
+
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    folder_sync_engine.initial_sync()
+
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == inbox_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+    assert len(body_fetches) == (len(uid_dict) + 1) // 2
+
+
+def test_header_first_initial_sync(db, generic_account, inbox_folder,
+                                   mock_imapclient, monkeypatch):
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.HEADER_FIRST_SYNC_THRESHOLD', 1)
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.BODY_BACKFILL_BATCH_SIZE', 1000)
+    uid_dict = uids.example()
+    texts = {}
+    for uid, data in uid_dict.items():
+        texts[uid] = mime.from_string(data['BODY[]']).parts[0].body
+        data['BODY[HEADER]'] = re.split(r'\r?\n\r?\n', data['BODY[]'], 1)[0]
+        data['BODYSTRUCTURE'] = ([('TEXT', 'PLAIN', ('CHARSET', 'utf-8'),
+                                   None, None, '7BIT', len(texts[uid]), 1)],
+                                 'ALTERNATIVE')
+        data['BODY[1]<0>'] = texts[uid].encode('utf-8')
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    folder_sync_engine.initial_sync()
+
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == inbox_folder.id).all()
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+    for imapuid in saved_uids:
+        message = imapuid.message
+        assert message.body_pending
+        assert message.data_sha256 is None
+        assert message.size == len(uid_dict[imapuid.msg_uid]['BODY[]'])
+        assert message.snippet == message.calculate_plaintext_snippet(
+            texts[imapuid.msg_uid])
+
+    # Once the folder is synced, bodies are backfilled as we poll.
+    folder_sync_engine.state = 'poll'
+    with folder_sync_engine.conn_pool.get() as crispin_client:
+        folder_sync_engine.backfill_pending_bodies(crispin_client)
+    db.session.expire_all()
+    for imapuid in saved_uids:
+        assert not imapuid.message.body_pending
+        assert imapuid.message.data_sha256 == \
+            sha256(uid_dict[imapuid.msg_uid]['BODY[]']).hexdigest()
+
+
+def test_download_queue_bounded_by_size():
+    queue = DownloadQueue(max_bytes=10)
+    queue.put('a', 8)
+    # Putting another item blocks until 'a' has been consumed.
+    putter = gevent.spawn(queue.put, 'b', 8)
+    gevent.sleep(0)
+    assert not putter.ready()
+    assert queue.get() == 'a'
+    putter.join(timeout=1)
+    assert putter.ready()
+    assert queue.size == 8
+    # Oversized items are accepted into an empty queue.
+    assert queue.get() == 'b'
+    queue.put('c', 100)
+    assert queue.get() == 'c'
+
+
+def test_batch_by_size():
+    sizes = {1: 10, 2: 10, 3: 50, 4: 10, 5: 10, 6: 10}
+    assert list(batch_by_size([1, 2, 3, 4, 5, 6], sizes, 30, 10)) == \
+        [[1, 2], [3], [4, 5, 6]]
+    assert list(batch_by_size([1, 2, 4, 5, 6], sizes, 100, 2)) == \
+        [[1, 2], [4, 5], [6]]
+
+
 def test_new_uids_synced_when_polling(db, generic_account, inbox_folder,
                                       mock_imapclient):
     uid_dict = uids.example()
@@ -186,6 +301,47 @@ def test_handle_uidinvalid(db, generic_account, inbox_folder, mock_imapclient):
         ImapUid.folder_id == inbox_folder.id).all() == []
 
 
+def test_handle_uidinvalid_remaps_by_message_id(db, generic_account,
+                                                inbox_folder, mock_imapclient):
+    uid_dict = uids.example()
+    for uid, data in uid_dict.items():
+        message_id = '<{}@example.com>'.format(uid)
+        data['BODY[]'] = 'Message-Id: {}\r\n{}'.format(message_id,
+                                                        data['BODY[]'])
+        data['RFC822.SIZE'] = len(data['BODY[]'])
+        data['BODY[HEADER.FIELDS (MESSAGE-ID)]'] = \
+            'Message-ID: {}\r\n\r\n'.format(message_id)
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+    inbox_folder.imapfolderinfo = ImapFolderInfo(account=generic_account,
+                                                 uidvalidity=1,
+                                                 uidnext=1)
+    db.session.commit()
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    folder_sync_engine.initial_sync()
+    saved = {message_id: uid for uid, message_id in db.session.query(
+        ImapUid.msg_uid, Message.message_id_header).join(Message).filter(
+            ImapUid.folder_id == inbox_folder.id)}
+
+    # The server renumbers the folder, and one message is gone.
+    mock_imapclient._data[inbox_folder.name] = {
+        uid + 1000: data for uid, data in uid_dict.items()[1:]}
+    mock_imapclient.uidvalidity = 2
+    assert folder_sync_engine.resync_uids() == 'initial'
+    db.session.expire_all()
+
+    remapped = {message_id: uid for uid, message_id in db.session.query(
+        ImapUid.msg_uid, Message.message_id_header).join(Message).filter(
+            ImapUid.folder_id == inbox_folder.id)}
+    assert remapped == {message_id: uid + 1000 for message_id, uid
+                        in saved.items() if uid != uid_dict.keys()[0]}
+    assert folder_sync_engine.uidvalidity == 2
+
+
 def test_handle_uidinvalid_loops(db, generic_account, inbox_folder,
                                  mock_imapclient, monkeypatch):
 
@@ -273,11 +429,22 @@ def test_gmail_message_deduplication(db, default_account, all_mail_folder,
         BoundedSemaphore(1))
     all_folder_sync_engine.initial_sync()
 
+    body_fetches = []
+    fetch = mock_imapclient.fetch
+
+    def counting_fetch(items, data, modifiers=None):
+        if 'BODY.PEEK[]' in data:
+            body_fetches.append(items)
+        return fetch(items, data, modifiers)
+    mock_imapclient.fetch = counting_fetch
+
     trash_folder_sync_engine = GmailFolderSyncEngine(
         default_account.id, default_account.namespace.id, trash_folder.name,
         default_account.email_address, 'gmail',
         BoundedSemaphore(1))
     trash_folder_sync_engine.initial_sync()
+    # We already had the message, so we didn't download it again.
+    assert body_fetches == []
 
     # Check that we have two uids, but just one message.
     assert [(uid,)] == db.session.query(ImapUid.msg_uid).filter(
@@ -291,6 +458,48 @@ def test_gmail_message_deduplication(db, default_account, all_mail_folder,
         Message.g_msgid == uid_values['X-GM-MSGID']).count() == 1
 
 
+def test_gmail_thread_expansion_is_batched(db, default_account,
+                                           all_mail_folder, mock_imapclient):
+    # Two threads of three messages each.
+    uid_dict = {}
+    for uid in range(1, 7):
+        uid_dict[uid] = uid_data.example()
+        uid_dict[uid]['X-GM-MSGID'] = 1000 + uid
+        uid_dict[uid]['X-GM-THRID'] = 1001 if uid % 2 else 1002
+    mock_imapclient.add_folder_data(all_mail_folder.name, uid_dict)
+    searches = []
+    search = mock_imapclient.search
+
+    def counting_search(criteria):
+        searches.append(criteria)
+        return search(criteria)
+    mock_imapclient.search = counting_search
+
+    folder_sync_engine = GmailFolderSyncEngine(
+        default_account.id, default_account.namespace.id, all_mail_folder.name,
+        default_account.email_address, 'gmail', BoundedSemaphore(1))
+    with folder_sync_engine.conn_pool.get() as crispin_client:
+        crispin_client.select_folder(all_mail_folder.name, lambda *args: True)
+        # Start from the newest message on each thread.
+        metadata = crispin_client.g_metadata([5, 6])
+        expanded = list(folder_sync_engine.expand_uids_to_download(
+            crispin_client, [5, 6], metadata))
+
+    assert expanded == [6, 4, 2, 5, 3, 1]
+    assert len(searches) == 1
+    assert set(metadata) == set(uid_dict)
+
+
+def test_g_msgids_lookup(db, default_namespace, thread):
+    for g_msgid in range(10, 20):
+        add_fake_message(db.session, default_namespace.id, thread,
+                         g_msgid=g_msgid)
+    assert g_msgids(default_namespace.id, db.session, [], chunk_size=3) == \
+        set()
+    assert g_msgids(default_namespace.id, db.session,
+                    ['5', 12, 13, 19, 20, 30], chunk_size=3) == {12, 13, 19}
+
+
 def test_imap_message_deduplication(db, generic_account, inbox_folder,
                                     generic_trash_folder, mock_imapclient):
     uid = 22
@@ -336,3 +545,31 @@ def test_imap_message_deduplication(db, generic_account, inbox_folder,
     assert db.session.query(Message).filter(
         Message.namespace_id == generic_account.namespace.id,
         Message.data_sha256 == body_sha).count() == 1
+
+
+def test_uid_index_tracks_saved_and_deleted_uids(db, generic_account,
+                                                 inbox_folder,
+                                                 mock_imapclient):
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    folder_sync_engine.initial_sync()
+    assert set(folder_sync_engine.get_uid_index()) == set(uid_dict)
+
+    expunged_uid = min(uid_dict)
+    folder_sync_engine.remove_deleted_uids([expunged_uid])
+    assert expunged_uid not in folder_sync_engine.get_uid_index()
+
+    # A reload picks up changes made behind the engine's back.
+    folder_sync_engine._uid_index_loaded_at = datetime(2000, 1, 1)
+    db.session.query(ImapUid).filter(
+        ImapUid.folder_id == inbox_folder.id,
+        ImapUid.msg_uid == max(uid_dict)).delete()
+    db.session.commit()
+    assert set(folder_sync_engine.get_uid_index()) == \
+        set(uid_dict) - {expunged_uid, max(uid_dict)}
@@ -0,0 +1,20 @@
+from inbox.mailsync.backends.imap.poll_scheduler import PollScheduler
+
+
+def test_poll_interval_backs_off_while_idle():
+    scheduler = PollScheduler(10, 60)
+    assert [scheduler.next_interval() for _ in range(5)] == \
+        [20, 40, 60, 60, 60]
+
+
+def test_poll_interval_snaps_back_on_activity():
+    scheduler = PollScheduler(10, 60)
+    for _ in range(5):
+        scheduler.next_interval()
+    scheduler.record_change()
+    assert scheduler.last_change_at is not None
+    assert scheduler.next_interval() == 10
+    assert scheduler.next_interval() == 20
+
+    scheduler.reset()
+    assert scheduler.next_interval() == 10
@@ -6,6 +6,8 @@ import pytest
 import mock
 from backports import ssl
 
+from inbox.connection_broker import (ConnectionBroker, PRIORITY_HIGH,
+                                     PRIORITY_NORMAL)
 from inbox.crispin import CrispinConnectionPool
 
 
@@ -64,3 +66,46 @@ def test_connection_retained_on_other_errors():
             raise ValueError
     assert conn in pool._queue
     assert not conn.logout.called
+
+
+def test_broker_enforces_budgets_by_priority():
+    broker = ConnectionBroker()
+    limits = {('account', 1): 1, ('host', 'imap.example.com'): None}
+    lease = broker.acquire(limits)
+    granted = []
+
+    def acquire(priority):
+        broker.acquire(limits, priority)
+        granted.append(priority)
+
+    waiters = [gevent.spawn(acquire, PRIORITY_NORMAL),
+               gevent.spawn(acquire, PRIORITY_HIGH)]
+    gevent.sleep(0)
+    assert granted == []
+    # Other accounts aren't held up.
+    broker.acquire({('account', 2): 1})
+
+    lease.release()
+    gevent.sleep(0)
+    assert granted == [PRIORITY_HIGH]
+    gevent.killall(waiters)
+
+
+def test_broker_closes_idle_connections():
+    broker = ConnectionBroker(idle_ttl=60)
+    evicted = []
+    lease = broker.acquire({('host', 'imap.example.com'): 1})
+    lease.on_evict = lambda: evicted.append(lease)
+    lease.checkin()
+
+    # Idle connections make room for new ones when the budget is exhausted.
+    other = broker.acquire({('host', 'imap.example.com'): 1})
+    gevent.sleep(0)
+    assert evicted == [lease]
+    assert not lease.checkout()
+
+    # And are closed once they've been idle for longer than the TTL.
+    other.checkin()
+    other.idle_since -= 61
+    broker._dispatch()
+    assert other.closed
@@ -0,0 +1,44 @@
+from inbox.mailsync.backends.imap.uid_index import UidIndex
+
+
+def test_uid_index_loads_unsorted_input():
+    index = UidIndex([5, 1, 3, 3])
+    assert list(index) == [1, 3, 5]
+    assert 3 in index
+    assert 4 not in index
+    assert index.max() == 5
+    assert UidIndex().max() == 0
+
+
+def test_uid_index_update():
+    index = UidIndex([1, 2, 3])
+    index.update([7, 5])
+    assert list(index) == [1, 2, 3, 5, 7]
+    index.update([4, 5, 6])
+    assert list(index) == range(1, 8)
+
+
+def test_uid_index_difference_update():
+    index = UidIndex(range(1, 11))
+    index.difference_update([2, 4, 42])
+    assert list(index) == [1, 3, 5, 6, 7, 8, 9, 10]
+    index = UidIndex(range(1, 1001))
+    index.difference_update(range(1, 1000))
+    assert list(index) == [1000]
+
+
+def test_uid_index_set_differences():
+    index = UidIndex([1, 2, 3, 5, 8])
+    remote_uids = [9, 8, 4, 3, 1]
+    assert index.difference(remote_uids) == [2, 5]
+    assert index.missing(remote_uids) == [4, 9]
+    assert index.top(2) == [5, 8]
+    assert index.top(0) == []
+
+
+def test_uid_index_in_ranges():
+    index = UidIndex([1, 2, 3, 5, 8, 4000000000])
+    assert index.in_ranges([(2, 5), (7, 4294967295)]) == [2, 3, 5, 8,
+                                                          4000000000]
+    assert index.in_ranges([(9, 100)]) == []
+    assert index.in_ranges([]) == []
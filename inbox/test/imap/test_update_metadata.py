@@ -1,6 +1,7 @@
 import pytest
 import json
 from inbox.crispin import GmailFlags, Flags
+from inbox.models import Transaction
 from inbox.models.backends.imap import ImapUid
 from inbox.mailsync.backends.imap.common import (update_metadata,
                                                  update_message_metadata)
@@ -52,6 +53,38 @@ def test_generic_drafts_flag_constrained_by_folder(db, generic_account,
     assert message.is_draft == (folder_role == 'drafts')
 
 
+def test_update_metadata_creates_one_revision_per_object(db, generic_account):
+    thread = add_fake_thread(db.session, generic_account.namespace.id)
+    folder = add_fake_folder(db.session, generic_account)
+    messages = []
+    for msg_uid in range(1, 6):
+        message = add_fake_message(db.session, generic_account.namespace.id,
+                                   thread)
+        add_fake_imapuid(db.session, generic_account.id, message, folder,
+                         msg_uid)
+        messages.append(message)
+
+    def update_count(table, record_id):
+        return db.session.query(Transaction).filter(
+            Transaction.object_type == table,
+            Transaction.record_id == record_id,
+            Transaction.command == 'update').count()
+
+    thread_revisions = update_count('thread', thread.id)
+    message_revisions = {m.id: update_count('message', m.id)
+                         for m in messages}
+
+    new_flags = {msg_uid: Flags(('\\Seen', '\\Flagged'), None)
+                 for msg_uid in range(1, 6)}
+    update_metadata(generic_account.id, folder.id, 'inbox', new_flags,
+                    db.session, batch_size=10)
+
+    assert all(m.is_read and m.is_starred for m in messages)
+    assert update_count('thread', thread.id) == thread_revisions + 1
+    for m in messages:
+        assert update_count('message', m.id) == message_revisions[m.id] + 1
+
+
 def test_update_categories_when_actionlog_entry_missing(
         db, default_account, message, imapuid):
     message.categories_changes = True
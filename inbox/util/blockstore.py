@@ -1,46 +1,307 @@
+"""
+Storage for raw messages and attachments, by the hex SHA-256 of their
+contents.
+
+Blobs are stored by one of these backends, chosen with BLOCKSTORE_BACKEND:
+
+'s3'
+    The TEMP_MESSAGE_STORE_BUCKET_NAME S3 bucket. The default if
+    STORE_MESSAGES_ON_S3 is set.
+'disk'
+    Uncompressed files in MSG_PARTS_DIRECTORY, nested six directories deep
+    by the first characters of their hash. The default otherwise.
+'local'
+    Compressed files in MSG_PARTS_DIRECTORY (see LocalBackend), for
+    deployments that keep their blobs on local disk. Blobs written by the
+    'disk' backend can still be read, so existing deployments can switch.
+
+Reads go through an in-process LRU cache of recently read blobs (see
+BlobCache) and, if BLOCKSTORE_DISK_CACHE_DIRECTORY is set, a second cache
+tier on local disk, which can be shared by the processes on a host. The
+disk tier is meant to sit in front of S3; it isn't pruned by the sync
+engine, so run something like tmpreaper on it.
+
+"""
 import os
+import tempfile
 import time
+import zlib
+from collections import OrderedDict
 from hashlib import sha256
 
+try:
+    import zstandard
+except ImportError:
+    # Only needed for BLOCKSTORE_COMPRESSION = 'zstd'.
+    zstandard = None
+
 from inbox.config import config
+from inbox.util.file import mkdirp
 from inbox.util.stats import statsd_client
 from nylas.logging import get_logger
 log = get_logger()
 
 # TODO: store AWS credentials in a better way.
 STORE_MSG_ON_S3 = config.get('STORE_MESSAGES_ON_S3', None)
-
-if STORE_MSG_ON_S3:
+BLOCKSTORE_BACKEND = config.get('BLOCKSTORE_BACKEND',
+                                's3' if STORE_MSG_ON_S3 else 'disk')
+# Compression used by the 'local' backend for new blobs: 'zlib', 'zstd' or
+# None.
+BLOCKSTORE_COMPRESSION = config.get('BLOCKSTORE_COMPRESSION', 'zlib')
+BLOCKSTORE_COMPRESSION_LEVEL = config.get('BLOCKSTORE_COMPRESSION_LEVEL', 6)
+# Whether the 'local' backend fsyncs blobs before renaming them into place.
+BLOCKSTORE_FSYNC = config.get('BLOCKSTORE_FSYNC', False)
+# Total size of the in-process cache of blobs read, and the size of the
+# largest blob it caches, in bytes. 0 disables the cache.
+BLOCKSTORE_CACHE_MAX_BYTES = config.get('BLOCKSTORE_CACHE_MAX_BYTES',
+                                        64 * 1024 * 1024)
+BLOCKSTORE_CACHE_MAX_ENTRY_BYTES = config.get(
+    'BLOCKSTORE_CACHE_MAX_ENTRY_BYTES', 8 * 1024 * 1024)
+# Directory of the on-disk cache of blobs read; None disables it.
+BLOCKSTORE_DISK_CACHE_DIRECTORY = config.get(
+    'BLOCKSTORE_DISK_CACHE_DIRECTORY', None)
+
+if BLOCKSTORE_BACKEND == 's3':
     from boto.s3.connection import S3Connection
     from boto.s3.key import Key
-else:
-    from inbox.util.file import mkdirp
 
-    def _data_file_directory(h):
-        return os.path.join(config.get_required('MSG_PARTS_DIRECTORY'),
-                            h[0], h[1], h[2], h[3], h[4], h[5])
+# The first byte of each blob file written by LocalBackend says how the rest
+# of it is compressed.
+RAW = '\x00'
+ZLIB = '\x01'
+ZSTD = '\x02'
 
-    def _data_file_path(h):
-        return os.path.join(_data_file_directory(h), h)
 
+def _data_file_directory(h):
+    return os.path.join(config.get_required('MSG_PARTS_DIRECTORY'),
+                        h[0], h[1], h[2], h[3], h[4], h[5])
 
-def save_to_blockstore(data_sha256, data):
-    assert data is not None
-    assert type(data) is not unicode
 
-    if len(data) == 0:
-        log.warning('Not saving 0-length data blob')
-        return
+def _data_file_path(h):
+    return os.path.join(_data_file_directory(h), h)
 
-    if STORE_MSG_ON_S3:
+
+class BlockstoreBackend(object):
+    """Interface of the blockstore backends."""
+
+    def save(self, data_sha256, data):
+        raise NotImplementedError
+
+    def get(self, data_sha256):
+        """Return the blob with the given hash, or None if there's none."""
+        raise NotImplementedError
+
+    def get_many(self, data_sha256s):
+        """Return a dict of hash: blob (or None) for the given hashes."""
+        return {h: self.get(h) for h in data_sha256s}
+
+
+class S3Backend(BlockstoreBackend):
+
+    def save(self, data_sha256, data):
         _save_to_s3(data_sha256, data)
-    else:
+
+    def get(self, data_sha256):
+        return _get_from_s3(data_sha256)
+
+
+class DiskBackend(BlockstoreBackend):
+
+    def save(self, data_sha256, data):
         directory = _data_file_directory(data_sha256)
         mkdirp(directory)
 
         with open(_data_file_path(data_sha256), 'wb') as f:
             f.write(data)
 
+    def get(self, data_sha256):
+        return _get_from_disk(data_sha256)
+
+
+class LocalBackend(BlockstoreBackend):
+    """
+    Compressed blobs on local disk, in a two-level fan-out of 256 * 256
+    directories (e.g. 'ab/cd/abcd...'), which keeps directories small
+    without the lookups of deeper nesting.
+
+    Each file starts with a byte saying how the rest of it is compressed.
+    Blobs which don't get smaller (e.g. JPEGs, ZIP files) are stored as is.
+    Blobs are written to a temporary file which is then renamed into place,
+    so that readers never see partial blobs, and aren't written at all if a
+    blob with the same hash exists already.
+
+    Parameters
+    ----------
+    compression: str or None
+        'zlib', 'zstd' (requires the zstandard package) or None.
+    level: int
+        The compression level.
+    fsync: bool
+        Whether to fsync blobs before renaming them into place.
+    directory: str, optional
+        Defaults to MSG_PARTS_DIRECTORY.
+
+    """
+
+    def __init__(self, compression=BLOCKSTORE_COMPRESSION,
+                 level=BLOCKSTORE_COMPRESSION_LEVEL, fsync=BLOCKSTORE_FSYNC,
+                 directory=None):
+        if compression not in ('zlib', 'zstd', None):
+            raise ValueError('Unknown compression: {}'.format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires zstandard')
+        self.compression = compression
+        self.level = level
+        self.fsync = fsync
+        self._directory = directory
+
+    @property
+    def directory(self):
+        return self._directory or config.get_required('MSG_PARTS_DIRECTORY')
+
+    def path(self, data_sha256):
+        return os.path.join(self.directory, data_sha256[:2],
+                            data_sha256[2:4], data_sha256)
+
+    def compress(self, data):
+        if self.compression == 'zlib':
+            header, compressed = ZLIB, zlib.compress(data, self.level)
+        elif self.compression == 'zstd':
+            header, compressed = ZSTD, zstandard.ZstdCompressor(
+                level=self.level).compress(data)
+        else:
+            return RAW + data
+        if len(compressed) >= len(data):
+            return RAW + data
+        return header + compressed
+
+    def decompress(self, stored):
+        header, data = stored[:1], stored[1:]
+        if header == RAW:
+            return data
+        elif header == ZLIB:
+            return zlib.decompress(data)
+        elif header == ZSTD:
+            if zstandard is None:
+                raise ValueError('Reading a zstd blob requires zstandard')
+            return zstandard.ZstdDecompressor().decompress(data)
+        raise ValueError('Unknown blob header: {!r}'.format(header))
+
+    def save(self, data_sha256, data):
+        path = self.path(data_sha256)
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        mkdirp(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                        prefix='.{}.'.format(data_sha256))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.compress(data))
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, data_sha256):
+        if not data_sha256:
+            return None
+        try:
+            with open(self.path(data_sha256), 'rb') as f:
+                return self.decompress(f.read())
+        except IOError:
+            pass
+        if self._directory is None:
+            # Blobs written by DiskBackend.
+            return _get_from_disk(data_sha256)
+        return None
+
+
+BACKENDS = {'s3': S3Backend, 'disk': DiskBackend, 'local': LocalBackend}
+_backend = None
+_disk_cache = None
+
+
+def get_backend():
+    """Return the BLOCKSTORE_BACKEND backend."""
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[BLOCKSTORE_BACKEND]()
+    return _backend
+
+
+def get_disk_cache():
+    """
+    Return the LocalBackend for the on-disk cache tier, or None if there's
+    none configured.
+
+    """
+    global _disk_cache
+    if _disk_cache is None and BLOCKSTORE_DISK_CACHE_DIRECTORY:
+        _disk_cache = LocalBackend(directory=BLOCKSTORE_DISK_CACHE_DIRECTORY)
+    return _disk_cache
+
+
+class BlobCache(object):
+    """
+    LRU cache of blobs by hash, bounded by their total size.
+
+    Parameters
+    ----------
+    max_bytes: int
+        Total size of the cached blobs.
+    max_entry_bytes: int
+        Size of the largest blob to cache; larger ones would push out too
+        many others.
+
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, data_sha256):
+        value = self._entries.pop(data_sha256, None)
+        if value is not None:
+            self._entries[data_sha256] = value
+        return value
+
+    def put(self, data_sha256, value):
+        if len(value) > self.max_entry_bytes or data_sha256 in self._entries:
+            return
+        self._entries[data_sha256] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+_cache = BlobCache(BLOCKSTORE_CACHE_MAX_BYTES,
+                   BLOCKSTORE_CACHE_MAX_ENTRY_BYTES)
+
+
+def save_to_blockstore(data_sha256, data):
+    assert data is not None
+    assert type(data) is not unicode
+
+    if len(data) == 0:
+        log.warning('Not saving 0-length data blob')
+        return
+
+    get_backend().save(data_sha256, data)
+
 
 def _save_to_s3(data_sha256, data):
     assert 'TEMP_MESSAGE_STORE_BUCKET_NAME' in config, \
@@ -74,11 +335,40 @@ def _save_to_s3_bucket(data_sha256, bucket_name, data):
     statsd_client.timing('s3_blockstore.save_latency', latency_millis)
 
 
+def _get_cached(data_sha256):
+    value = _cache.get(data_sha256)
+    if value is not None:
+        statsd_client.incr('blockstore.cache.hits')
+        statsd_client.incr('blockstore.cache.hit_bytes', len(value))
+        return value
+    statsd_client.incr('blockstore.cache.misses')
+
+    disk_cache = get_disk_cache()
+    if disk_cache is not None:
+        value = disk_cache.get(data_sha256)
+        if value is not None and data_sha256 == sha256(value).hexdigest():
+            statsd_client.incr('blockstore.disk_cache.hits')
+            statsd_client.incr('blockstore.disk_cache.hit_bytes', len(value))
+            _cache.put(data_sha256, value)
+            return value
+        statsd_client.incr('blockstore.disk_cache.misses')
+
+
+def _cache_fetched(data_sha256, value):
+    statsd_client.incr('blockstore.cache.miss_bytes', len(value))
+    disk_cache = get_disk_cache()
+    if disk_cache is not None:
+        disk_cache.save(data_sha256, value)
+    _cache.put(data_sha256, value)
+    statsd_client.gauge('blockstore.cache.bytes', _cache.size)
+
+
 def get_from_blockstore(data_sha256):
-    if STORE_MSG_ON_S3:
-        value = _get_from_s3(data_sha256)
-    else:
-        value = _get_from_disk(data_sha256)
+    value = _get_cached(data_sha256)
+    if value is not None:
+        return value
+
+    value = get_backend().get(data_sha256)
 
     if value is None:
         # We don't store None values so if such is returned, it's an error.
@@ -87,9 +377,35 @@ def get_from_blockstore(data_sha256):
 
     assert data_sha256 == sha256(value).hexdigest(), \
         "Returned data doesn't match stored hash!"
+    _cache_fetched(data_sha256, value)
     return value
 
 
+def get_many_from_blockstore(data_sha256s):
+    """
+    Like get_from_blockstore(), for several hashes at once. Returns a dict
+    of hash: blob, or None for blobs which weren't found.
+
+    """
+    values = {}
+    for data_sha256 in set(data_sha256s):
+        values[data_sha256] = _get_cached(data_sha256)
+    missing = [h for h, value in values.iteritems() if value is None]
+    if not missing:
+        return values
+
+    fetched = get_backend().get_many(missing)
+    for data_sha256, value in fetched.iteritems():
+        if value is None:
+            log.error('No data returned!', sha256=data_sha256)
+            continue
+        assert data_sha256 == sha256(value).hexdigest(), \
+            "Returned data doesn't match stored hash!"
+        _cache_fetched(data_sha256, value)
+    values.update(fetched)
+    return values
+
+
 def _get_from_s3(data_sha256):
     assert 'AWS_ACCESS_KEY_ID' in config, 'Need AWS key!'
     assert 'AWS_SECRET_ACCESS_KEY' in config, 'Need AWS secret!'
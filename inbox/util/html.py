@@ -63,6 +63,82 @@ def strip_tags(html):
         get_logger().error('error stripping tags', raw_html=html)
     return s.get_data()
 
+# A document's <head> is skipped by extract_snippet_text() if the document
+# starts with it, unless it contains scripts or comments, which might contain
+# a spurious </head>, character references, which strip_tags() keeps even
+# inside <title>, or the start of the body (i.e. the </head> we found is
+# stray markup, e.g. from a quoted message).
+HEAD_START_RE = re.compile(
+    r'\s*(<!doctype[^>]*>\s*)?(<html(\s[^>]*)?>\s*)?<head[\s>]', re.I)
+HEAD_END_RE = re.compile(r'</head\s*>', re.I)
+HEAD_SKIP_UNSAFE_RE = re.compile(r'<(?:script|!--|body)|&', re.I)
+
+
+class SnippetComplete(Exception):
+    pass
+
+
+class SnippetExtractor(HTMLTagStripper):
+    """
+    HTMLTagStripper which stops parsing (by raising SnippetComplete) once it
+    has collected more than `length` non-whitespace characters of text.
+
+    """
+
+    def __init__(self, length):
+        HTMLTagStripper.__init__(self)
+        self.length = length
+        self.visible_length = 0
+
+    def _count(self, start):
+        for d in self.fed[start:]:
+            self.visible_length += len(u''.join(d.split()))
+        if self.visible_length > self.length:
+            raise SnippetComplete()
+
+    def handle_data(self, d):
+        start = len(self.fed)
+        HTMLTagStripper.handle_data(self, d)
+        self._count(start)
+
+    def handle_charref(self, d):
+        start = len(self.fed)
+        HTMLTagStripper.handle_charref(self, d)
+        self._count(start)
+
+    def handle_entityref(self, d):
+        start = len(self.fed)
+        HTMLTagStripper.handle_entityref(self, d)
+        self._count(start)
+
+
+def extract_snippet_text(html, length):
+    """
+    Return enough of the start of strip_tags(html) to contain its first
+    `length` characters once whitespace is collapsed, i.e.
+
+        ' '.join(extract_snippet_text(html, n).split())[:n] ==
+            ' '.join(strip_tags(html).split())[:n]
+
+    but without stripping the whole document: parsing stops once we have
+    enough text. The contents of <head> (which strip_tags() only drops in
+    part, but which in practice don't contain visible text) are skipped
+    without parsing them.
+
+    """
+    if HEAD_START_RE.match(html):
+        match = HEAD_END_RE.search(html)
+        if match and not HEAD_SKIP_UNSAFE_RE.search(html, 0, match.start()):
+            html = html[match.end():]
+    s = SnippetExtractor(length)
+    try:
+        s.feed(html)
+    except SnippetComplete:
+        pass
+    except HTMLParseError:
+        get_logger().error('error stripping tags', raw_html=html)
+    return s.get_data()
+
 # https://djangosnippets.org/snippets/19/
 re_string = re.compile(ur'(?P<htmlchars>[<&>])|(?P<space>^[ \t]+)|(?P<lineend>\n)|(?P<protocol>(^|\s)((http|ftp)://.*?))(\s|$)', re.S | re.M | re.I | re.U)  # noqa
 
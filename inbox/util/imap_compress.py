@@ -0,0 +1,156 @@
+"""
+IMAP COMPRESS=DEFLATE (RFC 4978) for imaplib connections.
+
+Once the server has accepted a COMPRESS DEFLATE command, everything sent in
+either direction is a raw DEFLATE stream. Neither imaplib nor IMAPClient
+support this, so DeflateStream takes over the file object and send() method
+of the underlying imaplib.IMAP4 instance, which is all the I/O imaplib (and
+IMAPClient's TLS subclass) do.
+
+"""
+import zlib
+
+from inbox.util.stats import statsd_client
+
+# Number of compressed bytes to read from the socket at a time.
+RECV_SIZE = 65536
+# Report byte counts to statsd after this many (uncompressed) bytes of
+# traffic, rather than on every read.
+REPORT_INTERVAL_BYTES = 2 ** 20
+
+
+def can_compress(imap):
+    """
+    Whether we know how to wrap the I/O of `imap`, an imaplib.IMAP4
+    instance. We need to read whatever is available from the socket rather
+    than block for a given number of bytes, so we rely on imaplib's file
+    object being a socket._fileobject.
+
+    """
+    f = getattr(imap, 'file', None)
+    return hasattr(f, '_sock') and hasattr(f, '_rbuf')
+
+
+class DeflateStream(object):
+    """
+    Compress/decompress the traffic of `imap`, an imaplib.IMAP4 instance for
+    which the server has just accepted COMPRESS DEFLATE.
+
+    Parameters
+    ----------
+    metric_prefix: str, optional
+        If given, byte counts before and after compression are reported to
+        statsd as `<metric_prefix>.{received,sent}.{raw,compressed}`.
+
+    """
+
+    def __init__(self, imap, metric_prefix=None):
+        self._file = imap.file
+        self._recv = imap.file._sock.recv
+        self._send = imap.send
+        # Anything the server sent after its OK response, which imaplib may
+        # have buffered already, is compressed.
+        self._pending = imap.file._rbuf.getvalue()
+        imap.file._rbuf.seek(0)
+        imap.file._rbuf.truncate()
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                            zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buf = ''
+        self._pos = 0
+        self.metric_prefix = metric_prefix
+        # Totals for the connection, and the counts not yet reported.
+        self.counts = dict.fromkeys(['received.raw', 'received.compressed',
+                                     'sent.raw', 'sent.compressed'], 0)
+        self._unreported = dict(self.counts)
+        imap.file = self
+        imap.send = self.send
+
+    def _count(self, direction, raw, compressed):
+        for key, count in [(direction + '.raw', raw),
+                           (direction + '.compressed', compressed)]:
+            self.counts[key] += count
+            self._unreported[key] += count
+        if (self._unreported['received.raw'] + self._unreported['sent.raw'] >=
+                REPORT_INTERVAL_BYTES):
+            self.report()
+
+    def report(self):
+        """Send the byte counts since the last report to statsd."""
+        if self.metric_prefix is not None:
+            for key, count in self._unreported.iteritems():
+                if count:
+                    statsd_client.incr('{}.{}'.format(self.metric_prefix, key),
+                                       count)
+        self._unreported = dict.fromkeys(self._unreported, 0)
+
+    def send(self, data):
+        compressed = (self._compressor.compress(data) +
+                      self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self._send(compressed)
+        self._count('sent', len(data), len(compressed))
+
+    def has_buffered_line(self):
+        """
+        Whether a complete line has been decompressed but not read yet.
+        Such data can't be seen by select() on the socket, so callers which
+        select before reading (e.g. IMAPClient's idle_check()) have to
+        check this first.
+
+        """
+        return self._buf.find('\n', self._pos) >= 0
+
+    def _fill(self, chunks):
+        """
+        Replace the (exhausted) buffer with the next chunk of decompressed
+        data. Returns False at EOF. If reading from the socket fails (e.g.
+        it's non-blocking and nothing has arrived yet), `chunks`, the data
+        the caller read so far, are put back into the buffer so that they
+        aren't lost.
+
+        """
+        try:
+            data = self._pending or self._recv(RECV_SIZE)
+        except:
+            self._buf = ''.join(chunks)
+            self._pos = 0
+            raise
+        self._pending = ''
+        if not data:
+            return False
+        self._buf = self._decompressor.decompress(data)
+        self._pos = 0
+        self._count('received', len(self._buf), len(data))
+        return True
+
+    def read(self, size):
+        chunks = []
+        while size > 0:
+            if self._pos == len(self._buf) and not self._fill(chunks):
+                break
+            data = self._buf[self._pos:self._pos + size]
+            self._pos += len(data)
+            size -= len(data)
+            chunks.append(data)
+        return ''.join(chunks)
+
+    def readline(self, limit=-1):
+        chunks = []
+        length = 0
+        while limit < 0 or length < limit:
+            if self._pos == len(self._buf) and not self._fill(chunks):
+                break
+            end = self._buf.find('\n', self._pos)
+            end = len(self._buf) if end < 0 else end + 1
+            if limit >= 0:
+                end = min(end, self._pos + limit - length)
+            chunks.append(self._buf[self._pos:end])
+            length += end - self._pos
+            self._pos = end
+            if chunks[-1].endswith('\n'):
+                break
+        return ''.join(chunks)
+
+    def close(self):
+        self.report()
+        self._file.close()
@@ -15,6 +15,18 @@ def chunk(iterable, size):
         yield group
 
 
+def consume(items):
+    """
+    Yield the items of the list `items`, removing each from the list as it's
+    yielded, so that it can be garbage-collected as soon as the caller is
+    done with it. The list is empty afterwards.
+
+    """
+    items.reverse()
+    while items:
+        yield items.pop()
+
+
 def partition(pred, iterable):
     """ Use a predicate to partition entries into false entries and true
         entries.
@@ -0,0 +1,488 @@
+"""
+Parsing raw MIME messages into plain data.
+
+Message.create_from_synced() and Message.load_body() build their ORM objects
+from the result of parse_message_inline(), which only consists of builtin
+types. That lets us parse large messages in a pool of worker processes
+instead of the sync greenlet: the flanker parse, attachment decoding and
+HTML snippet extraction of a 20MB message take hundreds of milliseconds of
+CPU time, during which no other greenlet in the sync process runs.
+
+The pool is disabled by default; set MIME_PARSE_WORKERS to enable it.
+Messages smaller than MIME_PARSE_WORKER_THRESHOLD bytes are always parsed
+inline, since for them shipping the message to a worker and the result back
+costs about as much as parsing it.
+
+"""
+import binascii
+import cPickle
+import multiprocessing
+import os
+import re
+import struct
+import time
+from hashlib import sha256
+
+import gevent.os
+from gevent.queue import Queue
+from flanker import mime
+
+from inbox.config import config
+from inbox.util.addr import parse_mimepart_address_header
+from inbox.util.blockstore import save_to_blockstore
+from inbox.util.encoding import unicode_safe_truncate
+from inbox.util.html import plaintext2html, extract_snippet_text
+from inbox.util.misc import parse_references, get_internaldate
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+SNIPPET_LENGTH = 191
+
+# Number of parse worker processes. 0 disables the pool.
+PARSE_WORKERS = config.get('MIME_PARSE_WORKERS', 0)
+# Size in bytes from which messages are parsed in the pool.
+PARSE_WORKER_THRESHOLD = config.get('MIME_PARSE_WORKER_THRESHOLD', 2 ** 20)
+# When streaming attachments, the size in bytes from which attachments are
+# written to the blockstore as soon as they're decoded, rather than kept in
+# memory until the message is committed.
+STREAM_ATTACHMENT_THRESHOLD = config.get('MIME_STREAM_ATTACHMENT_THRESHOLD',
+                                         2 ** 16)
+
+# Errors we expect flanker to raise for malformed messages.
+PARSE_ERRORS = (mime.DecodingError, AttributeError, RuntimeError, TypeError)
+PART_PARSE_ERRORS = PARSE_ERRORS + (binascii.Error, UnicodeDecodeError)
+
+HEADER_END_RE = re.compile(r'\r?\n\r?\n')
+
+# Worker requests and responses are pickled, prefixed with their length.
+LENGTH_FORMAT = '!Q'
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+READ_SIZE = 65536
+
+
+def plaintext_snippet(text):
+    return unicode_safe_truncate(' '.join(text.split()), SNIPPET_LENGTH)
+
+
+def html_snippet(text):
+    return plaintext_snippet(extract_snippet_text(text, SNIPPET_LENGTH))
+
+
+def calculate_body(html_parts, plain_parts):
+    """Return the (HTML) body and snippet for the given text parts."""
+    html_body = ''.join(html_parts).decode('utf-8').strip()
+    plain_body = '\n'.join(plain_parts).decode('utf-8').strip()
+    if html_body:
+        return html_body, html_snippet(html_body)
+    elif plain_body:
+        return plaintext2html(plain_body, False), plaintext_snippet(plain_body)
+    return u'', u''
+
+
+def parse_metadata(parsed, body_string, received_date, account_id,
+                   folder_name, mid, metadata=None):
+    """
+    Return the Message attributes which come from the headers of `parsed`,
+    a flanker message, as a dict.
+
+    The attributes are added to `metadata`, if given, as they're parsed, so
+    that callers keep the ones parsed before an error.
+
+    """
+    if metadata is None:
+        metadata = {}
+    mime_version = parsed.headers.get('Mime-Version')
+    # sometimes MIME-Version is '1.0 (1.0)', hence the .startswith()
+    if mime_version is not None and not mime_version.startswith('1.0'):
+        log.warning('Unexpected MIME-Version',
+                    account_id=account_id, folder_name=folder_name,
+                    mid=mid, mime_version=mime_version)
+
+    metadata['subject'] = parsed.subject
+    for key, header in [('from_addr', 'From'), ('sender_addr', 'Sender'),
+                        ('reply_to', 'Reply-To'), ('to_addr', 'To'),
+                        ('cc_addr', 'Cc'), ('bcc_addr', 'Bcc')]:
+        metadata[key] = parse_mimepart_address_header(parsed, header)
+
+    metadata['in_reply_to'] = parsed.headers.get('In-Reply-To')
+
+    # The RFC mandates that the Message-Id header must be at most 998
+    # characters. Sadly, not everybody follows specs.
+    message_id_header = parsed.headers.get('Message-Id')
+    if message_id_header and len(message_id_header) > 998:
+        message_id_header = message_id_header[:998]
+        log.warning('Message-Id header too long. Truncating',
+                    parsed.headers.get('Message-Id'),
+                    logstash_tag='truncated_message_id')
+    metadata['message_id_header'] = message_id_header
+
+    received_date = received_date if received_date else \
+        get_internaldate(parsed.headers.get('Date'),
+                         parsed.headers.get('Received'))
+    # It seems MySQL rounds up fractional seconds in a weird way,
+    # preventing us from reconciling messages correctly. See:
+    # https://github.com/nylas/sync-engine/commit/ed16b406e0a for
+    # more details.
+    metadata['received_date'] = received_date.replace(microsecond=0)
+
+    # Custom Nylas header
+    metadata['nylas_uid'] = parsed.headers.get('X-INBOX-ID')
+
+    # In accordance with JWZ (http://www.jwz.org/doc/threading.html)
+    metadata['references'] = parse_references(
+        parsed.headers.get('References', ''),
+        parsed.headers.get('In-Reply-To', ''))
+
+    metadata['size'] = len(body_string)  # includes headers text
+    return metadata
+
+
+def _attachment(data, content_disposition, content_type, filename,
+                content_id, stream):
+    data = data or ''
+    if isinstance(data, unicode):
+        data = data.encode('utf-8', 'strict')
+    if content_id:
+        content_id = content_id[:255]
+    data_sha256 = sha256(data).hexdigest()
+    size = len(data)
+    if stream and size >= STREAM_ATTACHMENT_THRESHOLD:
+        save_to_blockstore(data_sha256, data)
+        data = None
+    return {'data': data, 'data_sha256': data_sha256, 'size': size,
+            'content_disposition': content_disposition,
+            'content_type': content_type, 'filename': filename,
+            'content_id': content_id}
+
+
+def _parse_mimepart(mimepart, html_parts, plain_parts, attachments,
+                    account_id, mid, stream):
+    """
+    Add the data of `mimepart` to the text parts or attachments. Returns
+    False if the part couldn't be handled.
+
+    """
+    disposition, _ = mimepart.content_disposition
+    content_id = mimepart.headers.get('Content-Id')
+    content_type, params = mimepart.content_type
+
+    filename = mimepart.detected_file_name
+    if filename == '':
+        filename = None
+
+    data = mimepart.body
+
+    is_text = content_type.startswith('text')
+    if disposition not in (None, 'inline', 'attachment'):
+        log.error('Unknown Content-Disposition', account_id=account_id,
+                  mid=mid,
+                  bad_content_disposition=mimepart.content_disposition)
+        return False
+
+    if disposition == 'attachment':
+        attachments.append(_attachment(data, disposition, content_type,
+                                       filename, content_id, stream))
+        return True
+
+    if (disposition == 'inline' and
+            not (is_text and filename is None and content_id is None)):
+        # Some clients set Content-Disposition: inline on text MIME parts
+        # that we really want to treat as part of the text body. Don't
+        # treat those as attachments.
+        attachments.append(_attachment(data, disposition, content_type,
+                                       filename, content_id, stream))
+        return True
+
+    if is_text:
+        if data is None:
+            return True
+        normalized_data = data.encode('utf-8', 'strict')
+        normalized_data = normalized_data.replace('\r\n', '\n'). \
+            replace('\r', '\n')
+        if content_type == 'text/html':
+            html_parts.append(normalized_data)
+        elif content_type == 'text/plain':
+            plain_parts.append(normalized_data)
+        else:
+            log.info('Saving other text MIME part as attachment',
+                     content_type=content_type, account_id=account_id)
+            attachments.append(_attachment(data, 'attachment', content_type,
+                                           filename, content_id, stream))
+        return True
+
+    # Finally, if we get a non-text MIME part without Content-Disposition,
+    # treat it as an attachment.
+    attachments.append(_attachment(data, 'attachment', content_type,
+                                   filename, content_id, stream))
+    return True
+
+
+def parse_body(parsed, account_id, folder_name, mid,
+               stream_attachments=False):
+    """
+    Return the body, snippet and attachments of `parsed`, a flanker message,
+    and whether any of its parts failed to parse, as a dict.
+
+    With `stream_attachments`, attachments of at least
+    STREAM_ATTACHMENT_THRESHOLD bytes are saved to the blockstore as soon as
+    they're decoded, and their data is left out of the result, so that we
+    never hold more than one of them in memory.
+
+    """
+    plain_parts = []
+    html_parts = []
+    attachments = []
+    decode_error = False
+    for mimepart in parsed.walk(
+            with_self=parsed.content_type.is_singlepart()):
+        try:
+            if mimepart.content_type.is_multipart():
+                continue  # TODO should we store relations?
+            if not _parse_mimepart(mimepart, html_parts, plain_parts,
+                                   attachments, account_id, mid,
+                                   stream_attachments):
+                decode_error = True
+        except PART_PARSE_ERRORS as e:
+            log.error('Error parsing message MIME parts',
+                      folder_name=folder_name, account_id=account_id,
+                      error=e)
+            decode_error = True
+    body, snippet = calculate_body(html_parts, plain_parts)
+    return {'body': body, 'snippet': snippet, 'attachments': attachments,
+            'decode_error': decode_error}
+
+
+def parse_message_inline(body_string, received_date=None, account_id=None,
+                         folder_name=None, mid=None, metadata=True,
+                         stream_attachments=False):
+    """
+    Parse the raw MIME message `body_string`.
+
+    Parameters
+    ----------
+    body_string: str
+        The full message, including headers.
+    received_date: datetime, optional
+        The message's received date, if known. Otherwise it's determined
+        from the Date and Received headers.
+    account_id, folder_name, mid:
+        Only used for logging.
+    metadata: bool
+        Whether to parse the headers as well as the body.
+    stream_attachments: bool
+        See parse_body().
+
+    Returns
+    -------
+    dict
+        With keys
+        data_sha256: the hash of `body_string`.
+        metadata: the attributes returned by parse_metadata(), or None if
+            `metadata` is False. If the headers couldn't be parsed, just
+            the attributes parsed before the error.
+        headers: the raw header block, if `metadata` is True and the
+            message could be parsed.
+        body, snippet, attachments: see parse_body(). The attachments are
+            dicts with the data (None if it was streamed to the
+            blockstore), data_sha256, size, content_disposition,
+            content_type, filename and content_id of each part. These are
+            None, None and [] if the message couldn't be parsed at all.
+        decode_error: whether any of the message failed to parse.
+
+    """
+    result = {'data_sha256': sha256(body_string).hexdigest(),
+              'metadata': {} if metadata else None, 'headers': None,
+              'body': None, 'snippet': None, 'attachments': [],
+              'decode_error': True}
+    try:
+        parsed = mime.from_string(body_string)
+        if metadata:
+            parse_metadata(parsed, body_string, received_date, account_id,
+                           folder_name, mid, result['metadata'])
+    except PARSE_ERRORS as e:
+        log.error('Error parsing message metadata' if metadata else
+                  'Error parsing message body', folder_name=folder_name,
+                  account_id=account_id, mid=mid, error=e)
+        return result
+
+    if metadata:
+        match = HEADER_END_RE.search(body_string)
+        result['headers'] = body_string[:match.end()] if match else \
+            body_string
+    result.update(parse_body(parsed, account_id, folder_name, mid,
+                             stream_attachments))
+    return result
+
+
+def _send(fd, obj, write):
+    payload = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    for data in (struct.pack(LENGTH_FORMAT, len(payload)), payload):
+        offset = 0
+        while offset < len(data):
+            offset += write(fd, buffer(data, offset))
+
+
+def _read_exactly(fd, size, read):
+    chunks = []
+    while size:
+        data = read(fd, min(size, READ_SIZE))
+        if not data:
+            raise EOFError
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+
+def _recv(fd, read):
+    length, = struct.unpack(LENGTH_FORMAT,
+                            _read_exactly(fd, LENGTH_SIZE, read))
+    return cPickle.loads(_read_exactly(fd, length, read))
+
+
+def _worker_loop(read_fd, write_fd, parent_fds):
+    # Runs in the worker process, which doesn't use gevent: it only ever
+    # blocks on reading the next request. Close the sync process's ends of
+    # the workers' pipes, so that the workers see EOF when it goes away.
+    for fd in parent_fds:
+        os.close(fd)
+    while True:
+        try:
+            kwargs = _recv(read_fd, os.read)
+        except EOFError:
+            # The sync process closed the pool or exited.
+            return
+        try:
+            response = (True, parse_message_inline(**kwargs))
+        except Exception as e:
+            response = (False, repr(e))
+        _send(write_fd, response, os.write)
+
+
+class ParseWorkerError(Exception):
+    pass
+
+
+class _Worker(object):
+    """A parse worker process, and the pipes to talk to it."""
+
+    # The sync process's ends of all workers' pipes.
+    parent_fds = set()
+
+    def __init__(self):
+        child_read, parent_write = os.pipe()
+        parent_read, child_write = os.pipe()
+        fds = (parent_read, parent_write)
+        self.parent_fds.update(fds)
+        self.process = multiprocessing.Process(
+            target=_worker_loop,
+            args=(child_read, child_write, tuple(self.parent_fds)))
+        self.process.daemon = True
+        try:
+            self.process.start()
+        except Exception:
+            self._close_fds(fds)
+            raise
+        finally:
+            os.close(child_read)
+            os.close(child_write)
+        gevent.os.make_nonblocking(parent_read)
+        gevent.os.make_nonblocking(parent_write)
+        self.read_fd = parent_read
+        self.write_fd = parent_write
+
+    def parse(self, kwargs):
+        _send(self.write_fd, kwargs, gevent.os.nb_write)
+        ok, result = _recv(self.read_fd, gevent.os.nb_read)
+        if not ok:
+            raise ParseWorkerError(result)
+        return result
+
+    def _close_fds(self, fds):
+        for fd in fds:
+            os.close(fd)
+            self.parent_fds.discard(fd)
+
+    def close(self):
+        self._close_fds((self.read_fd, self.write_fd))
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class ParsePool(object):
+    """
+    A pool of worker processes running parse_message_inline(). Workers are
+    started as they are needed, up to `size`.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._worker_count = 0
+        self._idle = Queue()
+
+    def parse(self, **kwargs):
+        """
+        Return parse_message_inline(**kwargs), computed by a worker process.
+        Blocks (cooperatively) until a worker is available.
+
+        """
+        if self._idle.empty() and self._worker_count < self.size:
+            worker = _Worker()
+            self._worker_count += 1
+        else:
+            worker = self._idle.get()
+
+        try:
+            result = worker.parse(kwargs)
+        except ParseWorkerError:
+            self._idle.put(worker)
+            raise
+        except BaseException:
+            # The worker died or was interrupted mid-request (e.g. because
+            # our greenlet was killed), so its pipes can't be reused.
+            self._worker_count -= 1
+            worker.close()
+            raise
+        self._idle.put(worker)
+        return result
+
+    def close(self):
+        """Stop the idle worker processes."""
+        while not self._idle.empty():
+            self._idle.get().close()
+            self._worker_count -= 1
+
+
+_pool = None
+
+
+def get_parse_pool():
+    """Return this process's ParsePool, with PARSE_WORKERS workers."""
+    global _pool
+    if _pool is None:
+        _pool = ParsePool(PARSE_WORKERS)
+    return _pool
+
+
+def parse_message(body_string, **kwargs):
+    """
+    Return parse_message_inline(body_string, **kwargs), computed in the
+    parse worker pool if it's enabled and `body_string` is large enough.
+
+    """
+    if not PARSE_WORKERS or len(body_string) < PARSE_WORKER_THRESHOLD:
+        return parse_message_inline(body_string, **kwargs)
+
+    kwargs['body_string'] = body_string
+    start = time.time()
+    try:
+        result = get_parse_pool().parse(**kwargs)
+    except (EnvironmentError, EOFError, ParseWorkerError) as e:
+        log.error('MIME parse worker failed, parsing inline',
+                  account_id=kwargs.get('account_id'), mid=kwargs.get('mid'),
+                  error=e)
+        return parse_message_inline(**kwargs)
+    statsd_client.timing('mailsync.mime_parse_pool.parse_time',
+                         (time.time() - start) * 1000)
+    return result
@@ -170,10 +170,13 @@ class MockIMAPClient(object):
             # Slow implementation, but whatever
             return [u for u, v in uid_dict.items() if headerstring in
                     v['BODY[]'].lower()]
-        if criteria[0] in ['X-GM-THRID', 'X-GM-MSGID']:
-            assert len(criteria) == 2
-            thrid = criteria[1]
-            return [u for u, v in uid_dict.items() if v[criteria[0]] == thrid]
+        if criteria[0] in ['OR', 'X-GM-THRID', 'X-GM-MSGID']:
+            # e.g. ['OR', 'X-GM-THRID', 1, 'X-GM-THRID', 2]
+            keys = [c for c in criteria if c != 'OR']
+            assert len(keys) == 2 * (len(criteria) - len(keys) + 1)
+            pairs = zip(keys[::2], keys[1::2])
+            return [u for u, v in uid_dict.items()
+                    if any(v[key] == value for key, value in pairs)]
         raise ValueError('unsupported test criteria: {!r}'.format(criteria))
 
     def select_folder(self, folder_name, readonly=False):
@@ -184,26 +187,47 @@ class MockIMAPClient(object):
         assert self.selected_folder is not None
         uid_dict = self._data[self.selected_folder]
         resp = {}
-        if 'BODY.PEEK[]' in data:
-            data.remove('BODY.PEEK[]')
-            data.append('BODY[]')
-        if isinstance(items, (int, long)):
-            items = [items]
-        elif isinstance(items, basestring) and re.match('[0-9]+:\*', items):
-            min_uid = int(items.split(':')[0])
-            items = {u for u in uid_dict if u >= min_uid} | {max(uid_dict)}
-            if modifiers is not None:
-                m = re.match('CHANGEDSINCE (?P<modseq>[0-9]+)', modifiers[0])
-                if m:
-                    modseq = int(m.group('modseq'))
-                    items = {u for u in items
-                             if uid_dict[u]['MODSEQ'][0] > modseq}
+        # Responses to e.g. BODY.PEEK[HEADER] or BODY.PEEK[1]<0.2048> come
+        # back as BODY[HEADER] and BODY[1]<0>.
+        data = [re.sub(r'^BODY\.PEEK(\[[^\]]*\])(?:<(\d+)\.\d+>)?$',
+                       lambda m: 'BODY' + m.group(1) +
+                       ('<{}>'.format(m.group(2)) if m.group(2) else ''), d)
+                for d in data]
+        items = self._match_uids(items)
+        if modifiers is not None:
+            m = re.match('CHANGEDSINCE (?P<modseq>[0-9]+)', modifiers[0])
+            if m:
+                modseq = int(m.group('modseq'))
+                items = {u for u in items
+                         if uid_dict[u]['MODSEQ'][0] > modseq}
         for u in items:
-            if u in uid_dict:
-                resp[u] = {k: v for k, v in uid_dict[u].items() if k in data or
-                           k == 'MODSEQ'}
+            resp[u] = {k: v for k, v in uid_dict[u].items() if k in data or
+                       k == 'MODSEQ'}
         return resp
 
+    def _match_uids(self, items):
+        """Return the saved UIDs in the selected folder matching `items`, a
+        UID, list of UIDs or sequence set string like '1:3,5,7:*'."""
+        uid_dict = self._data[self.selected_folder]
+        if isinstance(items, (int, long)):
+            items = [items]
+        elif isinstance(items, basestring):
+            uids = set()
+            for part in items.split(','):
+                start, _, end = part.partition(':')
+                start = int(start)
+                if end == '*':
+                    # n:* always includes the highest UID, even if it's < n.
+                    uids.update(u for u in uid_dict if u >= start)
+                    uids.update([max(uid_dict)] if uid_dict else [])
+                elif end:
+                    lo, hi = sorted([start, int(end)])
+                    uids.update(u for u in uid_dict if lo <= u <= hi)
+                else:
+                    uids.add(start)
+            items = uids
+        return {u for u in items if u in uid_dict}
+
     def append(self, folder_name, mimemsg, flags, date,
                x_gm_msgid=0, x_gm_thrid=0):
         uid_dict = self._data[folder_name]
@@ -243,7 +267,7 @@ class MockIMAPClient(object):
         return resp
 
     def delete_messages(self, uids, silent=False):
-        for u in uids:
+        for u in self._match_uids(uids):
             del self._data[self.selected_folder][u]
 
     def remove_flags(self, uids, flags):
@@ -1,16 +1,57 @@
 # -*- coding: utf-8 -*-
-from inbox.models.thread import Thread
+from hashlib import sha256
+
+from inbox.models.thread import Thread, ThreadReference
 from sqlalchemy import desc
 from sqlalchemy.orm import joinedload, load_only
 from inbox.util.misc import cleanup_subject
 
 
 MAX_THREAD_LENGTH = 500
+# Number of most recent threads with the same subject we look at for a
+# message which isn't linked to any thread through its Message-IDs.
+MAX_SUBJECT_MATCH_THREADS = 20
+
+
+def message_id_hash(message_id):
+    """Key for `message_id` in the ThreadReference index."""
+    if isinstance(message_id, unicode):
+        message_id = message_id.encode('utf-8')
+    return sha256(message_id).hexdigest()
+
+
+def thread_message_ids(message):
+    """
+    Return the Message-IDs which link `message` to other messages: its own,
+    and the ones from its References and In-Reply-To headers.
+
+    """
+    message_ids = set(message.references or [])
+    message_ids.add(message.message_id_header)
+    return {m.strip() for m in message_ids if m and m.strip()}
 
 
 def fetch_corresponding_thread(db_session, namespace_id, message):
     """fetch a thread matching the corresponding message. Returns None if
-       there's no matching thread."""
+       there's no matching thread.
+
+       We first look the message's Message-IDs up in the ThreadReference
+       index, which finds the thread of any message it replies to, or which
+       replied to it. Only if that fails do we fall back to comparing
+       participants with recent threads with the same subject."""
+    hashes = [message_id_hash(m) for m in thread_message_ids(message)]
+    if hashes:
+        thread = db_session.query(Thread). \
+            join(ThreadReference, ThreadReference.thread_id == Thread.id). \
+            filter(ThreadReference.namespace_id == namespace_id,
+                   ThreadReference.message_id_hash.in_(hashes),
+                   Thread.deleted_at.is_(None)). \
+            order_by(desc(Thread.id)). \
+            options(load_only('id', 'discriminator',
+                              'message_count')).first()
+        if thread is not None:
+            return thread
+
     # FIXME: for performance reasons, we make the assumption that a reply
     # to a message always has a similar subject. This is only
     # right 95% of the time.
@@ -19,7 +60,8 @@ def fetch_corresponding_thread(db_session, namespace_id, message):
         filter(Thread.namespace_id == namespace_id,
                Thread._cleaned_subject == clean_subject). \
         order_by(desc(Thread.id)). \
-        options(load_only('id', 'discriminator'),
+        limit(MAX_SUBJECT_MATCH_THREADS). \
+        options(load_only('id', 'discriminator', 'message_count'),
                 joinedload(Thread.messages).load_only(
                     'from_addr', 'to_addr', 'bcc_addr', 'cc_addr'))
 
@@ -41,7 +83,7 @@ def fetch_corresponding_thread(db_session, namespace_id, message):
             if len(match_emails & message_emails) >= 2:
                 # No need to loop through the rest of the messages
                 # in the thread
-                if len(thread.messages) >= MAX_THREAD_LENGTH:
+                if thread.get_message_count() >= MAX_THREAD_LENGTH:
                     break
                 else:
                     return match.thread
@@ -60,9 +102,27 @@ def fetch_corresponding_thread(db_session, namespace_id, message):
                 # Check that we're not over max thread length in this case
                 # No need to loop through the rest of the messages
                 # in the thread.
-                if len(thread.messages) >= MAX_THREAD_LENGTH:
+                if thread.get_message_count() >= MAX_THREAD_LENGTH:
                     break
                 else:
                     return match.thread
 
     return
+
+
+def index_thread_references(db_session, namespace_id, message, thread):
+    """
+    Add the Message-IDs linking `message` to other messages to the
+    ThreadReference index for `thread`, so that later messages referring to
+    them (or referred to by them) find it.
+
+    """
+    hashes = {message_id_hash(m) for m in thread_message_ids(message)}
+    if hashes and thread.id is not None:
+        hashes.difference_update(
+            h for h, in db_session.query(ThreadReference.message_id_hash).
+            filter(ThreadReference.thread_id == thread.id,
+                   ThreadReference.message_id_hash.in_(hashes)))
+    for h in hashes:
+        db_session.add(ThreadReference(namespace_id=namespace_id,
+                                       thread=thread, message_id_hash=h))
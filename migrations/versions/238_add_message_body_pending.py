@@ -0,0 +1,25 @@
+"""Add Message.body_pending column
+
+Revision ID: 1f2c8b5a9e41
+Revises: 780b1dabd51
+Create Date: 2026-10-18 10:12:41.530127
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f2c8b5a9e41'
+down_revision = '780b1dabd51'
+
+from alembic import op
+from sqlalchemy.sql import text
+
+
+def upgrade():
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE message ADD COLUMN body_pending "
+                      "tinyint(1) NOT NULL DEFAULT '0'"))
+
+
+def downgrade():
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE message DROP COLUMN body_pending"))
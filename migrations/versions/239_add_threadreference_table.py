@@ -0,0 +1,46 @@
+"""Add ThreadReference table
+
+Revision ID: 5c9e3a1d7b02
+Revises: 1f2c8b5a9e41
+Create Date: 2026-10-18 14:03:27.115402
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c9e3a1d7b02'
+down_revision = '1f2c8b5a9e41'
+
+from alembic import op, context
+import sqlalchemy as sa
+
+
+def upgrade():
+    shard_id = int(context.get_x_argument(as_dictionary=True).get('shard_id'))
+
+    op.create_table(
+        'threadreference',
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('namespace_id', sa.BigInteger(), nullable=False),
+        sa.Column('thread_id', sa.BigInteger(), nullable=False),
+        sa.Column('message_id_hash', sa.String(length=64), nullable=False),
+        sa.ForeignKeyConstraint(['thread_id'], [u'thread.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_threadreference_created_at', 'threadreference',
+                    ['created_at'], unique=False)
+    op.create_index('ix_threadreference_thread_id', 'threadreference',
+                    ['thread_id'], unique=False)
+    op.create_index('ix_threadreference_namespace_id_message_id_hash',
+                    'threadreference', ['namespace_id', 'message_id_hash'],
+                    unique=False)
+
+    conn = op.get_bind()
+    increment = (shard_id << 48) + 1
+    conn.execute('ALTER TABLE threadreference AUTO_INCREMENT={}'.format(
+        increment))
+
+
+def downgrade():
+    op.drop_table('threadreference')
@@ -0,0 +1,27 @@
+"""Add Thread.message_count column
+
+Revision ID: 3a7d2e6f1c84
+Revises: 5c9e3a1d7b02
+Create Date: 2026-10-18 12:41:07.214396
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a7d2e6f1c84'
+down_revision = '5c9e3a1d7b02'
+
+from alembic import op
+from sqlalchemy.sql import text
+
+
+def upgrade():
+    # Left NULL for existing threads; their messages are counted the first
+    # time a new message is threaded against them.
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE thread ADD COLUMN message_count "
+                      "int(11) DEFAULT NULL"))
+
+
+def downgrade():
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE thread DROP COLUMN message_count"))